@@ -0,0 +1,256 @@
+"""
+Benchmark of the insert strategies of DatabaseClient (executemany,
+execute_values, multi-row VALUES and COPY) at different batch sizes
+
+Synthetic ScrapingProducts with discounts are inserted through
+DatabaseClient.insert_scraping_products_with_discounts on a kept connection,
+the same calls made by the scrapers, into copies of the stage tables created in
+a separate schema of the database of the .env (a local PostgreSQL, never the
+production one). The schema name must start with "benchmark_" or
+"db_write_benchmark", and it is only dropped and created again with --yes. It
+is dropped at the end unless --keep-schema.
+
+Reports rows/s and the latency percentiles of each batch, and saves the
+results as JSON in benchmarks/results.
+
+Usage:
+    python benchmarks/db_write_benchmark.py --yes
+    python benchmarks/db_write_benchmark.py --yes --batch-size 500 --batch-size 5000 --batches 20
+    python benchmarks/db_write_benchmark.py --yes --strategy executemany --strategy copy
+"""
+
+import argparse
+import json
+import os
+import random
+import re
+import sys
+import time
+from datetime import datetime
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_DIR = os.path.join(ROOT_DIR, "benchmarks", "results")
+
+sys.path.insert(0, os.path.join(ROOT_DIR, "src", "scraping"))
+
+import psycopg2  # noqa: E402
+from psycopg2 import sql  # noqa: E402
+from database.client import DB_CONFIG, INSERT_STRATEGIES, DatabaseClient  # noqa: E402
+from database.models.scraping_product import ScrapingProduct  # noqa: E402
+
+# Stage tables as in doc/dbdiagram.txt, with the indexes of doc/migrations/003
+SCHEMA_DDL = """
+CREATE TABLE {schema}.stage_scraping_products (
+    id bigint PRIMARY KEY,
+    name varchar NOT NULL,
+    market varchar,
+    category varchar,
+    brand varchar,
+    product_url varchar,
+    source_id varchar,
+    price int NOT NULL,
+    quantity decimal(8,2),
+    unit_of_measure varchar,
+    extraction_url text,
+    extraction_date timestamp NOT NULL,
+    currency varchar,
+    created_at timestamp DEFAULT now(),
+    is_processed boolean DEFAULT false
+);
+CREATE INDEX ON {schema}.stage_scraping_products (market, source_id DESC)
+    WHERE is_processed = false;
+
+CREATE TABLE {schema}.stage_discounts (
+    id bigint GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+    product_id bigint NOT NULL,
+    type varchar NOT NULL,
+    discounted_price int NOT NULL,
+    conditions_text varchar,
+    conditions_min_quantity integer,
+    conditions_buy_quantity integer,
+    conditions_get_quantity integer,
+    created_at timestamp DEFAULT now()
+);
+CREATE INDEX ON {schema}.stage_discounts (product_id);
+"""
+
+# The benchmark drops its schema, so it only accepts names that are clearly its own
+SCHEMA_PREFIXES = ("benchmark_", "db_write_benchmark")
+
+CATEGORIES = ["Mercearia", "Bebidas", "Limpeza", "Hortifruti", "Açougue", "Padaria"]
+UNITS = ["UN", "KG", "L", "G", "ML"]
+
+
+def generate_products(count: int, rng: random.Random, discount_rate: float = 0.5) -> list:
+    """ScrapingProducts like the ones of the scrapers, discount_rate of them with wholesale and card discounts"""
+    extraction_date = datetime.now()
+    products = []
+    for _ in range(count):
+        price = rng.randint(100, 20_000)
+        product_number = rng.randint(1, 10_000_000)
+        product = ScrapingProduct(
+            name=f"Produto {product_number} Marca {rng.randint(1, 500)} {rng.randint(1, 5)}kg",
+            market="Benchmark",
+            category=rng.choice(CATEGORIES),
+            price=price,
+            extraction_date=extraction_date,
+            brand=f"Marca {rng.randint(1, 500)}",
+            source_id=str(product_number),
+            quantity=round(rng.uniform(0.1, 5), 2),
+            unit_of_measure=rng.choice(UNITS),
+            product_url=f"https://example.com/produto/{product_number}",
+            extraction_url=f"https://example.com/categoria?page={rng.randint(1, 50)}",
+        )
+        if rng.random() < discount_rate:
+            product.add_wholesale_discount(
+                discounted_price=int(price * 0.9), min_quantity=rng.choice([3, 6, 12])
+            )
+            product.add_card_discount(discounted_price=int(price * 0.95))
+        products.append(product)
+    return products
+
+
+def _percentile(sorted_values: list, fraction: float) -> float:
+    index = min(len(sorted_values) - 1, max(0, round(fraction * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def benchmark_schema(name: str) -> str:
+    """argparse type of --schema: never public or a schema of the application"""
+    if name == "public" or not name.startswith(SCHEMA_PREFIXES):
+        raise argparse.ArgumentTypeError(
+            f"'{name}' is not a benchmark schema, it must start with one of {SCHEMA_PREFIXES}"
+        )
+    # Also used unquoted in the search_path of the connection
+    if not re.fullmatch(r"[a-z0-9_]+", name):
+        raise argparse.ArgumentTypeError(
+            f"'{name}' is not a valid schema name, use lowercase letters, digits and _"
+        )
+    return name
+
+
+def _reset_schema(schema: str, drop_only: bool = False):
+    schema_identifier = sql.Identifier(benchmark_schema(schema))
+    conn = psycopg2.connect(**DB_CONFIG)
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(sql.SQL("DROP SCHEMA IF EXISTS {} CASCADE").format(schema_identifier))
+            if not drop_only:
+                cursor.execute(sql.SQL("CREATE SCHEMA {}").format(schema_identifier))
+                cursor.execute(sql.SQL(SCHEMA_DDL).format(schema=schema_identifier))
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def measure(strategy: str, batch_size: int, batches: int, schema: str, seed: int) -> dict:
+    # Empty tables for each combination, the index sizes don't favour the last one
+    _reset_schema(schema)
+    client = DatabaseClient(
+        "db_write_benchmark",
+        strategy=strategy,
+        db_config={**DB_CONFIG, "options": f"-c search_path={schema}"},
+    )
+    rng = random.Random(seed)
+
+    # One connection for all the batches, as the persist stage of the scrapers
+    with client.keep_connection():
+        # First batch not measured: connection and plan caches
+        warmup = generate_products(batch_size, rng)
+        if not client.insert_scraping_products_with_discounts(warmup):
+            raise RuntimeError(f"Insert with strategy '{strategy}' failed, see the log")
+
+        latencies = []
+        rows = 0
+        for _ in range(batches):
+            products = generate_products(batch_size, rng)
+            rows += len(products) + sum(len(product.discounts) for product in products)
+
+            start_time = time.perf_counter()
+            success = client.insert_scraping_products_with_discounts(products)
+            latencies.append(time.perf_counter() - start_time)
+            if not success:
+                raise RuntimeError(f"Insert with strategy '{strategy}' failed, see the log")
+
+    total_seconds = sum(latencies)
+    latencies.sort()
+    return {
+        "strategy": strategy,
+        "batch_size": batch_size,
+        "batches": batches,
+        "rows": rows,
+        "rows_per_second": round(rows / total_seconds, 1),
+        "products_per_second": round(batch_size * batches / total_seconds, 1),
+        "p50_ms": round(_percentile(latencies, 0.5) * 1000, 2),
+        "p95_ms": round(_percentile(latencies, 0.95) * 1000, 2),
+        "p99_ms": round(_percentile(latencies, 0.99) * 1000, 2),
+        "max_ms": round(latencies[-1] * 1000, 2),
+    }
+
+
+def run(strategies: list, batch_sizes: list, batches: int, schema: str, seed: int) -> dict:
+    results = []
+    for batch_size in batch_sizes:
+        for strategy in strategies:
+            result = measure(strategy, batch_size, batches, schema, seed)
+            results.append(result)
+            print(
+                f"{strategy:<15} {batch_size:>6} products/batch {result['rows_per_second']:>10,.1f} rows/s "
+                f"p50 {result['p50_ms']:>9.2f} ms  p95 {result['p95_ms']:>9.2f} ms  "
+                f"p99 {result['p99_ms']:>9.2f} ms"
+            )
+    return {
+        "created_at": datetime.now().replace(microsecond=0).isoformat(),
+        "database": {"host": DB_CONFIG["host"], "database": DB_CONFIG["database"]},
+        "results": results,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark of the database insert strategies")
+    parser.add_argument(
+        "--strategy", action="append", choices=INSERT_STRATEGIES, help="default: all"
+    )
+    parser.add_argument(
+        "--batch-size",
+        action="append",
+        type=int,
+        help="products per insert (default: 50, 500 and 5000)",
+    )
+    parser.add_argument("--batches", type=int, default=10, help="measured batches per combination")
+    parser.add_argument(
+        "--schema",
+        type=benchmark_schema,
+        default="db_write_benchmark",
+        help=f"schema of the test tables, starting with one of {SCHEMA_PREFIXES}",
+    )
+    parser.add_argument("--keep-schema", action="store_true", help="keep the inserted rows")
+    parser.add_argument(
+        "--yes", action="store_true", help="confirm that the schema can be dropped and created again"
+    )
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    if not args.yes:
+        parser.error(
+            f"the schema '{args.schema}' of {DB_CONFIG['host']}/{DB_CONFIG['database']} "
+            "is dropped (CASCADE) and created again, run with --yes to confirm"
+        )
+
+    try:
+        report = run(
+            args.strategy or list(INSERT_STRATEGIES),
+            args.batch_size or [50, 500, 5000],
+            args.batches,
+            args.schema,
+            args.seed,
+        )
+    finally:
+        if not args.keep_schema:
+            _reset_schema(args.schema, drop_only=True)
+
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    filename = os.path.join(RESULTS_DIR, f"db_write_{report['created_at'].replace(':', '-')}.json")
+    with open(filename, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print(f"\nResults saved in: {filename}")
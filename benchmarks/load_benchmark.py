@@ -0,0 +1,192 @@
+"""
+End-to-end load benchmark of the scrapers against the mock market server
+
+The real market modules run (one process each, to measure their memory) with
+their URLs pointing to benchmarks/mock_market_server.py. The random delays
+between requests are disabled unless --keep-delays is used.
+
+Reports pages/s, products/s and the peak memory (max RSS) of each market, and
+saves the results as JSON in benchmarks/results.
+
+Usage:
+    python benchmarks/load_benchmark.py
+    python benchmarks/load_benchmark.py --market tenda --categories 20 --products 1000
+    python benchmarks/load_benchmark.py --latency-ms 80 --error-rate 0.02 --rate-limit 30 --concurrency 8
+    python benchmarks/load_benchmark.py --persist db     # insert in the database of the .env
+    python benchmarks/load_benchmark.py --market stmarche --products 5000 --streaming
+"""
+
+import argparse
+import importlib
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from urllib.parse import urlparse
+
+from mock_market_server import add_server_arguments, create_server
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCRAPING_DIR = os.path.join(ROOT_DIR, "src", "scraping")
+RESULTS_DIR = os.path.join(ROOT_DIR, "benchmarks", "results")
+
+MARKETS = ["tenda", "stmarche"]
+
+
+class _DiscardingClient:
+    """Database client of --persist none: the products are dropped, only the scraping is measured"""
+
+    def __init__(self, logger_name: str = None):
+        pass
+
+    @contextmanager
+    def keep_connection(self):
+        yield self
+
+    def insert_scraping_products_with_discounts(self, scraping_products_list):
+        return True
+
+
+def _point_to_mock_server(module, market: str, base_url: str):
+    if market == "tenda":
+        module.URL_API = (
+            base_url
+            + "/api/public/store/category/{category_id}/products?&page={page}&order=relevance"
+        )
+        module.URL_CATEGORIES = base_url + "/api/recommendations/departments"
+    else:
+        module.BASE_URL = base_url
+
+
+def _run_market(market: str, base_url: str, options: dict) -> dict:
+    """Entry point of the process of each market"""
+    # The snapshots of the run are written in a temporary directory
+    os.chdir(tempfile.mkdtemp(prefix=f"load_benchmark_{market}_"))
+    sys.path.insert(0, SCRAPING_DIR)
+
+    import pipeline
+    from orchestrator import MARKETS as MARKET_MODULES, STREAMING_MARKETS
+    from utils import http_request
+
+    pipeline.RETRY_WAIT_SECONDS = options["retry_wait_seconds"]
+    if not options["keep_delays"]:
+        http_request.MIN_DELAY_SECONDS = http_request.MAX_DELAY_SECONDS = 0
+    if options["concurrency"]:
+        http_request.set_host_concurrency(
+            urlparse(base_url).hostname, initial=1, maximum=options["concurrency"]
+        )
+
+    module = importlib.import_module(MARKET_MODULES[market])
+    _point_to_mock_server(module, market, base_url)
+    if options["persist"] == "none":
+        module.DatabaseClient = _DiscardingClient
+
+    run_options = {"category_workers": options["category_workers"]}
+    if options["streaming"] and market in STREAMING_MARKETS:
+        run_options["streaming"] = True
+
+    start_time = time.perf_counter()
+    report = module.run(**run_options)
+    seconds = time.perf_counter() - start_time
+
+    fetch_stage = next(stage for stage in report["stages"] if stage["stage"] == "fetch")
+    pages = fetch_stage["items_out"]
+    return {
+        "market": market,
+        "seconds": round(seconds, 2),
+        "pages": pages,
+        "products": report["products"],
+        "pages_per_second": round(pages / seconds, 1),
+        "products_per_second": round(report["products"] / seconds, 1),
+        # KB on Linux
+        "peak_memory_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        "lost_pages": len(report.get("retries", {}).get("lost", [])),
+        "hosts": http_request.host_concurrency_stats(),
+        "stages": report["stages"],
+    }
+
+
+def run(args) -> dict:
+    server = create_server(args)
+    server.start()
+    print(
+        f"Mock server on {server.url}: {len(server.catalog.categories)} categories, "
+        f"{server.catalog.total_products} products per market"
+    )
+
+    options = {
+        "category_workers": args.category_workers,
+        "concurrency": args.concurrency,
+        "keep_delays": args.keep_delays,
+        "persist": args.persist,
+        "streaming": args.streaming,
+        "retry_wait_seconds": args.retry_wait_seconds,
+    }
+
+    results = []
+    # spawn: each market starts with a clean process, so the peak memory is its own
+    context = multiprocessing.get_context("spawn")
+    for market in args.market or MARKETS:
+        with context.Pool(1) as pool:
+            result = pool.apply(_run_market, (market, server.url, options))
+        results.append(result)
+        print(
+            f"{market:<10} {result['pages']:>6} pages {result['pages_per_second']:>8.1f} pages/s "
+            f"{result['products']:>8} products {result['products_per_second']:>10.1f} products/s "
+            f"peak {result['peak_memory_mb']:.1f} MB"
+        )
+
+    server.shutdown()
+    return {
+        "created_at": datetime.now().replace(microsecond=0).isoformat(),
+        "server": {
+            "categories": args.categories,
+            "products": args.products,
+            "page_size": args.page_size,
+            "latency_ms": args.latency_ms,
+            "error_rate": args.error_rate,
+            "rate_limit": args.rate_limit,
+            **server.stats,
+        },
+        "options": options,
+        "markets": results,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load benchmark of the scrapers")
+    parser.add_argument("--market", action="append", choices=MARKETS, help="default: all")
+    add_server_arguments(parser)
+    parser.add_argument("--category-workers", type=int, default=2)
+    parser.add_argument(
+        "--concurrency", type=int, help="enable the adaptive concurrency with this maximum"
+    )
+    parser.add_argument(
+        "--keep-delays", action="store_true", help="keep the random delays between requests"
+    )
+    parser.add_argument(
+        "--persist",
+        choices=["none", "db"],
+        default="none",
+        help="none: drop the products, db: insert them in the database",
+    )
+    parser.add_argument(
+        "--streaming", action="store_true", help="streaming mode of the markets that support it"
+    )
+    parser.add_argument(
+        "--retry-wait-seconds", type=float, default=1, help="pause before each round of retries"
+    )
+    args = parser.parse_args()
+
+    report = run(args)
+
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    filename = os.path.join(RESULTS_DIR, f"load_{report['created_at'].replace(':', '-')}.json")
+    with open(filename, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print(f"\nResults saved in: {filename}")
@@ -0,0 +1,352 @@
+"""
+Local HTTP server that emulates the markets, to benchmark the scrapers without
+sending requests to the real sites
+
+    Tenda      GET /api/recommendations/departments
+               GET /api/public/store/category/{id}/products?page=N
+    St Marche  GET /?store_id=...                          (home with the categories)
+               GET /collections/{slug}?store_id=...&page=N  (products of the category)
+    Stats      GET /__stats
+
+The catalog is generated from a seed, so every run serves the same products.
+Latency, errors (500) and a rate limit (429 with Retry-After) can be injected.
+
+Usage:
+    python benchmarks/mock_market_server.py --port 8080 --latency-ms 50 --error-rate 0.01 --rate-limit 20
+"""
+
+import argparse
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+from urllib.parse import parse_qs, urlparse
+
+PRODUCT_NAMES = [
+    ("Biscoito CLUB SOCIAL Original Pacote 144g", "Club Social"),
+    ("Cerveja Pilsen Corona Lata 350ml", "Corona"),
+    ("Refrigerante Coca-Cola Garrafa 2L", "Coca-Cola"),
+    ("Arroz Branco Tipo 1 Camil 5kg", "Camil"),
+    ("Feijão Carioca Kicaldo 1kg", "Kicaldo"),
+    ("Café Torrado e Moído Pilão 500g", "Pilão"),
+    ("Leite UHT Integral Italac 1L", "Italac"),
+    ("Azeite de Oliva Extra Virgem Gallo 500ml", "Gallo"),
+    ("Sabão em Pó Omo Lavagem Perfeita 1,6kg", "Omo"),
+    ("Iogurte Natural Nestlé c/ 4 unidades 170g", "Nestlé"),
+    ("Açúcar Refinado União 1kg", "União"),
+    ("Macarrão Espaguete Renata 500g", "Renata"),
+    ("Chocolate ao Leite Lacta 80g", "Lacta"),
+    ("Água Mineral sem Gás Crystal 1,5L", "Crystal"),
+    ("Banana Prata", None),
+    ("Picanha Bovina a Vácuo Resfriada 1,7kg", None),
+]
+
+STORE_ID = "66677604431"
+
+
+class MockCatalog:
+    """Categories and products served by the mock markets"""
+
+    def __init__(
+        self,
+        categories: int = 10,
+        products_per_category: int = 500,
+        page_size: int = 24,
+        seed: int = 1,
+    ):
+        self.page_size = page_size
+        rng = random.Random(seed)
+
+        self.categories = []
+        for index in range(categories):
+            # Categories of different sizes, like the real ones
+            size = max(1, int(products_per_category * rng.uniform(0.25, 1.75)))
+            products = []
+            for position in range(size):
+                name, brand = PRODUCT_NAMES[(index + position) % len(PRODUCT_NAMES)]
+                price = round(rng.uniform(2, 90), 2)
+                products.append(
+                    {
+                        "id": index * 100_000 + position,
+                        "name": f"{name} {index}-{position}",
+                        "brand": brand,
+                        "price": price,
+                        "url": f"/produto/{index}-{position}",
+                        "wholesalePrices": (
+                            [
+                                {"minQuantity": 3, "price": round(price * 0.95, 2)},
+                                {"minQuantity": 6, "price": round(price * 0.9, 2)},
+                            ]
+                            if position % 2 == 0
+                            else []
+                        ),
+                    }
+                )
+            self.categories.append(
+                {
+                    "id": 3400 + index,
+                    "name": f"Categoria {index}",
+                    "slug": f"categoria-{index}",
+                    "products": products,
+                }
+            )
+
+        self._by_id = {category["id"]: category for category in self.categories}
+        self._by_slug = {category["slug"]: category for category in self.categories}
+
+    @property
+    def total_products(self) -> int:
+        return sum(len(category["products"]) for category in self.categories)
+
+    def page(self, category: dict, page: int) -> list:
+        start = (page - 1) * self.page_size
+        return category["products"][start : start + self.page_size]
+
+    def total_pages(self, category: dict) -> int:
+        return -(-len(category["products"]) // self.page_size)
+
+    def by_id(self, category_id: int) -> Optional[dict]:
+        return self._by_id.get(category_id)
+
+    def by_slug(self, slug: str) -> Optional[dict]:
+        return self._by_slug.get(slug)
+
+
+class _TokenBucket:
+    def __init__(self, requests_per_second: float):
+        self.rate = requests_per_second
+        self.tokens = requests_per_second
+        self.updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def take(self) -> bool:
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return True
+            return False
+
+
+_TENDA_PRODUCTS = re.compile(r"^/api/public/store/category/(\d+)/products$")
+_MARCHE_CATEGORY = re.compile(r"^/collections/([\w-]+)$")
+
+
+class MockMarketServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(
+        self,
+        address,
+        catalog: MockCatalog,
+        latency_ms: float = 0,
+        error_rate: float = 0,
+        rate_limit: Optional[float] = None,
+        seed: int = 1,
+    ):
+        super().__init__(address, _Handler)
+        self.catalog = catalog
+        self.latency_ms = latency_ms
+        self.error_rate = error_rate
+        self.rate_limit = _TokenBucket(rate_limit) if rate_limit else None
+        self.random = random.Random(seed)
+        self.stats = {"requests": 0, "errors": 0, "rate_limited": 0}
+        self._stats_lock = threading.Lock()
+
+    @property
+    def url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def count(self, key: str):
+        with self._stats_lock:
+            self.stats[key] += 1
+
+    def start(self) -> threading.Thread:
+        """Serve in a background thread"""
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return thread
+
+
+class _Handler(BaseHTTPRequestHandler):
+    server: MockMarketServer
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status: int, body: str, content_type: str, headers: Optional[dict] = None):
+        data = body.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _send_json(self, data):
+        self._send(200, json.dumps(data, ensure_ascii=False), "application/json; charset=utf-8")
+
+    def _send_html(self, html: str):
+        # Without charset, like St Marche (the scraper fixes the encoding with encode_text)
+        self._send(200, html, "text/html")
+
+    def do_GET(self):
+        server = self.server
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+
+        if url.path == "/__stats":
+            self._send_json(dict(server.stats, products=server.catalog.total_products))
+            return
+
+        server.count("requests")
+
+        if server.rate_limit is not None and not server.rate_limit.take():
+            server.count("rate_limited")
+            self._send(429, "Too Many Requests", "text/plain", {"Retry-After": "1"})
+            return
+
+        if server.latency_ms:
+            # +-50% of jitter
+            time.sleep(server.latency_ms * server.random.uniform(0.5, 1.5) / 1000)
+
+        if server.error_rate and server.random.random() < server.error_rate:
+            server.count("errors")
+            self._send(500, "Internal Server Error", "text/plain")
+            return
+
+        page = int(query.get("page", ["1"])[0])
+
+        if url.path == "/api/recommendations/departments":
+            self._send_json(
+                [
+                    {"idDepartment": category["id"], "nameDepartment": category["name"]}
+                    for category in server.catalog.categories
+                ]
+            )
+            return
+
+        match = _TENDA_PRODUCTS.match(url.path)
+        if match:
+            category = server.catalog.by_id(int(match.group(1)))
+            if category is None:
+                self._send(404, "Not Found", "text/plain")
+                return
+            self._send_json(
+                {
+                    "total_pages": server.catalog.total_pages(category),
+                    "total_products": len(category["products"]),
+                    "page": page,
+                    "products": server.catalog.page(category, page),
+                }
+            )
+            return
+
+        if url.path == "/":
+            self._send_html(_marche_home(server.catalog))
+            return
+
+        match = _MARCHE_CATEGORY.match(url.path)
+        if match:
+            category = server.catalog.by_slug(match.group(1))
+            if category is None:
+                self._send(404, "Not Found", "text/plain")
+                return
+            self._send_html(_marche_category_page(category, server.catalog.page(category, page)))
+            return
+
+        self._send(404, "Not Found", "text/plain")
+
+
+def _marche_home(catalog: MockCatalog) -> str:
+    links = "\n".join(
+        f'      <a href="/collections/{category["slug"]}">{category["name"]}</a>'
+        for category in catalog.categories
+    )
+    return f"""<!DOCTYPE html>
+<html lang="pt-BR">
+<body>
+  <nav><div class="category-slider_3a4b5">
+{links}
+  </div></nav>
+</body>
+</html>
+"""
+
+
+def _marche_category_page(category: dict, products: list) -> str:
+    cards = []
+    for product in products:
+        price = f"R$\xa0{product['price']:.2f}".replace(".", ",")
+        cards.append(
+            f"""    <div class="algolia-insights product-card">
+      <a href="/collections/{category['slug']}/products/{product['id']}?store_id={STORE_ID}">
+        <h4 class="_product-card-title_2b3c4">{product['name']}</h4>
+      </a>
+      <div class="_product-card-price_5d6e7">
+        <span class="_product-card-price-regular_1x2y3">{price}</span>
+        <span class="_product-card-price-measurement_9a8b7">un</span>
+      </div>
+    </div>"""
+        )
+    return f"""<!DOCTYPE html>
+<html lang="pt-BR">
+<body>
+  <main>
+    <h1>{category['name']}</h1>
+    <div class="collection-grid">
+{chr(10).join(cards)}
+    </div>
+  </main>
+</body>
+</html>
+"""
+
+
+def add_server_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("--categories", type=int, default=10, help="categories of each market")
+    parser.add_argument(
+        "--products", type=int, default=500, help="average number of products per category"
+    )
+    parser.add_argument("--page-size", type=int, default=24, help="products per page")
+    parser.add_argument("--latency-ms", type=float, default=0, help="latency of each response")
+    parser.add_argument(
+        "--error-rate", type=float, default=0, help="fraction of responses with status 500"
+    )
+    parser.add_argument(
+        "--rate-limit", type=float, help="requests per second before answering 429"
+    )
+    parser.add_argument("--seed", type=int, default=1, help="seed of the catalog and the errors")
+
+
+def create_server(args, host: str = "127.0.0.1", port: int = 0) -> MockMarketServer:
+    catalog = MockCatalog(args.categories, args.products, args.page_size, args.seed)
+    return MockMarketServer(
+        (host, port),
+        catalog,
+        latency_ms=args.latency_ms,
+        error_rate=args.error_rate,
+        rate_limit=args.rate_limit,
+        seed=args.seed,
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Mock market server")
+    parser.add_argument("--port", type=int, default=8080)
+    add_server_arguments(parser)
+    args = parser.parse_args()
+
+    mock_server = create_server(args, port=args.port)
+    print(
+        f"Serving {len(mock_server.catalog.categories)} categories and "
+        f"{mock_server.catalog.total_products} products per market on {mock_server.url}"
+    )
+    mock_server.serve_forever()
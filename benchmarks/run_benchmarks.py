@@ -0,0 +1,373 @@
+"""
+Benchmarks of the parsers, encoders and models of the scrapers
+
+The inputs are the fixtures in benchmarks/fixtures, so the results only depend
+on the code. They are synthetic, not recorded: a Tenda search API response and a
+St Marche category page written by hand with the structure the scrapers parse
+(24 products each), so they don't cover every variation of the real pages.
+
+Each run is saved as JSON in benchmarks/results and can be compared with a
+previous one to catch regressions.
+
+Usage:
+    python benchmarks/run_benchmarks.py
+    python benchmarks/run_benchmarks.py --filter tenda --filter normalize
+    python benchmarks/run_benchmarks.py --compare benchmarks/results/<previous>.json
+"""
+
+import argparse
+import importlib.util
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import timeit
+from datetime import datetime
+from types import SimpleNamespace
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FIXTURES_DIR = os.path.join(ROOT_DIR, "benchmarks", "fixtures")
+RESULTS_DIR = os.path.join(ROOT_DIR, "benchmarks", "results")
+
+sys.path.insert(0, os.path.join(ROOT_DIR, "src", "scraping"))
+
+# Times each benchmark is measured, the best and the median are reported
+REPEAT = 5
+
+# A benchmark is a regression when it is this much slower than the compared run
+REGRESSION_THRESHOLD = 0.2
+
+BENCHMARKS = {}
+
+
+def benchmark(name: str):
+    """
+    Register a benchmark. The decorated function prepares the inputs and
+    returns (function to measure, operations per call).
+    """
+
+    def register(setup):
+        BENCHMARKS[name] = setup
+        return setup
+
+    return register
+
+
+def _read_fixture(filename: str) -> str:
+    with open(os.path.join(FIXTURES_DIR, filename), "r", encoding="utf-8") as f:
+        return f.read()
+
+
+def _tenda_page() -> dict:
+    return json.loads(_read_fixture("tenda_search_page.json"))
+
+
+def _marche_page():
+    return SimpleNamespace(text=_read_fixture("marche_category_page.html"))
+
+
+def _load_transforming_utils():
+    # src/transforming/utils.py has the same name as the scraping utils package
+    spec = importlib.util.spec_from_file_location(
+        "transforming_utils", os.path.join(ROOT_DIR, "src", "transforming", "utils.py")
+    )
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def _product_names() -> list:
+    return [product["name"] for product in _tenda_page()["products"]]
+
+
+def _scraping_products() -> list:
+    from database.models.scraping_product import ScrapingProduct
+    from utils.encoders import price_to_int
+
+    products = []
+    for product_item in _tenda_page()["products"]:
+        product = ScrapingProduct(
+            name=product_item["name"],
+            market="Tenda",
+            price=price_to_int(product_item["price"]),
+            extraction_date=datetime(2025, 8, 6, 16, 22, 9),
+            category="Mercearia",
+            brand=product_item["brand"],
+            source_id=str(product_item["id"]),
+            product_url=product_item["url"],
+        )
+        for wholesale_price in product_item["wholesalePrices"]:
+            product.add_wholesale_discount(
+                discounted_price=price_to_int(wholesale_price["price"]),
+                min_quantity=wholesale_price["minQuantity"],
+            )
+        products.append(product)
+    return products
+
+
+@benchmark("tenda.parse_search_products")
+def _bench_tenda_parse():
+    import market_tenda_api
+
+    page = _tenda_page()
+    return (
+        lambda: market_tenda_api._parse_tenda_search_products(page, "benchmark", "Mercearia"),
+        len(page["products"]),
+    )
+
+
+@benchmark("html_parser.parse_html")
+def _bench_parse_html():
+    from utils.html_parser import parse_html
+
+    response = _marche_page()
+    return lambda: parse_html(response), 1
+
+
+@benchmark("marche.extract_product_data")
+def _bench_marche_extract():
+    import market_marche
+    from utils.html_parser import parse_html
+
+    soup = parse_html(_marche_page())
+    cards = [
+        (card, card.find("a", href=True))
+        for card in soup.find_all("div", class_="algolia-insights")
+    ]
+
+    def extract():
+        for card, link in cards:
+            market_marche._extract_product_data(card, link, "Mercearia", "benchmark")
+
+    return extract, len(cards)
+
+
+@benchmark("encoders.price_to_int")
+def _bench_price_to_int():
+    from utils.encoders import price_to_int
+
+    prices = [product["price"] for product in _tenda_page()["products"]]
+    prices += ["R$\xa025,89", "R$ 5.825,10", "13,60", "0,13", "1.234,56"]
+
+    def convert():
+        for price in prices:
+            price_to_int(price)
+
+    return convert, len(prices)
+
+
+@benchmark("encoders.string_to_decimal")
+def _bench_string_to_decimal():
+    from utils.encoders import string_to_decimal
+
+    values = ["R$\xa025,89", "R$ 5.825,10", "asdsa 13,60", "13.60", "0,13", "1,2 kg", "500 g"]
+
+    def convert():
+        for value in values:
+            string_to_decimal(value)
+
+    return convert, len(values)
+
+
+@benchmark("normalize_word.cold")
+def _bench_normalize_cold():
+    # Without the lru_cache: cost of the first time a name is seen
+    normalize_word = _load_transforming_utils().normalize_word.__wrapped__
+    names = _product_names()
+
+    def normalize():
+        for name in names:
+            normalize_word(name)
+
+    return normalize, len(names)
+
+
+@benchmark("normalize_word.cached")
+def _bench_normalize_cached():
+    normalize_word = _load_transforming_utils().normalize_word
+    names = _product_names()
+
+    def normalize():
+        for name in names:
+            normalize_word(name)
+
+    return normalize, len(names)
+
+
+@benchmark("measures.extract_measure.cold")
+def _bench_extract_measure_cold():
+    # Without the lru_cache of the names: cost of the first time a name is seen.
+    # The sizes ("500g", "1L") repeat a lot between names, so their conversion stays cached
+    from utils.measures import extract_measure
+
+    extract = extract_measure.__wrapped__
+    names = _product_names()
+
+    def extract_all():
+        for name in names:
+            extract(name)
+
+    return extract_all, len(names)
+
+
+@benchmark("measures.extract_measure.cached")
+def _bench_extract_measure_cached():
+    from utils.measures import extract_measure
+
+    names = _product_names()
+
+    def extract_all():
+        for name in names:
+            extract_measure(name)
+
+    return extract_all, len(names)
+
+
+@benchmark("scraping_product.to_dict")
+def _bench_to_dict():
+    products = _scraping_products()
+
+    def convert():
+        for product in products:
+            product.to_dict()
+
+    return convert, len(products)
+
+
+@benchmark("scraping_product.to_tuple")
+def _bench_to_tuple():
+    products = _scraping_products()
+
+    def convert():
+        for product in products:
+            product.to_tuple()
+
+    return convert, len(products)
+
+
+@benchmark("snowflake.generate_id")
+def _bench_snowflake():
+    from database.snowflake_id import SnowflakeIDGenerator
+
+    generator = SnowflakeIDGenerator(machine_id=1)
+    ids = 1000
+
+    def generate():
+        for _ in range(ids):
+            generator.generate_id()
+
+    return generate, ids
+
+
+def _measure(function, operations: int) -> dict:
+    timer = timeit.Timer(function)
+    # Number of calls that take at least 0.2 seconds
+    calls, _ = timer.autorange()
+    times = [seconds / calls for seconds in timer.repeat(repeat=REPEAT, number=calls)]
+
+    best, median = min(times), statistics.median(times)
+    return {
+        "operations_per_call": operations,
+        "calls": calls,
+        "repeat": REPEAT,
+        "best_us_per_op": round(best / operations * 1e6, 3),
+        "median_us_per_op": round(median / operations * 1e6, 3),
+        "ops_per_second": round(operations / median, 1),
+    }
+
+
+def _git_commit() -> str:
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=ROOT_DIR, text=True
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(filters=None) -> dict:
+    results = {}
+    for name, setup in BENCHMARKS.items():
+        if filters and not any(text in name for text in filters):
+            continue
+        try:
+            function, operations = setup()
+        except ImportError as e:
+            # Benchmarks of modules whose dependencies are not installed
+            print(f"{name:<32} skipped ({e})")
+            results[name] = {"skipped": str(e)}
+            continue
+
+        results[name] = _measure(function, operations)
+        print(
+            f"{name:<32} {results[name]['median_us_per_op']:>12.3f} us/op "
+            f"{results[name]['ops_per_second']:>14,.1f} ops/s"
+        )
+
+    return {
+        "created_at": datetime.now().replace(microsecond=0).isoformat(),
+        "git_commit": _git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "benchmarks": results,
+    }
+
+
+def save(report: dict) -> str:
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    filename = os.path.join(
+        RESULTS_DIR, f"benchmarks_{report['created_at'].replace(':', '-')}.json"
+    )
+    with open(filename, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    return filename
+
+
+def compare(report: dict, previous: dict, threshold: float = REGRESSION_THRESHOLD) -> list:
+    """Print the change of each benchmark and return the names of the regressions"""
+    print(f"\nCompared with {previous.get('git_commit')} ({previous.get('created_at')}):")
+
+    regressions = []
+    for name, result in report["benchmarks"].items():
+        previous_result = previous.get("benchmarks", {}).get(name)
+        if "skipped" in result or not previous_result or "skipped" in previous_result:
+            continue
+
+        # The best time is the least affected by the noise of the machine
+        ratio = result["best_us_per_op"] / previous_result["best_us_per_op"]
+        status = ""
+        if ratio > 1 + threshold:
+            status = "REGRESSION"
+            regressions.append(name)
+        elif ratio < 1 - threshold:
+            status = "faster"
+        print(f"{name:<32} {ratio - 1:>+8.1%} {status}")
+
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks of the scrapers")
+    parser.add_argument(
+        "--filter", action="append", help="only the benchmarks whose name contains this text"
+    )
+    parser.add_argument("--compare", help="results JSON of a previous run")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=REGRESSION_THRESHOLD,
+        help="slowdown considered a regression (0.2 = 20%%)",
+    )
+    args = parser.parse_args()
+
+    report = run(args.filter)
+    print(f"\nResults saved in: {save(report)}")
+
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            regressions = compare(report, json.load(f), args.threshold)
+        if regressions:
+            print(f"\n{len(regressions)} regressions: {', '.join(regressions)}")
+            sys.exit(1)
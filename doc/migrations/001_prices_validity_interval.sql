@@ -0,0 +1,6 @@
+-- Validity interval of the prices, used by the delta mode of the transform
+ALTER TABLE prices ADD COLUMN IF NOT EXISTS valid_to timestamp;
+
+UPDATE prices
+SET valid_to = extraction_date
+WHERE valid_to IS NULL;
@@ -0,0 +1,62 @@
+-- Latest effective price of each product in each supermarket, maintained by the transform
+CREATE TABLE IF NOT EXISTS current_prices (
+    id_supermarket integer NOT NULL,
+    id_product integer NOT NULL,
+    id_price integer NOT NULL,
+    extraction_date timestamp NOT NULL,
+    last_seen timestamp NOT NULL,
+    value int NOT NULL,
+    best_value int NOT NULL,
+    best_condition_type varchar,
+    currency varchar,
+    PRIMARY KEY (id_supermarket, id_product)
+);
+
+CREATE INDEX IF NOT EXISTS current_prices_id_product_best_value_idx
+    ON current_prices (id_product, best_value);
+
+-- Cheapest current offer of each product across all the supermarkets
+CREATE TABLE IF NOT EXISTS best_offers (
+    id_product integer PRIMARY KEY,
+    id_supermarket integer NOT NULL,
+    id_price integer NOT NULL,
+    extraction_date timestamp NOT NULL,
+    last_seen timestamp NOT NULL,
+    value int NOT NULL,
+    best_value int NOT NULL,
+    best_condition_type varchar,
+    currency varchar
+);
+
+-- Backfill from the prices already registered
+INSERT INTO current_prices (
+    id_supermarket, id_product, id_price, extraction_date, last_seen,
+    value, best_value, best_condition_type, currency
+)
+SELECT DISTINCT ON (p.id_supermarket, p.id_product)
+    p.id_supermarket, p.id_product, p.id, p.extraction_date,
+    COALESCE(p.valid_to, p.extraction_date),
+    p.value, LEAST(p.value, d.unit_value), d.condition_type, p.currency
+FROM prices p
+LEFT JOIN LATERAL (
+    SELECT unit_value, condition_type
+    FROM discounts
+    WHERE id_price = p.id AND unit_value < p.value
+    -- Same discounts as offers.build_offer (BEST_VALUE_DISCOUNT_TYPES)
+    AND condition_type IN ('CARD', 'WHOLESALE')
+    ORDER BY unit_value
+    LIMIT 1
+) d ON true
+ORDER BY p.id_supermarket, p.id_product, p.extraction_date DESC
+ON CONFLICT (id_supermarket, id_product) DO NOTHING;
+
+INSERT INTO best_offers (
+    id_product, id_supermarket, id_price, extraction_date, last_seen,
+    value, best_value, best_condition_type, currency
+)
+SELECT DISTINCT ON (id_product)
+    id_product, id_supermarket, id_price, extraction_date, last_seen,
+    value, best_value, best_condition_type, currency
+FROM current_prices
+ORDER BY id_product, best_value, value, id_supermarket
+ON CONFLICT (id_product) DO NOTHING;
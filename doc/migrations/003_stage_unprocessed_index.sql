@@ -0,0 +1,9 @@
+-- Partial index used by the transform to claim the unprocessed stage rows
+-- (WHERE market = ... AND is_processed = false ORDER BY source_id DESC).
+-- It only contains the pending rows, so it stays small as the stage table grows.
+CREATE INDEX CONCURRENTLY IF NOT EXISTS stage_scraping_products_unprocessed_idx
+    ON stage_scraping_products (market, source_id DESC)
+    WHERE is_processed = false;
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS stage_discounts_product_id_idx
+    ON stage_discounts (product_id);
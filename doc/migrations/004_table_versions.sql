@@ -0,0 +1,8 @@
+-- Version of each table written through DatabaseQueryClient (src/transforming/sql_client.py),
+-- increased after every commit. The result cache compares it to drop the results
+-- cached before a write of another process
+CREATE TABLE IF NOT EXISTS table_versions (
+    table_name varchar PRIMARY KEY,
+    version bigint NOT NULL,
+    updated_at timestamp NOT NULL DEFAULT now()
+);
@@ -1,10 +1,16 @@
+import csv
+import io
 import os
 import psycopg2
 import threading
+from contextlib import contextmanager
+from typing import Optional
 from dotenv import load_dotenv
+from psycopg2.extras import execute_values
 from database.models.scraping_product import ScrapingProduct
 from database.models.product_discount import ProductDiscount
 from utils.logger import Logger
+from utils.metrics import METRICS
 
 load_dotenv()
 
@@ -16,111 +22,226 @@ DB_CONFIG = {
     "port": os.getenv("DB_PORT"),
 }
 
+# Columns of the stage tables, in the order of ScrapingProduct.to_tuple and ProductDiscount.to_tuple
+SCRAPING_PRODUCT_COLUMNS = (
+    "id",
+    "name",
+    "market",
+    "category",
+    "brand",
+    "product_url",
+    "source_id",
+    "price",
+    "quantity",
+    "unit_of_measure",
+    "extraction_url",
+    "extraction_date",
+    "currency",
+)
+DISCOUNT_COLUMNS = (
+    "product_id",
+    "type",
+    "discounted_price",
+    "conditions_text",
+    "conditions_min_quantity",
+    "conditions_buy_quantity",
+    "conditions_get_quantity",
+)
+
+# How the batches are written (compared by benchmarks/db_write_benchmark.py):
+#   executemany     one INSERT per row
+#   execute_values  INSERTs of EXECUTE_VALUES_PAGE_SIZE rows (psycopg2.extras.execute_values)
+#   values          a single INSERT with all the rows of the batch
+#   copy            COPY FROM STDIN in CSV format
+INSERT_STRATEGIES = ("executemany", "execute_values", "values", "copy")
+DEFAULT_INSERT_STRATEGY = os.getenv("DB_INSERT_STRATEGY", "executemany")
+EXECUTE_VALUES_PAGE_SIZE = 100
+
 
 class DatabaseClient:
-    def __init__(self, logger_name: str = "database_client"):
+    def __init__(
+        self,
+        logger_name: str = "database_client",
+        strategy: Optional[str] = None,
+        db_config: Optional[dict] = None,
+    ):
         self.logger = Logger(logger_name)
+        # Label of the metrics of this client
+        self.name = logger_name
+        self.strategy = strategy or DEFAULT_INSERT_STRATEGY
+        if self.strategy not in INSERT_STRATEGIES:
+            raise ValueError(
+                f"Unknown insert strategy '{self.strategy}', expected one of {INSERT_STRATEGIES}"
+            )
+        self.db_config = db_config or DB_CONFIG
+
+        # Connection shared by the queries inside keep_connection()
+        self._keep_connection = False
+        self._kept_conn = None
+        self._kept_conn_lock = threading.Lock()
+
+    @contextmanager
+    def keep_connection(self):
+        """
+        Run the queries of the block on a single connection instead of opening
+        one per query. The persist stage of the scrapers inserts every page with
+        it. A lost connection is opened again by the next query.
+        """
+        self._keep_connection = True
+        try:
+            yield self
+        finally:
+            with self._kept_conn_lock:
+                self._keep_connection = False
+                if self._kept_conn is not None:
+                    self._kept_conn.close()
+                    self._kept_conn = None
+
+    @contextmanager
+    def _connection(self):
+        """Connection of one query (None if it can't connect), closed after it unless kept"""
+        if not self._keep_connection:
+            conn = self._connect_db()
+            try:
+                yield conn
+            finally:
+                if conn is not None:
+                    conn.close()
+            return
+
+        # The queries of the threads that share the client take turns on the connection
+        with self._kept_conn_lock:
+            if self._kept_conn is None or self._kept_conn.closed:
+                self._kept_conn = self._connect_db()
+            yield self._kept_conn
 
     def _connect_db(self):
         try:
-            conn = psycopg2.connect(**DB_CONFIG)
+            with METRICS.timer("db_connect_seconds", client=self.name):
+                conn = psycopg2.connect(**self.db_config)
             self.logger.debug("Database connection established")
             return conn
         except psycopg2.Error as error:
-            self.logger.error(f"Error connecting to the database: {error}")
+            self.logger.error("Error connecting to the database: %s", error)
             return None
 
-    def _insert_scraping_products(self, scraping_products_list):
-        conn = self._connect_db()
+    def _write_rows(self, cursor, table: str, columns: tuple, rows: list):
+        """Write the rows with the strategy of the client (the caller commits)"""
+        column_list = ", ".join(columns)
+        row_placeholders = "(" + ", ".join(["%s"] * len(columns)) + ")"
 
-        if conn is None:
-            return False
-
-        try:
-            cursor = conn.cursor()
-
-            query = """
-            INSERT INTO stage_scraping_products (
-                id, name, market, category, brand, product_url, source_id,
-                price, quantity, unit_of_measure, extraction_url, 
-                extraction_date, currency
-            ) VALUES (
-                %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s
+        if self.strategy == "executemany":
+            cursor.executemany(
+                f"INSERT INTO {table} ({column_list}) VALUES {row_placeholders}", rows
+            )
+        elif self.strategy == "execute_values":
+            execute_values(
+                cursor,
+                f"INSERT INTO {table} ({column_list}) VALUES %s",
+                rows,
+                page_size=EXECUTE_VALUES_PAGE_SIZE,
             )
-            """
-
-            # Convert ScrapingProduct objects to tuples if necessary
-            if scraping_products_list and isinstance(
-                scraping_products_list[0], ScrapingProduct
-            ):
-                data_to_insert = [
-                    product.to_tuple() for product in scraping_products_list
-                ]
-            else:
-                data_to_insert = scraping_products_list
-
-            cursor.executemany(query, data_to_insert)
-            conn.commit()
-
-            self.logger.debug(
-                f"{len(scraping_products_list)} products inserted correctly"
+        elif self.strategy == "values":
+            values = b",".join(cursor.mogrify(row_placeholders, row) for row in rows)
+            cursor.execute(f"INSERT INTO {table} ({column_list}) VALUES ".encode() + values)
+        else:
+            buffer = io.StringIO()
+            # Every value quoted but None, an unquoted empty field is NULL for COPY
+            csv.writer(buffer, quoting=csv.QUOTE_NOTNULL).writerows(rows)
+            buffer.seek(0)
+            cursor.copy_expert(
+                f"COPY {table} ({column_list}) FROM STDIN WITH (FORMAT csv)", buffer
             )
-            return True
 
-        except psycopg2.Error as error:
-            self.logger.error(f"Error inserting products: {error}")
-            conn.rollback()
-            return False
+    def _insert_scraping_products(self, scraping_products_list):
+        with self._connection() as conn:
+            if conn is None:
+                return False
 
-        finally:
-            cursor.close()
-            conn.close()
+            try:
+                cursor = conn.cursor()
+
+                # Convert ScrapingProduct objects to tuples if necessary
+                if scraping_products_list and isinstance(
+                    scraping_products_list[0], ScrapingProduct
+                ):
+                    data_to_insert = [
+                        product.to_tuple() for product in scraping_products_list
+                    ]
+                else:
+                    data_to_insert = scraping_products_list
+
+                with METRICS.timer(
+                    "db_query_seconds",
+                    client=self.name,
+                    table="stage_scraping_products",
+                    strategy=self.strategy,
+                ):
+                    self._write_rows(
+                        cursor, "stage_scraping_products", SCRAPING_PRODUCT_COLUMNS, data_to_insert
+                    )
+                    conn.commit()
+                METRICS.increment(
+                    "db_rows_total",
+                    len(data_to_insert),
+                    client=self.name,
+                    table="stage_scraping_products",
+                )
+
+                self.logger.debug("%d products inserted correctly", len(scraping_products_list))
+                return True
+
+            except psycopg2.Error as error:
+                self.logger.error("Error inserting products: %s", error)
+                if not conn.closed:
+                    conn.rollback()
+                return False
+
+            finally:
+                cursor.close()
 
     def _insert_product_discounts(self, discounts_list):
         """Insert product discounts into the database"""
-        conn = self._connect_db()
-
-        if conn is None:
-            return False
+        with self._connection() as conn:
+            if conn is None:
+                return False
 
-        try:
-            cursor = conn.cursor()
-
-            query = """
-            INSERT INTO stage_discounts (
-                product_id, type, discounted_price, conditions_text,
-                conditions_min_quantity, conditions_buy_quantity, conditions_get_quantity
-            ) VALUES (
-                %s, %s, %s, %s, %s, %s, %s
-            )
-            """
+            try:
+                cursor = conn.cursor()
 
-            # Convert ProductDiscount objects to tuples if necessary
-            if discounts_list and isinstance(discounts_list[0], ProductDiscount):
-                data_to_insert = [discount.to_tuple() for discount in discounts_list]
-            else:
-                data_to_insert = discounts_list
+                # Convert ProductDiscount objects to tuples if necessary
+                if discounts_list and isinstance(discounts_list[0], ProductDiscount):
+                    data_to_insert = [discount.to_tuple() for discount in discounts_list]
+                else:
+                    data_to_insert = discounts_list
 
-            cursor.executemany(query, data_to_insert)
-            conn.commit()
+                with METRICS.timer(
+                    "db_query_seconds",
+                    client=self.name,
+                    table="stage_discounts",
+                    strategy=self.strategy,
+                ):
+                    self._write_rows(cursor, "stage_discounts", DISCOUNT_COLUMNS, data_to_insert)
+                    conn.commit()
+                METRICS.increment(
+                    "db_rows_total", len(data_to_insert), client=self.name, table="stage_discounts"
+                )
 
-            self.logger.debug(f"{len(discounts_list)} discounts inserted correctly")
-            return True
+                self.logger.debug("%d discounts inserted correctly", len(discounts_list))
+                return True
 
-        except psycopg2.Error as error:
-            self.logger.error(f"Error inserting discounts: {error}")
-            conn.rollback()
-            return False
+            except psycopg2.Error as error:
+                self.logger.error("Error inserting discounts: %s", error)
+                if not conn.closed:
+                    conn.rollback()
+                return False
 
-        finally:
-            cursor.close()
-            conn.close()
+            finally:
+                cursor.close()
 
     def insert_scraping_products_with_discounts(self, scraping_products_list):
         """Insert products and their discounts into the database"""
-        self.logger.debug(
-            f"Starting insertion of {len(scraping_products_list)} products"
-        )
+        self.logger.debug("Starting insertion of %d products", len(scraping_products_list))
 
         # Insert products first
         success = self._insert_scraping_products(scraping_products_list)
@@ -137,23 +258,75 @@ class DatabaseClient:
 
         # Insert discounts if there are any
         if all_discounts:
-            self.logger.debug(f"Inserting {len(all_discounts)} discounts")
+            self.logger.debug("Inserting %d discounts", len(all_discounts))
             return self._insert_product_discounts(all_discounts)
 
         self.logger.debug("No discounts to insert")
         return True
 
+    def delete_scraping_products(
+        self, market: str, category: str, extraction_date, extraction_urls: Optional[list] = None
+    ) -> bool:
+        """
+        Delete the staged products (and their discounts) of a category in a run,
+        only the ones scraped from extraction_urls if given. A retried work queue
+        unit calls it first, so the pages of the failed attempt are not staged twice.
+        """
+        with self._connection() as conn:
+            if conn is None:
+                return False
+
+            condition = "market = %s AND category = %s AND extraction_date = %s"
+            params = [market, category, extraction_date]
+            if extraction_urls is not None:
+                condition += " AND extraction_url = ANY(%s)"
+                params.append(list(extraction_urls))
+
+            try:
+                cursor = conn.cursor()
+                with METRICS.timer(
+                    "db_query_seconds", client=self.name, table="stage_scraping_products", strategy="delete"
+                ):
+                    cursor.execute(
+                        f"""
+                        DELETE FROM stage_discounts WHERE product_id IN (
+                            SELECT id FROM stage_scraping_products WHERE {condition}
+                        )
+                        """,
+                        params,
+                    )
+                    cursor.execute(f"DELETE FROM stage_scraping_products WHERE {condition}", params)
+                    conn.commit()
+
+                self.logger.info(
+                    "%d staged products of category '%s' deleted before the retry", cursor.rowcount, category
+                )
+                return True
+
+            except psycopg2.Error as error:
+                self.logger.error("Error deleting the staged products of category '%s': %s", category, error)
+                if not conn.closed:
+                    conn.rollback()
+                return False
+
+            finally:
+                cursor.close()
+
     def insert_scraping_products_with_discounts_async(self, scraping_products_list, name, callback=None):
         """Insert products and their discounts into the database asynchronously"""
         def _insert_worker():
             try:
-                self.logger.debug(f"Starting async insertion of {len(scraping_products_list)} products for '{name}'")
+                self.logger.debug(
+                    "Starting async insertion of %d products for '%s'",
+                    len(scraping_products_list),
+                    name,
+                )
                 result = self.insert_scraping_products_with_discounts(scraping_products_list)
                 if callback:
                     callback(result, len(scraping_products_list), name)
                 return result
             except Exception as e:
-                self.logger.error(f"Error in async insertion for '{name}': {e}")
+                self.logger.error("Error in async insertion for '%s': %s", name, e)
                 if callback:
                     callback(False, len(scraping_products_list), name)
                 return False
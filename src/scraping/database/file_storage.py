@@ -1,6 +1,26 @@
 import json
 import os
+import re
+import threading
 from datetime import datetime
+from typing import Optional
+
+
+def _snapshot_filename(market: str, extraction_date, part: Optional[str] = None) -> str:
+    if isinstance(extraction_date, str):
+        try:
+            extraction_date = datetime.fromisoformat(extraction_date)
+        except ValueError:
+            pass
+
+    if isinstance(extraction_date, datetime):
+        extraction_date = extraction_date.replace(microsecond=0).isoformat()
+
+    extraction_date_str = str(extraction_date).replace(":", "-")
+    if part is not None:
+        # Units of the work queue write one file each -> "..._Mercearia_p21"
+        extraction_date_str += "_" + re.sub(r"[^\w-]+", "_", part)
+    return f"data/{market}_products_{extraction_date_str}.json"
 
 
 def save_products_to_file(products, market, extraction_date):
@@ -39,18 +59,7 @@ def save_scraping_products_to_file(
     if not os.path.exists("data"):
         os.makedirs("data")
 
-    # Handle extraction_date formatting
-    if isinstance(extraction_date, str):
-        try:
-            extraction_date = datetime.fromisoformat(extraction_date)
-        except ValueError:
-            pass
-
-    if isinstance(extraction_date, datetime):
-        extraction_date = extraction_date.replace(microsecond=0).isoformat()
-
-    extraction_date_str = str(extraction_date)
-    filename = f"data/{market}_products_{extraction_date_str.replace(':', '-')}.json"
+    filename = _snapshot_filename(market, extraction_date)
 
     products_data = [product.to_dict() for product in scraping_products]
 
@@ -61,3 +70,50 @@ def save_scraping_products_to_file(
     # print(f"Total ScrapingProduct objects saved: {len(scraping_products)}")
 
     return filename
+
+
+class ScrapingProductsFileWriter:
+    """
+    Snapshot file written as the products arrive, instead of keeping them all
+    in memory until the end of the run. The file has the same content as
+    save_scraping_products_to_file, and only gets its final name on close
+    (a run that dies leaves a .partial file). Without products no file is left.
+
+    part: name of a part of the run (a work queue unit), added to the file name
+    """
+
+    def __init__(self, market: str, extraction_date, part: Optional[str] = None):
+        if not os.path.exists("data"):
+            os.makedirs("data")
+
+        self.filename = _snapshot_filename(market, extraction_date, part)
+        self.partial_filename = self.filename + ".partial"
+        self.count = 0
+        self._file = open(self.partial_filename, "w", encoding="utf-8")
+        self._file.write("[")
+        self._lock = threading.Lock()
+
+    def write(self, scraping_products: list):
+        # Same layout as json.dump(products, indent=2): each product indented one level
+        chunk = "".join(
+            ",\n  "
+            + json.dumps(product.to_dict(), ensure_ascii=False, indent=2).replace("\n", "\n  ")
+            for product in scraping_products
+        )
+        with self._lock:
+            if self.count == 0 and chunk:
+                chunk = chunk[1:]
+            self._file.write(chunk)
+            self.count += len(scraping_products)
+
+    def close(self) -> Optional[str]:
+        """Give the file its final name, None if no product was written"""
+        with self._lock:
+            if not self._file.closed:
+                self._file.write("\n]" if self.count else "]")
+                self._file.close()
+                if self.count:
+                    os.replace(self.partial_filename, self.filename)
+                else:
+                    os.remove(self.partial_filename)
+        return self.filename if self.count else None
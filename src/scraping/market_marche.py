@@ -4,15 +4,23 @@ Scraping script for St Marche
 
 import time
 import re
+import threading
 from datetime import datetime
+from functools import partial
+from typing import Dict, List, Optional
 from utils.encoders import encode_text, string_to_decimal
 from utils.http_request import make_request_with_delay
 from utils.html_parser import parse_html
+from utils.deadline import Deadline, current_deadline
 from utils.logger import Logger
+from utils.measures import normalize_measure
+from utils.metrics import METRICS, peak_memory_mb, step_timer
 from utils.encoders import price_to_int
 from database.client import DatabaseClient
+from pipeline import Pipeline, PersistProducts, RetryQueue, Stage
 from database.models.scraping_product import ScrapingProduct
-from database.file_storage import save_scraping_products_to_file
+from database.file_storage import ScrapingProductsFileWriter, save_scraping_products_to_file
+from utils.scheduling import order_largest_first
 
 # TODO:
 # St Marche comments:
@@ -26,6 +34,12 @@ EXECUTION_TIME = datetime.now()
 MARKET = "StMarche"
 LOGGER = Logger(MARKET)
 
+# Failed pages in a row after which the pagination of a category is deferred
+MAX_CONSECUTIVE_FAILURES = 3
+
+# Pages waiting to be parsed and batches waiting to be saved in the streaming mode
+MAX_IN_FLIGHT_PAGES = 10
+
 BASE_URL = "https://marche.com.br"
 
 STORE_ID = 66677604431  # Pavao
@@ -70,7 +84,7 @@ def _extract_max_quantity(product_name: str):
 
 
 def _get_all_categories():
-    LOGGER.info(f"Getting all categories from {BASE_URL + STORE_URL}")
+    LOGGER.info("Getting all categories from %s", BASE_URL + STORE_URL)
 
     response = make_request_with_delay(
         BASE_URL + STORE_URL,
@@ -93,7 +107,7 @@ def _get_all_categories():
             }
         )
 
-    LOGGER.info(f"Total categories found: {len(categories_to_return)}")
+    LOGGER.info("Total categories found: %d", len(categories_to_return))
     return categories_to_return
 
 
@@ -146,6 +160,9 @@ def _extract_product_data(soup_product, link, category_name, category_url_with_p
         if measurement_text:
             quantity = string_to_decimal(measurement_text)
 
+    # Same units as the sizes taken from the names of the other markets (KG -> G)
+    quantity, unit_of_measure = normalize_measure(quantity, unit_of_measure)
+
     return ScrapingProduct(
         name=product_name,
         category=category_name,
@@ -161,83 +178,304 @@ def _extract_product_data(soup_product, link, category_name, category_url_with_p
     )
 
 
-def _get_all_products_for_category(category_name: str, category_url: str):
-    LOGGER.info(f"Getting all products for category {category_name} ({category_url})")
+def _fetch_category_pages(
+    category: dict,
+    retries: Optional[RetryQueue] = None,
+    category_deadline_seconds: Optional[float] = None,
+):
+    """
+    Fetch the pages of the category until one comes without products.
+
+    The category can be limited to a range of pages with "first_page" and
+    "last_page" keys. Failed pages are deferred to the retries and the
+    pagination goes on, after several failures in a row the rest of the
+    category is deferred.
+
+    The product cards are found here (the end of the category is the first page
+    without them) and the parse stage reads their fields. The urls seen in the
+    category go with its pages, so they are released with the last one.
+
+    category_deadline_seconds: time budget of the category, the pagination
+        stops when it expires
+    """
+    category_name, category_url = category["name"], category["url"]
+    first_page, last_page = category.get("first_page", 1), category.get("last_page")
+    LOGGER.info("Getting all products for category %s (%s)", category_name, category_url)
+
+    deadline = Deadline(
+        category_deadline_seconds,
+        parent=current_deadline(),
+        name=f"category '{category_name}'",
+    )
 
-    all_category_products = []
-    processed_product_urls = []
+    seen_product_urls = set()
+    consecutive_failures = 0
+    page = first_page
+    while last_page is None or page <= last_page:
+        if deadline.expired():
+            LOGGER.warning(
+                "Deadline of category '%s' exceeded, stopping at page %d", category_name, page
+            )
+            if retries is not None:
+                retries.abandon(
+                    "fetch",
+                    dict(category, first_page=page, last_page=last_page),
+                    "deadline exceeded",
+                )
+            break
 
-    page = 1
-    while True:
         category_url_with_page = category_url + f"&page={page}"
-        products_on_page = []
 
         LOGGER.debug(
-            f"Processing category '{category_name}' page {page}. url: {category_url_with_page}"
+            "Processing category '%s' page %d. url: %s", category_name, page, category_url_with_page
         )
 
-        response = make_request_with_delay(category_url_with_page, headers=HEADERS)
-        soup = parse_html(response)
+        with deadline.activate(), step_timer(MARKET, category_name, "fetch"):
+            response = make_request_with_delay(category_url_with_page, headers=HEADERS)
+
+        # The deadline expired during the request, the page is reported in the next iteration
+        if response is None and deadline.expired():
+            continue
 
-        soup_product_list = soup.find_all("div", class_="algolia-insights")
+        if response is None:
+            LOGGER.warning(
+                "No response for category '%s' page %d, deferred. url: %s",
+                category_name,
+                page,
+                category_url_with_page,
+                key=f"no-response-{category_name}",
+            )
+            consecutive_failures += 1
+            if retries is None:
+                break
+            if consecutive_failures >= MAX_CONSECUTIVE_FAILURES:
+                # The previous failed pages were already deferred one by one
+                retries.defer(
+                    "fetch",
+                    dict(category, first_page=page, last_page=last_page),
+                    f"{consecutive_failures} failed pages in a row",
+                )
+                break
+            retries.defer("fetch", dict(category, first_page=page, last_page=page), "no response")
+            page += 1
+            continue
+
+        consecutive_failures = 0
+
+        with step_timer(MARKET, category_name, "decode"):
+            soup_product_list = parse_html(response).find_all("div", class_="algolia-insights")
 
         if not soup_product_list:
-            LOGGER.debug(f"No products found on category '{category_name}' page {page}")
+            LOGGER.debug("No products found on category '%s' page %d", category_name, page)
             break
 
-        # products_added_this_page = 0
+        yield {
+            "category": category_name,
+            "page": page,
+            "url": category_url_with_page,
+            "soup_products": soup_product_list,
+            "seen_product_urls": seen_product_urls,
+        }
 
-        for soup_product in soup_product_list:
-            for link in soup_product.find_all("a", href=True):
-                product_url = link["href"]
+        page += 1
 
-                # Check if the product url is already processed (avoid duplicates)
-                if product_url not in processed_product_urls:
-                    LOGGER.debug(f"Processing product URL: {product_url}")
-                    processed_product_urls.append(product_url)
 
-                    product = _extract_product_data(
-                        soup_product, link, category_name, category_url_with_page
-                    )
+def _describe_retry_item(category: dict) -> dict:
+    """Category and pages of an item lost after the retries, for the report"""
+    return {
+        "category": category["name"],
+        "first_page": category.get("first_page", 1),
+        "last_page": category.get("last_page"),
+    }
 
-                    products_on_page.append(product)
 
-                    # products_added_this_page += 1
+class _PageParser:
+    """Parse stage: extracts the products of a page, skipping the urls already seen in the category"""
 
-        # # Stopping the loop if no product was added in the URL list
-        # if products_added_this_page == 0:
-        #     LOGGER.info(f"No new URL found on page {page}. Stopping the loop.")
-        #     break
+    def __init__(self):
+        self._lock = threading.Lock()
 
-        all_category_products.extend(products_on_page)
+    def __call__(self, page: dict):
+        category_name = page["category"]
+        processed_product_urls = page["seen_product_urls"]
+
+        start_time = time.perf_counter()
+        products_on_page = []
+        # Reading the fields of the card and building the ScrapingProduct
+        model_seconds = 0.0
+        for soup_product in page["soup_products"]:
+            for link in soup_product.find_all("a", href=True):
+                product_url = link["href"]
+
+                # Check if the product url is already processed (avoid duplicates)
+                with self._lock:
+                    if product_url in processed_product_urls:
+                        continue
+                    processed_product_urls.add(product_url)
+
+                LOGGER.debug("Processing product URL: %s", product_url)
+                model_start_time = time.perf_counter()
+                product = _extract_product_data(
+                    soup_product, link, category_name, page["url"]
+                )
+                model_seconds += time.perf_counter() - model_start_time
+
+                products_on_page.append(product)
+
+        parse_seconds = time.perf_counter() - start_time - model_seconds
+        for step, seconds in (("parse", parse_seconds), ("model", model_seconds)):
+            METRICS.observe(
+                "scraper_step_seconds",
+                seconds,
+                max(len(products_on_page), 1),
+                market=MARKET,
+                category=category_name,
+                step=step,
+            )
 
         LOGGER.info(
-            f"Category '{category_name}' page {page} - {len(products_on_page)} products found."
-            f" Total: {len(all_category_products)}"
+            "Category '%s' page %d - %d products found.",
+            category_name,
+            page["page"],
+            len(products_on_page),
         )
 
-        page += 1
-
-    return all_category_products
+        yield {"category": category_name, "products": products_on_page}
 
 
 def _insertion_callback(success, product_count, name):
     if success:
-        LOGGER.info(
-            f"Successfully inserted {product_count} products for category '{name}'"
-        )
+        LOGGER.info("Successfully inserted %d products for category '%s'", product_count, name)
     else:
-        LOGGER.error(f"Failed to insert {product_count} products for category '{name}'")
+        LOGGER.error("Failed to insert %d products for category '%s'", product_count, name)
 
 
-if __name__ == "__main__":
-    LOGGER.info(f"Starting {MARKET} scraper")
+def list_categories() -> List[dict]:
+    """Categories of the market, the work queue coordinator enqueues them as units"""
+    return _get_all_categories()
+
+
+def run_unit(
+    category: dict,
+    first_page: int = 1,
+    last_page: Optional[int] = None,
+    pages_per_unit: Optional[int] = None,
+    extraction_date: Optional[str] = None,
+    attempt: int = 1,
+) -> dict:
+    """Scrape a range of pages of a category, a unit of the work queue
+
+    The number of pages of a category is only known at the end, so with
+    pages_per_unit the next range is returned in "remaining_ranges" (open ended)
+    when the last page of this one still had products
+    extraction_date: extraction date shared by all the units of the same run
+    attempt: retries first delete the products staged by the previous attempts
+    """
+    global EXECUTION_TIME
+    if extraction_date:
+        EXECUTION_TIME = datetime.fromisoformat(extraction_date)
+
+    split = last_page is None and pages_per_unit is not None
+    if split:
+        last_page = first_page + pages_per_unit - 1
+
+    db_client = DatabaseClient(MARKET)
+    if attempt > 1:
+        # Without last page the unit is the whole category
+        page_urls = None
+        if last_page is not None:
+            page_urls = [
+                category["url"] + f"&page={page}" for page in range(first_page, last_page + 1)
+            ]
+        if not db_client.delete_scraping_products(
+            MARKET, category["name"], EXECUTION_TIME, page_urls
+        ):
+            raise RuntimeError("Could not delete the products of the previous attempt")
+
+    # One snapshot file per unit, written as the pages are parsed (the products are not kept)
+    snapshot = ScrapingProductsFileWriter(
+        MARKET, EXECUTION_TIME.isoformat(), part=f"{category['name']}_p{first_page}"
+    )
+    persist = PersistProducts(db_client, _insertion_callback, market=MARKET, snapshot=snapshot)
+    retries = RetryQueue()
+    fetched_pages = []
+
+    def fetch_category_pages(category):
+        for page in _fetch_category_pages(category, retries):
+            fetched_pages.append(page["page"])
+            yield page
+
+    pipeline = Pipeline(
+        [
+            Stage("fetch", fetch_category_pages),
+            Stage("parse", _PageParser(), workers=1),
+            Stage("persist", persist, workers=1),
+        ],
+        name=f"{MARKET}-{category['name']}",
+    )
+    # One connection for all the pages of the unit
+    with db_client.keep_connection():
+        pipeline_report = pipeline.run(
+            [dict(category, first_page=first_page, last_page=last_page)]
+        )
+        retries_report = retries.drain(pipeline, _describe_retry_item)
+
+    with step_timer(MARKET, category["name"], "file_write"):
+        snapshot_filename = snapshot.close()
+
+    remaining_ranges = []
+    if split and fetched_pages and max(fetched_pages) == last_page:
+        remaining_ranges = [(last_page + 1, None)]
+
+    return {
+        "market": MARKET,
+        "category": category["name"],
+        "first_page": first_page,
+        "last_page": max(fetched_pages, default=None),
+        "products": persist.product_count,
+        "snapshot": snapshot_filename,
+        "remaining_ranges": remaining_ranges,
+        "lost_pages": retries_report["lost"],
+        "stages": pipeline_report["stages"],
+    }
+
+
+def run(
+    category_workers: int = 1,
+    category_sizes: Optional[Dict[str, int]] = None,
+    retry_budget: int = 200,
+    deadline_seconds: Optional[float] = None,
+    category_deadline_seconds: Optional[float] = None,
+    streaming: bool = False,
+    max_in_flight_pages: int = MAX_IN_FLIGHT_PAGES,
+) -> dict:
+    """Scrape every category and return the run report
+
+    category_workers: number of categories scraped at the same time
+    category_sizes: products per category in the last run, the largest ones start first
+    retry_budget: maximum number of failed pages retried at the end of the run
+    deadline_seconds / category_deadline_seconds: time budget of the market and
+        of each category. Once expired the pending requests are cancelled and
+        what was collected is saved
+    streaming: the products of each page go to the snapshot file and the
+        database once parsed, instead of being kept until the end of the run.
+        At most max_in_flight_pages pages (and product batches) wait between
+        the stages, so the memory doesn't grow with the size of the catalog
+    """
+    LOGGER.info("Starting %s scraper", MARKET)
     start_time = time.time()
 
     db_client = DatabaseClient(MARKET)
-    active_threads = []
+    snapshot = (
+        ScrapingProductsFileWriter(MARKET, EXECUTION_TIME.isoformat()) if streaming else None
+    )
+    persist = PersistProducts(db_client, _insertion_callback, market=MARKET, snapshot=snapshot)
+    # The default queues hold up to 100 pages (their whole html) per stage
+    in_flight = {"queue_size": max_in_flight_pages} if streaming else {}
+    retries = RetryQueue(budget=retry_budget)
+    deadline = Deadline(deadline_seconds, name=MARKET)
 
-    categories = _get_all_categories()
+    categories = order_largest_first(_get_all_categories(), category_sizes)
 
     # TESTING
     # categories = [
@@ -247,35 +485,75 @@ if __name__ == "__main__":
     #     }
     # ]
 
-    total_categories = len(categories)
-    all_products = []
-    for idx, category in enumerate(categories, 1):
-        category_products = _get_all_products_for_category(
-            category["name"], category["url"]
-        )
-
+    pipeline = Pipeline(
+        [
+            Stage(
+                "fetch",
+                partial(
+                    _fetch_category_pages,
+                    retries=retries,
+                    category_deadline_seconds=category_deadline_seconds,
+                ),
+                workers=category_workers,
+                cancellable=True,
+            ),
+            Stage("parse", _PageParser(), workers=1, **in_flight),
+            Stage("persist", persist, workers=1, **in_flight),
+        ],
+        name=MARKET,
+        deadline=deadline,
+    )
+    # One connection for all the pages of the run
+    with db_client.keep_connection():
+        pipeline_report = pipeline.run(categories)
+        retries_report = retries.drain(pipeline, _describe_retry_item)
+
+    categories_report = []
+    for category in categories:
+        products_found = persist.category_counts.get(category["name"], 0)
         LOGGER.info(
-            f"Finished processing category '{category["name"]}' {len(category_products)} products found"
-            f" -> progress: {(idx/total_categories)*100:.1f}% [{idx:02d}/{total_categories:02d}]"
+            "Finished processing category '%s' %d products found", category["name"], products_found
         )
-
-        if len(category_products) > 0:
-            thread = db_client.insert_scraping_products_with_discounts_async(
-                category_products, category["name"], _insertion_callback
+        categories_report.append({"name": category["name"], "products": products_found})
+
+    with step_timer(MARKET, None, "file_write"):
+        if snapshot is not None:
+            snapshot.close()
+        elif persist.products:
+            save_scraping_products_to_file(
+                persist.products, MARKET, EXECUTION_TIME.isoformat()
             )
-            active_threads.append(thread)
-            all_products.extend(category_products)
-
-    save_scraping_products_to_file(
-        all_products, MARKET, EXECUTION_TIME.isoformat()
-    )
-
-    # wait for all database insertions to complete
-    LOGGER.info("Waiting for all database insertions to complete...")
-    for thread in active_threads:
-        thread.join()
 
     end_time = time.time()
     total_time_seconds = end_time - start_time
     total_time_minutes = total_time_seconds / 60
-    LOGGER.info(f"{MARKET} scraper finished in {total_time_minutes:.2f} minutes")
+    peak_memory = peak_memory_mb()
+    LOGGER.info(
+        "%s scraper finished in %.2f minutes, peak memory %s MB",
+        MARKET,
+        total_time_minutes,
+        peak_memory,
+    )
+
+    return {
+        "market": MARKET,
+        "extraction_date": EXECUTION_TIME.isoformat(),
+        "seconds": round(total_time_seconds, 2),
+        "products": persist.product_count,
+        "deadline_exceeded": deadline.expired(),
+        "categories": categories_report,
+        "stages": pipeline_report["stages"],
+        "retries": retries_report,
+        # Seconds spent in each step (fetch, decode, parse, model, file_write, db_insert)
+        "steps": METRICS.totals("scraper_step_seconds", by="step", market=MARKET),
+        "memory": {
+            "streaming": streaming,
+            "max_in_flight_pages": max_in_flight_pages if streaming else None,
+            # Peak of the process, the market runs in its own process in the orchestrator
+            "peak_mb": peak_memory,
+        },
+    }
+
+
+if __name__ == "__main__":
+    run()
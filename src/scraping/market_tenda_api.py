@@ -1,18 +1,25 @@
 """
 Scraping script for Tenda
 """
-from datetime import datetime
-from typing import List
+from contextlib import nullcontext
+from datetime import datetime, timedelta
+from functools import partial
+from typing import Dict, List, Optional
 import time
 from utils.http_request import make_request_with_delay
 from utils.logger import Logger
 from utils.encoders import price_to_int
-from database.file_storage import save_scraping_products_to_file
+from utils.deadline import Deadline, current_deadline
+from utils.fingerprints import CategoryFingerprints, build_fingerprint
+from utils.measures import extract_measure
+from utils.metrics import METRICS, step_timer
+from utils.scheduling import order_largest_first
+from database.file_storage import ScrapingProductsFileWriter, save_scraping_products_to_file
 from database.models.scraping_product import ScrapingProduct
 from database.client import DatabaseClient
+from pipeline import Pipeline, PersistProducts, RetryQueue, Stage
 
 # TODO:
-# - obtener la cantidad y la unidad de medida de los productos
 # - automatizar el proceso de obtener el token
 
 EXECUTION_TIME = datetime.now()
@@ -27,6 +34,9 @@ HEADERS = {
     "X-Authorization": f"Bearer {BEARER_TOKEN}",
 }
 
+# Fingerprints of the categories for the incremental mode
+FINGERPRINTS_FILE = "data/tenda_fingerprints.json"
+
 LOGGER = Logger(MARKET)
 
 
@@ -41,13 +51,20 @@ def _log_progress(current: int, total: int, category_name: str, page: int, url:
     width = len(str(total))
 
     LOGGER.info(
-        f"[{current:0{width}d}/{total:0{width}d}] ({percentage:.1f}%) "
-        f"Processing category '{category_name}' page {page}. url: {url}"
+        "[%0*d/%0*d] (%.1f%%) Processing category '%s' page %d. url: %s",
+        width,
+        current,
+        width,
+        total,
+        percentage,
+        category_name,
+        page,
+        url,
     )
 
 
 def _get_all_categories():
-    LOGGER.info(f"Getting all categories from {URL_CATEGORIES}")
+    LOGGER.info("Getting all categories from %s", URL_CATEGORIES)
 
     response = make_request_with_delay(
         URL_CATEGORIES,
@@ -64,99 +81,226 @@ def _get_all_categories():
             }
         )
 
-    LOGGER.info(f"Total categories found: {len(categories_to_return)}")
+    LOGGER.info("Total categories found: %d", len(categories_to_return))
     return categories_to_return
 
 
-def _process_additional_pages(
-    category_id: int, category_name: str, number_of_pages: int
-):
-    category_products_from_additional_pages = []
-
-    for page in range(2, number_of_pages + 1):
-        category_url = _build_tenda_api_url(category_id, page)
-
-        _log_progress(page, number_of_pages, category_name, page, category_url)
-
-        response = make_request_with_delay(category_url, headers=HEADERS)
-
-        if response is None or response.status_code != 200:
-            LOGGER.info(
-                f"No response for category '{category_name}' page {page}. url: {category_url}"
+def _category_fingerprint(response_json: dict) -> str:
+    """Fingerprint of the category: number of products + ids and prices of the first page"""
+    return build_fingerprint(
+        response_json.get("total_products"),
+        (
+            (
+                str(product.get("id")),
+                str(product.get("price")),
+                str(
+                    [
+                        (wholesale.get("minQuantity"), wholesale.get("price"))
+                        for wholesale in product.get("wholesalePrices") or []
+                    ]
+                ),
             )
-            continue
-
-        category_products_from_additional_pages.extend(
-            _parse_tenda_search_products(response.json(), category_url, category_name)
-        )
-
-    return category_products_from_additional_pages
+            for product in response_json.get("products", [])
+        ),
+    )
 
 
-def get_all_products_for_category(category_id: int, category_name: str):
-    category_url = _build_tenda_api_url(category_id)
-    LOGGER.debug(f"Getting all products for category {category_name} ({category_url})")
+def _discover_category_pages(
+    category: dict,
+    fingerprints: Optional[CategoryFingerprints] = None,
+    first_page: int = 1,
+    last_page: Optional[int] = None,
+    retries: Optional[RetryQueue] = None,
+    category_deadline_seconds: Optional[float] = None,
+):
+    """
+    Fetch the first page of the range and yield every page of the range
+    (first_page to last_page, or to the last page of the category).
+
+    With fingerprints (incremental mode) only the first page is yielded when the
+    category didn't change since its last complete crawl. If the first page
+    fails the category is deferred to the retries.
+
+    category_deadline_seconds: time budget of the category, the pages carry
+        the deadline to the fetch stage
+    """
+    category_url = _build_tenda_api_url(category["id"], first_page)
+    LOGGER.debug("Getting all products for category %s (%s)", category["name"], category_url)
+
+    deadline = Deadline(
+        category_deadline_seconds,
+        parent=current_deadline(),
+        name=f"category '{category['name']}'",
+    )
 
     # Get products from the first page
-    response = make_request_with_delay(category_url, headers=HEADERS)
-    response_json = response.json()
+    with deadline.activate():
+        response_json, error = _get_json(category_url, category["name"])
+    if response_json is None and deadline.expired():
+        LOGGER.warning(
+            "Deadline of category '%s' exceeded before its first page", category["name"]
+        )
+        if retries is not None:
+            retries.abandon("discover", category, "deadline exceeded")
+        return
+    if response_json is None:
+        LOGGER.warning(
+            "No response for category '%s' page %d (%s), deferred. url: %s",
+            category["name"],
+            first_page,
+            error,
+            category_url,
+        )
+        if retries is not None:
+            retries.defer("discover", category, error)
+        return
 
     number_of_pages = response_json.get("total_pages")
     number_of_products = response_json.get("total_products")
 
     if number_of_products == 0:
-        LOGGER.warning(
-            f"0 products found for category '{category_name}' -> {category_url}"
+        LOGGER.warning("0 products found for category '%s' -> %s", category["name"], category_url)
+        return
+
+    _log_progress(first_page, number_of_pages, category["name"], first_page, category_url)
+
+    first_page_data = {
+        "category": category,
+        "page": first_page,
+        "url": category_url,
+        "total_pages": number_of_pages,
+        "total_products": number_of_products,
+        "json": response_json,
+        "deadline": deadline,
+    }
+
+    if fingerprints is not None and first_page == 1:
+        fingerprint = _category_fingerprint(response_json)
+        crawl, reason = fingerprints.should_crawl(category["name"], fingerprint)
+        first_page_data.update(fingerprint=fingerprint, crawl_reason=reason)
+
+        if not crawl:
+            LOGGER.info(
+                "Category '%s' unchanged since the last full refresh, skipping %d pages",
+                category["name"],
+                number_of_pages - 1,
+            )
+            first_page_data["skipped"] = True
+            yield first_page_data
+            return
+
+    yield first_page_data
+
+    # The additional pages are fetched by the next stage
+    if last_page is None or last_page > number_of_pages:
+        last_page = number_of_pages
+    for page in range(first_page + 1, last_page + 1):
+        yield {
+            "category": category,
+            "page": page,
+            "url": _build_tenda_api_url(category["id"], page),
+            "total_pages": number_of_pages,
+            "deadline": deadline,
+        }
+
+
+def _get_json(url: str, category_name: Optional[str] = None):
+    """Return (json, None) or (None, reason of the failure)"""
+    with step_timer(MARKET, category_name, "fetch"):
+        response = make_request_with_delay(url, headers=HEADERS)
+    if response is None:
+        return None, "no response"
+    if response.status_code != 200:
+        return None, f"status {response.status_code}"
+    try:
+        with step_timer(MARKET, category_name, "decode"):
+            return response.json(), None
+    except ValueError:
+        return None, "invalid json"
+
+
+def _fetch_page(page: dict, retries: Optional[RetryQueue] = None):
+    if "json" not in page:
+        deadline = page.get("deadline")
+        if deadline is not None and deadline.expired():
+            LOGGER.warning(
+                "Deadline of category '%s' exceeded, page %d skipped",
+                page["category"]["name"],
+                page["page"],
+                key=f"deadline-{page['category']['name']}",
+            )
+            if retries is not None:
+                retries.abandon("fetch", page, "deadline exceeded")
+            return
+
+        _log_progress(
+            page["page"], page["total_pages"], page["category"]["name"], page["page"], page["url"]
         )
-        return []
 
-    all_category_products = []
-    all_category_products.extend(
-        _parse_tenda_search_products(response_json, category_url, category_name)
-    )
+        with deadline.activate() if deadline is not None else nullcontext():
+            response_json, error = _get_json(page["url"], page["category"]["name"])
+        if response_json is None:
+            # The crawl keeps going, the page is retried at the end of the run
+            LOGGER.warning(
+                "No response for category '%s' page %d (%s), deferred. url: %s",
+                page["category"]["name"],
+                page["page"],
+                error,
+                page["url"],
+                key=f"no-response-{page['category']['name']}",
+            )
+            if retries is not None:
+                retries.defer("fetch", page, error)
+            return
 
-    _log_progress(1, number_of_pages, category_name, 1, category_url)
+        page["json"] = response_json
 
-    # Get products from the additional pages
-    if number_of_pages > 1:
-        all_category_products.extend(
-            _process_additional_pages(category_id, category_name, number_of_pages)
-        )
+    yield page
 
-    if len(all_category_products) != number_of_products:
-        LOGGER.warning(
-            f"Number of products found for category '{category_name}' "
-            f"is different from the number of products in the response. "
-            f"actual: {len(all_category_products)} != expected: {number_of_products}"
-        )
-    else:
-        LOGGER.info(
-            f"Finished scraping category '{category_name}' - {len(all_category_products)}/{number_of_products} products retrieved"
-        )
 
-    return all_category_products
+def _describe_retry_item(item: dict) -> dict:
+    """Category and page of an item lost after the retries, for the report"""
+    if "page" in item:
+        return {"category": item["category"]["name"], "page": item["page"], "url": item["url"]}
+    return {"category": item["name"], "page": None, "url": _build_tenda_api_url(item["id"])}
+
+
+def _parse_page(page: dict):
+    yield {
+        "category": page["category"]["name"],
+        "products": _parse_tenda_search_products(
+            page["json"], page["url"], page["category"]["name"]
+        ),
+    }
 
 
 def _parse_tenda_search_products(
     search_response: dict, extraction_url: str, category_name: str
 ) -> List[ScrapingProduct]:
     normalized_products: List[ScrapingProduct] = []
+    # Measured per product but recorded once per page
+    parse_seconds = model_seconds = 0.0
 
     for product_item in search_response.get("products", []):
+        start_time = time.perf_counter()
+        # The API doesn't return the size, it is taken from the product name
+        measure = extract_measure(product_item.get("name"))
+        price = price_to_int(product_item.get("price"))
+        parsed_time = time.perf_counter()
+
         scraping_product = ScrapingProduct(
             name=product_item.get("name"),
             category=category_name,
             market=MARKET,
-            price=price_to_int(product_item.get("price")),
+            price=price,
             source_id=(
                 str(product_item.get("id"))
                 if product_item.get("id") is not None
                 else None
             ),
             brand=product_item.get("brand"),
-            # TODO: get the quantity and unit of measure
-            # quantity=1,
-            # unit_of_measure="UNIT",
+            quantity=measure.total_quantity if measure else None,
+            unit_of_measure=measure.unit if measure else None,
             product_url=product_item.get("url"),
             extraction_url=extraction_url,
             extraction_date=EXECUTION_TIME,
@@ -176,60 +320,273 @@ def _parse_tenda_search_products(
                 )
 
         normalized_products.append(scraping_product)
-
+        end_time = time.perf_counter()
+        parse_seconds += parsed_time - start_time
+        model_seconds += end_time - parsed_time
+
+    if normalized_products:
+        for step, seconds in (("parse", parse_seconds), ("model", model_seconds)):
+            METRICS.observe(
+                "scraper_step_seconds",
+                seconds,
+                len(normalized_products),
+                market=MARKET,
+                category=category_name,
+                step=step,
+            )
     return normalized_products
 
 
 def _insertion_callback(success, product_count, name):
     if success:
-        LOGGER.info(
-            f"Successfully inserted {product_count} products for category '{name}'"
-        )
+        LOGGER.info("Successfully inserted %d products for category '%s'", product_count, name)
     else:
-        LOGGER.error(f"Failed to insert {product_count} products for category '{name}'")
+        LOGGER.error("Failed to insert %d products for category '%s'", product_count, name)
+
+
+def list_categories() -> List[dict]:
+    """Categories of the market, the work queue coordinator enqueues them as units"""
+    return _get_all_categories()
+
+
+def run_unit(
+    category: dict,
+    first_page: int = 1,
+    last_page: Optional[int] = None,
+    pages_per_unit: Optional[int] = None,
+    extraction_date: Optional[str] = None,
+    fetch_workers: int = 8,
+    attempt: int = 1,
+) -> dict:
+    """Scrape a range of pages of a category, a unit of the work queue
+
+    last_page: None scrapes until the last page of the category. With pages_per_unit
+        only that many pages are scraped, and the rest of the category is returned
+        in "remaining_ranges" to be enqueued as new units
+    extraction_date: extraction date shared by all the units of the same run
+    attempt: retries first delete the products staged by the previous attempts
+    """
+    global EXECUTION_TIME
+    if extraction_date:
+        EXECUTION_TIME = datetime.fromisoformat(extraction_date)
+
+    split = last_page is None and pages_per_unit is not None
+    if split:
+        last_page = first_page + pages_per_unit - 1
 
-
-if __name__ == "__main__":
+    db_client = DatabaseClient(MARKET)
+    if attempt > 1:
+        # Without last page the unit is the whole category
+        page_urls = None
+        if last_page is not None:
+            page_urls = [
+                _build_tenda_api_url(category["id"], page) for page in range(first_page, last_page + 1)
+            ]
+        if not db_client.delete_scraping_products(
+            MARKET, category["name"], EXECUTION_TIME, page_urls
+        ):
+            raise RuntimeError("Could not delete the products of the previous attempt")
+
+    # One snapshot file per unit, written as the pages are parsed (the products are not kept)
+    snapshot = ScrapingProductsFileWriter(
+        MARKET, EXECUTION_TIME.isoformat(), part=f"{category['name']}_p{first_page}"
+    )
+    persist = PersistProducts(db_client, _insertion_callback, market=MARKET, snapshot=snapshot)
+    retries = RetryQueue()
+    first_pages = []
+
+    def discover_category_pages(category):
+        for page in _discover_category_pages(
+            category, first_page=first_page, last_page=last_page, retries=retries
+        ):
+            if "total_pages" in page and "json" in page:
+                first_pages.append(page)
+            yield page
+
+    pipeline = Pipeline(
+        [
+            Stage("discover", discover_category_pages),
+            Stage("fetch", partial(_fetch_page, retries=retries), workers=fetch_workers),
+            Stage("parse", _parse_page, workers=1),
+            Stage("persist", persist, workers=1),
+        ],
+        name=f"{MARKET}-{category['name']}",
+    )
+    # One connection for all the pages of the unit
+    with db_client.keep_connection():
+        pipeline_report = pipeline.run([category])
+        retries_report = retries.drain(pipeline, _describe_retry_item)
+
+    with step_timer(MARKET, category["name"], "file_write"):
+        snapshot_filename = snapshot.close()
+
+    total_pages = first_pages[0]["total_pages"] if first_pages else None
+    remaining_ranges = []
+    if split and total_pages and last_page < total_pages:
+        remaining_ranges = [
+            (start, min(start + pages_per_unit - 1, total_pages))
+            for start in range(last_page + 1, total_pages + 1, pages_per_unit)
+        ]
+
+    return {
+        "market": MARKET,
+        "category": category["name"],
+        "first_page": first_page,
+        "last_page": min(last_page, total_pages) if last_page and total_pages else total_pages,
+        "products": persist.product_count,
+        "snapshot": snapshot_filename,
+        "remaining_ranges": remaining_ranges,
+        "lost_pages": retries_report["lost"],
+        "stages": pipeline_report["stages"],
+    }
+
+
+def run(
+    category_workers: int = 1,
+    category_sizes: Optional[Dict[str, int]] = None,
+    fetch_workers: int = 8,
+    incremental: bool = False,
+    full_refresh_hours: float = 24,
+    sample_rate: float = 0.1,
+    retry_budget: int = 200,
+    deadline_seconds: Optional[float] = None,
+    category_deadline_seconds: Optional[float] = None,
+) -> dict:
+    """Scrape every category and return the run report
+
+    category_workers: number of categories scraped at the same time
+    fetch_workers: number of pages fetched at the same time, at most the concurrency
+        limit of the host
+    category_sizes: products per category in the last run, the largest ones start first
+    incremental: only the first page of the categories whose fingerprint didn't
+        change is scraped, until their last complete crawl is older than
+        full_refresh_hours. sample_rate of the unchanged categories are crawled anyway
+    retry_budget: maximum number of failed pages retried at the end of the run
+    deadline_seconds / category_deadline_seconds: time budget of the market and
+        of each category. Once expired the pending requests are cancelled and
+        what was collected is saved
+    """
     start_time = time.time()
     LOGGER.info("Starting Tenda API scraper")
 
     db_client = DatabaseClient(MARKET)
-    active_threads = []
+    persist = PersistProducts(db_client, _insertion_callback, market=MARKET)
+    retries = RetryQueue(budget=retry_budget)
+    deadline = Deadline(deadline_seconds, name=MARKET)
+    crawled_categories = {}
+
+    fingerprints = None
+    if incremental:
+        fingerprints = CategoryFingerprints(
+            FINGERPRINTS_FILE,
+            full_refresh_interval=timedelta(hours=full_refresh_hours),
+            sample_rate=sample_rate,
+        )
 
-    categories = _get_all_categories()
+    categories = order_largest_first(_get_all_categories(), category_sizes)
 
     # TESTING
     # categories = [{"id": 3412, "name": "Mercearia"}]
 
-    total_categories = len(categories)
-    for idx, category in enumerate(categories, 1):
-        LOGGER.info(
-            f"Processing category '{category["name"]}' (ID: {category["id"]})"
-            f" -> progress: [{idx:02d}/{total_categories:02d}] ({(idx/total_categories)*100:.1f}%) "
-        )
-
-        category_products = get_all_products_for_category(
-            category["id"], category["name"]
-        )
+    def discover_category_pages(category):
+        for page in _discover_category_pages(
+            category,
+            fingerprints,
+            retries=retries,
+            category_deadline_seconds=category_deadline_seconds,
+        ):
+            if "total_products" in page:
+                crawled_categories[category["name"]] = page
+            yield page
+
+    pipeline = Pipeline(
+        [
+            Stage(
+                "discover", discover_category_pages, workers=category_workers, cancellable=True
+            ),
+            Stage(
+                "fetch",
+                partial(_fetch_page, retries=retries),
+                workers=fetch_workers,
+                cancellable=True,
+            ),
+            Stage("parse", _parse_page, workers=1),
+            Stage("persist", persist, workers=1),
+        ],
+        name=MARKET,
+        deadline=deadline,
+    )
+    # One connection for all the pages of the run
+    with db_client.keep_connection():
+        pipeline_report = pipeline.run(categories)
+        retries_report = retries.drain(pipeline, _describe_retry_item)
+
+    categories_report = []
+    for category_name, first_page in crawled_categories.items():
+        products_found = persist.category_counts.get(category_name, 0)
+        number_of_products = first_page["total_products"]
+        category_report = {"name": category_name, "products": products_found}
+        if fingerprints is not None:
+            category_report["crawl"] = first_page["crawl_reason"]
+
+        if first_page.get("skipped"):
+            # Only the first page was scraped, the category size of the last run is kept
+            category_report["products"] = number_of_products
+            categories_report.append(category_report)
+            continue
 
-        if len(category_products) > 0:
-            LOGGER.info(
-                f"Starting async insertion of {len(category_products)} products for category '{category['name']}'"
+        if products_found != number_of_products:
+            LOGGER.warning(
+                "Number of products found for category '%s' "
+                "is different from the number of products in the response. "
+                "actual: %d != expected: %d",
+                category_name,
+                products_found,
+                number_of_products,
             )
-            thread = db_client.insert_scraping_products_with_discounts_async(
-                category_products, category["name"], _insertion_callback
+        else:
+            LOGGER.info(
+                "Finished scraping category '%s' - %d/%d products retrieved",
+                category_name,
+                products_found,
+                number_of_products,
             )
-            active_threads.append(thread)
+            # Only complete crawls become the reference of the next runs
+            if fingerprints is not None:
+                fingerprints.record(category_name, first_page["fingerprint"])
+        categories_report.append(category_report)
+
+    if fingerprints is not None:
+        fingerprints.save()
+        skipped = sum(1 for page in crawled_categories.values() if page.get("skipped"))
+        LOGGER.info(
+            "Incremental mode: %d/%d categories skipped", skipped, len(crawled_categories)
+        )
+
+    if persist.products:
+        with step_timer(MARKET, None, "file_write"):
             save_scraping_products_to_file(
-                category_products, MARKET, EXECUTION_TIME.isoformat()
+                persist.products, MARKET, EXECUTION_TIME.isoformat()
             )
 
-    # wait for all database insertions to complete
-    LOGGER.info("Waiting for all database insertions to complete...")
-    for thread in active_threads:
-        thread.join()
-
     end_time = time.time()
     total_time_seconds = end_time - start_time
     total_time_minutes = total_time_seconds / 60
-    LOGGER.info(f"Tenda API scraper finished in {total_time_minutes:.2f} minutes")
+    LOGGER.info("Tenda API scraper finished in %.2f minutes", total_time_minutes)
+
+    return {
+        "market": MARKET,
+        "extraction_date": EXECUTION_TIME.isoformat(),
+        "seconds": round(total_time_seconds, 2),
+        "products": persist.product_count,
+        "deadline_exceeded": deadline.expired(),
+        "categories": categories_report,
+        "stages": pipeline_report["stages"],
+        "retries": retries_report,
+        # Seconds spent in each step (fetch, decode, parse, model, file_write, db_insert)
+        "steps": METRICS.totals("scraper_step_seconds", by="step", market=MARKET),
+    }
+
+
+if __name__ == "__main__":
+    run()
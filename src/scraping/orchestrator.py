@@ -0,0 +1,288 @@
+"""
+Runs the scrapers of all the markets at the same time (one process per market)
+
+Usage:
+    python orchestrator.py                      # all markets
+    python orchestrator.py --market tenda       # only some markets
+    python orchestrator.py --category-workers 3
+    python orchestrator.py --incremental        # skip the unchanged categories
+    python orchestrator.py --deadline-minutes 120 --category-deadline-minutes 15
+"""
+
+import argparse
+import importlib
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime
+from typing import Optional
+from utils.http_request import (
+    host_concurrency_stats,
+    set_host_concurrency,
+    set_host_rate_limit,
+)
+from utils.logger import Logger
+from utils.metrics import METRICS
+
+LOGGER = Logger("orchestrator")
+
+# Registered markets -> module with a run(category_workers, category_sizes) function
+MARKETS = {
+    "tenda": "market_tenda_api",
+    "stmarche": "market_marche",
+}
+
+# Markets that support the incremental mode (category fingerprints)
+INCREMENTAL_MARKETS = {"tenda"}
+
+# Markets that support the streaming mode (bounded memory)
+STREAMING_MARKETS = {"stmarche"}
+
+# Requests per second allowed to each host
+HOST_RATE_LIMITS = {
+    "api.tendaatacado.com.br": 2.0,
+    "marche.com.br": 1.0,
+}
+
+# Requests in flight allowed to each host, adjusted between 1 and the maximum
+# with the responses of the host (429, Retry-After, errors, latency). The fetch
+# workers of the market must be more than the maximum, or the workers and not the
+# limit cap the requests: Tenda fetches with 8 workers, St Marche with one per
+# category worker (--category-workers 2 or more to reach its maximum)
+HOST_CONCURRENCY = {
+    "api.tendaatacado.com.br": {"initial": 2, "maximum": 4},
+    "marche.com.br": {"initial": 1, "maximum": 2},
+}
+
+# Products per category in the last run, used to start the largest categories first
+CATEGORY_STATS_FILE = "data/category_stats.json"
+
+# Timers and counters of each run (utils/metrics.py), one JSON lines file per run
+METRICS_DIR = "data/metrics"
+
+
+def load_category_stats() -> dict:
+    if not os.path.exists(CATEGORY_STATS_FILE):
+        return {}
+    with open(CATEGORY_STATS_FILE, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def save_category_stats(category_stats: dict, reports: dict):
+    """Store the products per category of the market reports ({market: report})"""
+    for market, report in reports.items():
+        market_stats = category_stats.setdefault(market, {})
+        for category in report.get("categories", []):
+            market_stats[category["name"]] = category["products"]
+
+    os.makedirs(os.path.dirname(CATEGORY_STATS_FILE), exist_ok=True)
+    with open(CATEGORY_STATS_FILE, "w", encoding="utf-8") as f:
+        json.dump(category_stats, f, ensure_ascii=False, indent=2)
+
+
+def configure_hosts():
+    """Rate and concurrency limits of the hosts, for the current process"""
+    for host, requests_per_second in HOST_RATE_LIMITS.items():
+        set_host_rate_limit(host, requests_per_second)
+    for host, options in HOST_CONCURRENCY.items():
+        set_host_concurrency(host, **options)
+
+
+def _run_market(
+    market: str,
+    category_workers: int,
+    category_sizes: dict,
+    options: dict,
+    run_id: str,
+    prometheus_metrics: bool = False,
+) -> dict:
+    """Entry point of each market process"""
+    configure_hosts()
+
+    module = importlib.import_module(MARKETS[market])
+    try:
+        report = module.run(
+            category_workers=category_workers, category_sizes=category_sizes, **options
+        )
+        report["hosts"] = host_concurrency_stats()
+    finally:
+        # Also when the market fails, to see where its time went
+        METRICS.write_jsonl(
+            os.path.join(METRICS_DIR, f"metrics_{run_id}.jsonl"), run=run_id, market=market
+        )
+        if prometheus_metrics:
+            METRICS.write_prometheus(
+                os.path.join(METRICS_DIR, f"metrics_{run_id}_{market}.prom"),
+                run=run_id,
+                market=market,
+            )
+    return report
+
+
+def run(
+    markets: list,
+    category_workers: int = 1,
+    incremental: bool = False,
+    full_refresh_hours: float = 24,
+    deadline_minutes: Optional[float] = None,
+    market_deadline_minutes: Optional[float] = None,
+    category_deadline_minutes: Optional[float] = None,
+    prometheus_metrics: bool = False,
+    streaming: bool = False,
+) -> dict:
+    """
+    Run the markets concurrently and write one consolidated report
+
+    deadline_minutes: time budget of the whole run, market_deadline_minutes and
+        category_deadline_minutes of each market and category. Once expired the
+        markets cancel the pending requests and save what they collected
+    prometheus_metrics: also write the metrics of each market in the Prometheus
+        text format (node_exporter textfile collector)
+    streaming: the markets that support it save the products as each page is
+        parsed, with bounded memory
+    """
+    start_time = time.time()
+    started_at = datetime.now()
+    run_id = started_at.replace(microsecond=0).isoformat().replace(":", "-")
+    category_stats = load_category_stats()
+    reports = {}
+
+    LOGGER.info("Starting orchestrator for markets: %s", ", ".join(markets))
+
+    # All the markets start now, so the run deadline is also a market deadline
+    market_deadlines = [
+        minutes for minutes in (deadline_minutes, market_deadline_minutes) if minutes is not None
+    ]
+    deadline_options = {
+        "deadline_seconds": min(market_deadlines) * 60 if market_deadlines else None,
+        "category_deadline_seconds": (
+            category_deadline_minutes * 60 if category_deadline_minutes is not None else None
+        ),
+    }
+
+    with ProcessPoolExecutor(max_workers=len(markets)) as executor:
+        futures = {
+            executor.submit(
+                _run_market,
+                market,
+                category_workers,
+                category_stats.get(market, {}),
+                {
+                    **deadline_options,
+                    **(
+                        {"incremental": True, "full_refresh_hours": full_refresh_hours}
+                        if incremental and market in INCREMENTAL_MARKETS
+                        else {}
+                    ),
+                    **(
+                        {"streaming": True}
+                        if streaming and market in STREAMING_MARKETS
+                        else {}
+                    ),
+                },
+                run_id,
+                prometheus_metrics,
+            ): market
+            for market in markets
+        }
+        for future in as_completed(futures):
+            market = futures[future]
+            try:
+                report = future.result()
+                LOGGER.info(
+                    "Market '%s' finished: %d products in %.2f minutes",
+                    market,
+                    report["products"],
+                    report["seconds"] / 60,
+                )
+            except Exception as e:
+                LOGGER.error("Market '%s' failed: %s", market, e)
+                report = {"market": market, "error": str(e)}
+            reports[market] = report
+
+    save_category_stats(
+        category_stats,
+        {market: report for market, report in reports.items() if "error" not in report},
+    )
+
+    total_time_seconds = time.time() - start_time
+    run_report = {
+        "started_at": started_at.replace(microsecond=0).isoformat(),
+        "seconds": round(total_time_seconds, 2),
+        "products": sum(report.get("products", 0) for report in reports.values()),
+        # Pages that failed even after the retries of each market
+        "lost_pages": sum(
+            len(report.get("retries", {}).get("lost", [])) for report in reports.values()
+        ),
+        "metrics_file": os.path.join(METRICS_DIR, f"metrics_{run_id}.jsonl"),
+        "markets": list(reports.values()),
+    }
+
+    report_file = f"data/run_report_{run_id}.json"
+    with open(report_file, "w", encoding="utf-8") as f:
+        json.dump(run_report, f, ensure_ascii=False, indent=2)
+
+    LOGGER.info(
+        "Orchestrator finished in %.2f minutes, %d products, %d pages lost. Report: %s",
+        total_time_seconds / 60,
+        run_report["products"],
+        run_report["lost_pages"],
+        report_file,
+    )
+    return run_report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run all the market scrapers")
+    parser.add_argument(
+        "--market", action="append", choices=sorted(MARKETS), help="market to run (default: all)"
+    )
+    parser.add_argument(
+        "--category-workers",
+        type=int,
+        default=1,
+        help="categories scraped at the same time in each market",
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="skip the categories that didn't change since the last full refresh",
+    )
+    parser.add_argument(
+        "--full-refresh-hours",
+        type=float,
+        default=24,
+        help="in incremental mode, categories are fully crawled at least this often",
+    )
+    parser.add_argument("--deadline-minutes", type=float, help="time budget of the whole run")
+    parser.add_argument(
+        "--market-deadline-minutes", type=float, help="time budget of each market"
+    )
+    parser.add_argument(
+        "--category-deadline-minutes", type=float, help="time budget of each category"
+    )
+    parser.add_argument(
+        "--prometheus-metrics",
+        action="store_true",
+        help=f"also write the metrics in the Prometheus text format in {METRICS_DIR}",
+    )
+    parser.add_argument(
+        "--streaming",
+        action="store_true",
+        help="save the products as each page is parsed, with bounded memory "
+        f"(markets: {', '.join(sorted(STREAMING_MARKETS))})",
+    )
+    args = parser.parse_args()
+
+    run(
+        args.market or list(MARKETS),
+        args.category_workers,
+        incremental=args.incremental,
+        full_refresh_hours=args.full_refresh_hours,
+        deadline_minutes=args.deadline_minutes,
+        market_deadline_minutes=args.market_deadline_minutes,
+        category_deadline_minutes=args.category_deadline_minutes,
+        prometheus_metrics=args.prometheus_metrics,
+        streaming=args.streaming,
+    )
@@ -0,0 +1,395 @@
+"""
+Pipeline of stages connected by bounded queues, used by the market scrapers
+
+    categories -> [fetch] -> pages -> [parse] -> products -> [persist]
+
+Each stage has its own worker threads, so the network keeps fetching pages
+while the previous ones are parsed and saved. A stage function receives one
+item and returns (or yields) the items for the next stage.
+
+Items that fail (pages without response) can be set aside in a RetryQueue, which
+runs them again through the pipeline once the main crawl has finished.
+
+With a deadline, the cancellable stages (the ones that make requests) drop
+their pending items once it expires, while the rest of the stages finish
+parsing and saving what was already fetched.
+"""
+
+import queue
+import threading
+import time
+from contextlib import nullcontext
+from typing import Any, Callable, Iterable, List, Optional, Union
+from utils.deadline import Deadline
+from utils.logger import Logger
+from utils.metrics import step_timer
+
+LOGGER = Logger("pipeline")
+
+# Default pause before each round of retries, so the host can recover
+RETRY_WAIT_SECONDS = 30
+
+# Marks the end of the items of a queue
+_END = object()
+
+
+class Stage:
+    """Step of the pipeline with its own workers and input queue"""
+
+    def __init__(
+        self,
+        name: str,
+        func: Callable[[Any], Optional[Iterable[Any]]],
+        workers: int = 1,
+        queue_size: int = 100,
+        cancellable: bool = False,
+    ):
+        self.name = name
+        self.func = func
+        self.workers = workers
+        # Items are dropped once the deadline of the pipeline expires
+        self.cancellable = cancellable
+        self.queue_size = queue_size
+        self.queue = queue.Queue(maxsize=queue_size)
+
+        self._lock = threading.Lock()
+        self._active_workers = workers
+        self.items_in = 0
+        self.items_out = 0
+        self.errors = 0
+        self.cancelled = 0
+        self.busy_seconds = 0.0
+
+    def _reset(self):
+        """Prepare the stage for a new run, the counters are kept"""
+        self.queue = queue.Queue(maxsize=self.queue_size)
+        self._active_workers = self.workers
+
+    def _count(self, items_out: int, busy_seconds: float, error: bool = False):
+        with self._lock:
+            self.items_in += 1
+            self.items_out += items_out
+            self.busy_seconds += busy_seconds
+            self.errors += int(error)
+
+    def _cancel(self):
+        with self._lock:
+            self.cancelled += 1
+
+    def _worker_finished(self) -> bool:
+        """True when the last worker of the stage finishes"""
+        with self._lock:
+            self._active_workers -= 1
+            return self._active_workers == 0
+
+    def report(self, elapsed_seconds: float) -> dict:
+        return {
+            "stage": self.name,
+            "workers": self.workers,
+            "items_in": self.items_in,
+            "items_out": self.items_out,
+            "errors": self.errors,
+            "cancelled": self.cancelled,
+            "items_per_second": round(self.items_in / elapsed_seconds, 2) if elapsed_seconds else 0.0,
+            "busy_seconds": round(self.busy_seconds, 2),
+            # Fraction of the time the workers of the stage were working
+            "utilization": (
+                round(self.busy_seconds / (elapsed_seconds * self.workers), 3)
+                if elapsed_seconds
+                else 0.0
+            ),
+        }
+
+
+class Pipeline:
+    """Runs the items through the stages and reports the throughput of each stage"""
+
+    def __init__(
+        self, stages: List[Stage], name: str = "pipeline", deadline: Optional[Deadline] = None
+    ):
+        self.stages = stages
+        self.name = name
+        # Active in every worker, so the requests of the stages respect it
+        self.deadline = deadline
+        self._cancelled_logged = False
+        self._lock = threading.Lock()
+
+    def expired(self) -> bool:
+        """True once the deadline of the pipeline has expired"""
+        if self.deadline is None or not self.deadline.expired():
+            return False
+        with self._lock:
+            if not self._cancelled_logged:
+                self._cancelled_logged = True
+                LOGGER.warning(
+                    "[%s] Deadline '%s' exceeded, cancelling the pending requests",
+                    self.name,
+                    self.deadline.name,
+                )
+        return True
+
+    def _stage_index(self, stage: Union[int, str]) -> int:
+        if isinstance(stage, int):
+            return stage
+        for index, pipeline_stage in enumerate(self.stages):
+            if pipeline_stage.name == stage:
+                return index
+        raise ValueError(f"Stage '{stage}' not found in pipeline '{self.name}'")
+
+    def _next_stage(self, index: int) -> Optional[Stage]:
+        return self.stages[index + 1] if index + 1 < len(self.stages) else None
+
+    def _run_worker(self, index: int):
+        with self.deadline.activate() if self.deadline else nullcontext():
+            self._process_items(index)
+
+    def _process_items(self, index: int):
+        stage = self.stages[index]
+        next_stage = self._next_stage(index)
+
+        while True:
+            item = stage.queue.get()
+            if item is _END:
+                break
+
+            # Keep reading the queue until the end, so the previous stage never blocks
+            if stage.cancellable and self.expired():
+                stage._cancel()
+                continue
+
+            start_time = time.perf_counter()
+            items_out = 0
+            error = False
+            outputs = ()
+            try:
+                outputs = stage.func(item) or ()
+                for output in outputs:
+                    items_out += 1
+                    if next_stage is not None:
+                        next_stage.queue.put(output)
+                    # Stop the generators that paginate (the output already made is kept)
+                    if stage.cancellable and self.expired():
+                        break
+            except Exception as e:
+                error = True
+                LOGGER.error(
+                    "[%s] Error in stage '%s': %s",
+                    self.name,
+                    stage.name,
+                    e,
+                    key=f"{self.name}-{stage.name}-error",
+                )
+            finally:
+                if hasattr(outputs, "close"):
+                    outputs.close()
+            stage._count(items_out, time.perf_counter() - start_time, error)
+
+        # The last worker of the stage closes the queue of the next one
+        if stage._worker_finished() and next_stage is not None:
+            for _ in range(next_stage.workers):
+                next_stage.queue.put(_END)
+
+    def run(self, items: Iterable[Any], start_stage: Union[int, str] = 0) -> dict:
+        """
+        Process all the items and return the report of the stages
+
+        start_stage: stage (index or name) that receives the items, the previous ones are skipped
+        """
+        start_time = time.perf_counter()
+        start_index = self._stage_index(start_stage)
+
+        threads = []
+        for index, stage in enumerate(self.stages[start_index:], start_index):
+            stage._reset()
+            for worker_number in range(stage.workers):
+                thread = threading.Thread(
+                    target=self._run_worker,
+                    args=(index,),
+                    name=f"{self.name}-{stage.name}-{worker_number}",
+                    daemon=True,
+                )
+                thread.start()
+                threads.append(thread)
+
+        first_stage = self.stages[start_index]
+        for item in items:
+            first_stage.queue.put(item)
+        for _ in range(first_stage.workers):
+            first_stage.queue.put(_END)
+
+        for thread in threads:
+            thread.join()
+
+        elapsed_seconds = time.perf_counter() - start_time
+        report = {
+            "seconds": round(elapsed_seconds, 2),
+            "stages": [stage.report(elapsed_seconds) for stage in self.stages[start_index:]],
+        }
+        for stage_report in report["stages"]:
+            LOGGER.info(
+                "[%s] Stage '%s': %d items (%s/s), utilization %.0f%%, %d errors, %d cancelled",
+                self.name,
+                stage_report["stage"],
+                stage_report["items_in"],
+                stage_report["items_per_second"],
+                stage_report["utilization"] * 100,
+                stage_report["errors"],
+                stage_report["cancelled"],
+            )
+        return report
+
+
+class RetryQueue:
+    """
+    Items that failed in a stage, retried after the main run of the pipeline
+    instead of blocking the workers with inline retries.
+
+    rounds: times the failed items are retried
+    budget: maximum number of retried items in the whole run
+    wait_seconds: pause before each round, so the host can recover
+    """
+
+    def __init__(
+        self, rounds: int = 2, budget: int = 200, wait_seconds: Optional[float] = None
+    ):
+        self.rounds = rounds
+        self.budget = budget
+        self.wait_seconds = RETRY_WAIT_SECONDS if wait_seconds is None else wait_seconds
+
+        self._pending = []
+        self._abandoned = []
+        self._lock = threading.Lock()
+        self.deferred = 0
+        self.retried = 0
+        self.lost = []
+
+    def defer(self, stage: str, item: Any, reason: str) -> None:
+        """Set aside an item of the stage to be retried later"""
+        with self._lock:
+            self._pending.append((stage, item, reason))
+            self.deferred += 1
+
+    def abandon(self, stage: str, item: Any, reason: str) -> None:
+        """Give up an item without retrying it (it is reported as lost)"""
+        with self._lock:
+            self._abandoned.append((stage, item, reason))
+
+    def drain(
+        self,
+        pipeline: Pipeline,
+        describe: Callable[[Any], dict] = lambda item: {"item": repr(item)},
+    ) -> dict:
+        """
+        Run the deferred items through the pipeline (again deferred items go to
+        the next round). The ones left without rounds or budget are lost, each
+        described with describe(item) in the report.
+        """
+        for round_number in range(1, self.rounds + 1):
+            with self._lock:
+                pending, self._pending = self._pending, []
+            if not pending:
+                break
+            if pipeline.expired():
+                self._lose(pending, describe, "deadline exceeded")
+                break
+
+            budget_left = max(self.budget - self.retried, 0)
+            to_retry, over_budget = pending[:budget_left], pending[budget_left:]
+            self._lose(over_budget, describe, "retry budget exhausted")
+            if not to_retry:
+                break
+
+            LOGGER.info(
+                "[%s] Retry round %d/%d: %d items in %ss",
+                pipeline.name,
+                round_number,
+                self.rounds,
+                len(to_retry),
+                self.wait_seconds,
+            )
+            wait_seconds = self.wait_seconds
+            if pipeline.deadline is not None:
+                wait_seconds = pipeline.deadline.timeout(wait_seconds)
+            time.sleep(wait_seconds)
+            self.retried += len(to_retry)
+
+            stages = {}
+            for stage, item, _ in to_retry:
+                stages.setdefault(stage, []).append(item)
+            for stage, items in stages.items():
+                pipeline.run(items, start_stage=stage)
+
+        with self._lock:
+            pending, self._pending = self._pending, []
+            abandoned, self._abandoned = self._abandoned, []
+        self._lose(pending, describe)
+        self._lose(abandoned, describe)
+
+        if self.lost:
+            LOGGER.warning("[%s] %d items lost after the retries", pipeline.name, len(self.lost))
+
+        return self.report()
+
+    def _lose(self, entries, describe: Callable[[Any], dict], reason: Optional[str] = None):
+        for _, item, item_reason in entries:
+            self.lost.append(dict(describe(item), reason=reason or item_reason))
+
+    def report(self) -> dict:
+        return {
+            "deferred": self.deferred,
+            "retried": self.retried,
+            "lost": self.lost,
+        }
+
+
+class PersistProducts:
+    """
+    Last stage of the market pipelines: inserts each batch of products in the
+    database and keeps them for the snapshot file of the run.
+
+    Receives {"category": name, "products": [ScrapingProduct, ...]} items.
+    db_client: DatabaseClient, run the pipeline inside db_client.keep_connection()
+        so all the batches are inserted on the same connection
+    market: label of the db_insert step in the metrics
+    snapshot: writer of the snapshot file (ScrapingProductsFileWriter). With it
+        each batch is written as it arrives and the products are not kept, so
+        the memory doesn't grow with the number of products
+    """
+
+    def __init__(
+        self,
+        db_client,
+        insertion_callback: Optional[Callable] = None,
+        market: str = "unknown",
+        snapshot=None,
+    ):
+        self.db_client = db_client
+        self.insertion_callback = insertion_callback
+        self.market = market
+        self.snapshot = snapshot
+        self.products = []
+        self.product_count = 0
+        self.category_counts = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, batch: dict):
+        products = batch["products"]
+        if not products:
+            return
+
+        with self._lock:
+            if self.snapshot is None:
+                self.products.extend(products)
+            self.product_count += len(products)
+            self.category_counts[batch["category"]] = (
+                self.category_counts.get(batch["category"], 0) + len(products)
+            )
+
+        if self.snapshot is not None:
+            with step_timer(self.market, batch["category"], "file_write"):
+                self.snapshot.write(products)
+
+        with step_timer(self.market, batch["category"], "db_insert"):
+            success = self.db_client.insert_scraping_products_with_discounts(products)
+        if self.insertion_callback:
+            self.insertion_callback(success, len(products), batch["category"])
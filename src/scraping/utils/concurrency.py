@@ -0,0 +1,218 @@
+"""
+Adaptive concurrency per host (AIMD: additive increase, multiplicative decrease)
+
+Each host has a limit of requests in flight. The limit grows by one after a
+window of healthy responses and is halved when the host pushes back: 429/503
+responses, Retry-After headers, a high error rate or latencies well above the
+usual ones. Retry-After also pauses the host until the given time.
+"""
+
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Dict, Optional
+from urllib.parse import urlparse
+from utils.logger import Logger
+
+LOGGER = Logger("concurrency")
+
+# Responses that mean "slow down"
+BACKOFF_STATUS = {429, 503}
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Seconds to wait from a Retry-After header (seconds or HTTP date)"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+
+
+class AdaptiveLimit:
+    """Concurrency limit of one host"""
+
+    def __init__(
+        self,
+        host: str,
+        initial: int = 1,
+        minimum: int = 1,
+        maximum: int = 8,
+        decrease_factor: float = 0.5,
+        latency_factor: float = 3.0,
+        min_latency_spike: float = 1.0,
+        max_error_rate: float = 0.2,
+        window: int = 20,
+    ):
+        self.host = host
+        self.limit = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        self.decrease_factor = decrease_factor
+        # A response slower than latency_factor times the usual latency is a spike
+        self.latency_factor = latency_factor
+        # ... and at least this many seconds slower (ignores jitter of fast responses)
+        self.min_latency_spike = min_latency_spike
+        self.max_error_rate = max_error_rate
+
+        self.in_flight = 0
+        self.paused_until = 0.0
+        self.latency = None  # moving average of the healthy responses
+        self._outcomes = deque(maxlen=window)
+        self._successes_since_change = 0
+        self._last_decrease = 0.0
+
+        self.increases = 0
+        self.decreases = 0
+        self.max_reached = initial
+
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        """Block until a request to the host is allowed"""
+        with self._condition:
+            while True:
+                wait_seconds = self.paused_until - time.monotonic()
+                if wait_seconds <= 0 and self.in_flight < self.limit:
+                    self.in_flight += 1
+                    return
+                self._condition.wait(wait_seconds if wait_seconds > 0 else None)
+
+    def release(
+        self,
+        status: Optional[int],
+        latency: float,
+        retry_after: Optional[float] = None,
+    ):
+        """Record the result of a request (status None for connection errors) and adjust the limit"""
+        with self._condition:
+            self.in_flight -= 1
+            now = time.monotonic()
+
+            error = status is None or status >= 500
+            self._outcomes.append(error)
+            error_rate = sum(self._outcomes) / len(self._outcomes)
+
+            if retry_after is not None:
+                self.paused_until = max(self.paused_until, now + retry_after)
+
+            reason = None
+            if status in BACKOFF_STATUS or retry_after is not None:
+                reason = f"status {status}" + (
+                    f", retry after {retry_after:.0f}s" if retry_after is not None else ""
+                )
+            elif (
+                len(self._outcomes) >= self._outcomes.maxlen // 2
+                and error_rate > self.max_error_rate
+            ):
+                reason = f"error rate {error_rate:.0%}"
+            elif (
+                not error
+                and self.latency is not None
+                and latency > self.latency * self.latency_factor
+                and latency - self.latency > self.min_latency_spike
+            ):
+                reason = f"latency {latency:.2f}s (usual {self.latency:.2f}s)"
+
+            if reason:
+                self._decrease(reason, now)
+            elif not error:
+                self.latency = (
+                    latency if self.latency is None else 0.8 * self.latency + 0.2 * latency
+                )
+                self._successes_since_change += 1
+                # One more request in flight after a full window of healthy responses
+                if (
+                    self._successes_since_change >= self._outcomes.maxlen
+                    and self.limit < self.maximum
+                ):
+                    self.limit += 1
+                    self.increases += 1
+                    self.max_reached = max(self.max_reached, self.limit)
+                    self._successes_since_change = 0
+                    LOGGER.info(
+                        "[%s] healthy responses -> concurrency %d -> %d",
+                        self.host,
+                        self.limit - 1,
+                        self.limit,
+                    )
+
+            self._condition.notify_all()
+
+    def _decrease(self, reason: str, now: float):
+        self._successes_since_change = 0
+        # The requests in flight when the limit was cut report the same problem, cut once
+        if self.latency is not None and now - self._last_decrease < max(1.0, self.latency * 2):
+            return
+
+        new_limit = max(self.minimum, int(self.limit * self.decrease_factor))
+        self._last_decrease = now
+        self.decreases += 1
+        self._outcomes.clear()
+        LOGGER.warning(
+            "[%s] %s -> concurrency %d -> %d", self.host, reason, self.limit, new_limit
+        )
+        self.limit = new_limit
+
+    def stats(self) -> dict:
+        return {
+            "limit": self.limit,
+            "max_reached": self.max_reached,
+            "increases": self.increases,
+            "decreases": self.decreases,
+            "latency": round(self.latency, 3) if self.latency is not None else None,
+        }
+
+
+class HostConcurrencyController:
+    """Adaptive limits of the hosts, hosts without a limit are not controlled"""
+
+    def __init__(self):
+        self._limits: Dict[str, AdaptiveLimit] = {}
+        self._lock = threading.Lock()
+
+    def set_host(self, host: str, **options):
+        with self._lock:
+            self._limits[host] = AdaptiveLimit(host, **options)
+
+    def get(self, url: str) -> Optional[AdaptiveLimit]:
+        return self._limits.get(urlparse(url).hostname)
+
+    @contextmanager
+    def request(self, url: str):
+        """
+        Hold a slot of the host while the request is made. The body must call
+        the yielded function with (status, retry_after) once it has the response.
+        """
+        limit = self.get(url)
+        if limit is None:
+            yield lambda status, retry_after=None: None
+            return
+
+        limit.acquire()
+        start_time = time.perf_counter()
+        result = {}
+
+        def record(status: Optional[int], retry_after: Optional[float] = None):
+            result.update(status=status, retry_after=retry_after)
+
+        try:
+            yield record
+        finally:
+            limit.release(
+                result.get("status"),
+                time.perf_counter() - start_time,
+                result.get("retry_after"),
+            )
+
+    def stats(self) -> Dict[str, dict]:
+        return {host: limit.stats() for host, limit in self._limits.items()}
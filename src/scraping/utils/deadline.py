@@ -0,0 +1,78 @@
+"""
+Time budgets of the scrapers (run -> market -> category)
+
+A Deadline can have a parent, and expires when itself or any parent expires.
+The deadline active in a thread (Deadline.activate) is read by the http
+requests, which shorten their timeouts to the time left and are not sent once
+it has expired.
+"""
+
+import threading
+import time
+from contextlib import contextmanager
+from typing import Optional
+
+_LOCAL = threading.local()
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+class Deadline:
+    """Point in time after which the work must stop (seconds None: no limit of its own)"""
+
+    def __init__(
+        self,
+        seconds: Optional[float] = None,
+        parent: Optional["Deadline"] = None,
+        name: str = "run",
+    ):
+        self.name = name
+        self.parent = parent
+        self.expires_at = time.monotonic() + seconds if seconds is not None else None
+
+    def child(self, seconds: Optional[float], name: str) -> "Deadline":
+        """Deadline of a part of the work, never later than this one"""
+        return Deadline(seconds, parent=self, name=name)
+
+    def remaining(self) -> Optional[float]:
+        """Seconds left, None if there is no limit"""
+        remaining = None
+        if self.expires_at is not None:
+            remaining = self.expires_at - time.monotonic()
+        if self.parent is not None:
+            parent_remaining = self.parent.remaining()
+            if parent_remaining is not None:
+                remaining = (
+                    parent_remaining if remaining is None else min(remaining, parent_remaining)
+                )
+        return max(remaining, 0.0) if remaining is not None else None
+
+    def expired(self) -> bool:
+        remaining = self.remaining()
+        return remaining is not None and remaining <= 0
+
+    def timeout(self, default: float) -> float:
+        """Timeout of an operation, shortened to the time left"""
+        remaining = self.remaining()
+        return default if remaining is None else min(default, remaining)
+
+    def check(self) -> None:
+        if self.expired():
+            raise DeadlineExceeded(f"Deadline '{self.name}' exceeded")
+
+    @contextmanager
+    def activate(self):
+        """Make this the deadline of the current thread"""
+        previous = getattr(_LOCAL, "deadline", None)
+        _LOCAL.deadline = self
+        try:
+            yield self
+        finally:
+            _LOCAL.deadline = previous
+
+
+def current_deadline() -> Optional[Deadline]:
+    """Deadline active in the current thread, None if there is no limit"""
+    return getattr(_LOCAL, "deadline", None)
@@ -0,0 +1,90 @@
+"""
+Fingerprints of the categories, used to skip the categories that didn't change
+since the last run.
+
+A fingerprint is the number of products of the category plus a hash of the
+products of its first page. When it is the same as in the last complete crawl
+the rest of the pages are very likely unchanged too, so the category can be
+skipped until the next full refresh.
+"""
+
+import hashlib
+import json
+import os
+import random
+import threading
+from datetime import datetime, timedelta
+from typing import Iterable, Optional, Tuple
+
+
+def build_fingerprint(total_products: int, items: Iterable) -> str:
+    """Hash of the number of products and the items (ids, prices...) of the first page"""
+    payload = json.dumps([total_products, sorted(items)], default=str)
+    return hashlib.sha1(payload.encode("utf-8")).hexdigest()
+
+
+class CategoryFingerprints:
+    """
+    Fingerprints of the last complete crawl of each category, stored in a JSON file:
+
+        {"Mercearia": {"fingerprint": "...", "full_refresh_at": "2024-01-01T06:00:00"}}
+
+    full_refresh_interval: a category is always crawled if its last complete
+        crawl is older than this
+    sample_rate: fraction of the unchanged categories that are crawled anyway,
+        to detect changes that don't show up on the first page
+    """
+
+    def __init__(
+        self,
+        path: str,
+        full_refresh_interval: timedelta = timedelta(days=1),
+        sample_rate: float = 0.0,
+    ):
+        self.path = path
+        self.full_refresh_interval = full_refresh_interval
+        self.sample_rate = sample_rate
+        self._lock = threading.Lock()
+        self._categories = self._load()
+
+    def _load(self) -> dict:
+        if not os.path.exists(self.path):
+            return {}
+        with open(self.path, "r", encoding="utf-8") as f:
+            return json.load(f)
+
+    def save(self) -> None:
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        with self._lock:
+            categories = dict(self._categories)
+        with open(self.path, "w", encoding="utf-8") as f:
+            json.dump(categories, f, ensure_ascii=False, indent=2)
+
+    def should_crawl(
+        self, category_name: str, fingerprint: str, now: Optional[datetime] = None
+    ) -> Tuple[bool, str]:
+        """Return (crawl, reason) for a category with this fingerprint"""
+        now = now or datetime.now()
+        with self._lock:
+            last = self._categories.get(category_name)
+
+        if last is None:
+            return True, "new"
+        if last["fingerprint"] != fingerprint:
+            return True, "changed"
+        if now - datetime.fromisoformat(last["full_refresh_at"]) >= self.full_refresh_interval:
+            return True, "full refresh"
+        if self.sample_rate and random.random() < self.sample_rate:
+            return True, "sample"
+        return False, "unchanged"
+
+    def record(
+        self, category_name: str, fingerprint: str, now: Optional[datetime] = None
+    ) -> None:
+        """Store the fingerprint of a complete crawl of the category"""
+        now = now or datetime.now()
+        with self._lock:
+            self._categories[category_name] = {
+                "fingerprint": fingerprint,
+                "full_refresh_at": now.replace(microsecond=0).isoformat(),
+            }
@@ -2,15 +2,24 @@ import requests
 import random
 import time
 import socket
+import threading
 import brotli
+from urllib.parse import urlparse
 from playwright.sync_api import sync_playwright
 from requests.adapters import HTTPAdapter
 from urllib3.util.retry import Retry
+from utils.concurrency import HostConcurrencyController, parse_retry_after
+from utils.deadline import Deadline, DeadlineExceeded, current_deadline
+from utils.metrics import METRICS
 
 # Constants for delays
 MIN_DELAY_SECONDS = 1
 MAX_DELAY_SECONDS = 4
 
+# Retries of the responses that ask to slow down (429/503), after waiting for the host.
+# If they keep failing the scrapers defer the page to the end of the run
+RATE_LIMITED_RETRIES = 1
+
 DEFAULT_HEADERS = {
     "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 Chrome/114.0.0.0 Safari/537.36",
     "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8",
@@ -23,12 +32,15 @@ DEFAULT_HEADERS = {
 
 def create_session():
     session = requests.Session()
+    # Only short retries here, the pages that still fail are deferred by the
+    # scrapers and retried at the end of the run (pipeline.RetryQueue)
     retry = Retry(
-        total=5,
-        connect=5,
-        read=5,
-        backoff_factor=0.8,  # 0.8, 1.6, 3.2, 6.4, ...
-        status_forcelist=[429, 500, 502, 503, 504],
+        total=2,
+        connect=2,
+        read=1,
+        backoff_factor=0.5,  # 0.5, 1
+        # 429 and 503 are handled by the concurrency controller (_make_request)
+        status_forcelist=[500, 502, 504],
         allowed_methods=frozenset(["GET"]),
         raise_on_status=False,
     )
@@ -42,10 +54,62 @@ def create_session():
 _SESSION = create_session()
 
 
+class HostRateLimiter:
+    """Limit the number of requests per second sent to each host (shared by all threads)"""
+
+    def __init__(self):
+        self._min_intervals = {}
+        self._next_request_time = {}
+        self._lock = threading.Lock()
+
+    def set_limit(self, host: str, requests_per_second: float):
+        with self._lock:
+            self._min_intervals[host] = 1 / requests_per_second
+
+    def wait(self, url: str):
+        """Block until the host of the url can receive another request"""
+        host = urlparse(url).hostname
+        with self._lock:
+            min_interval = self._min_intervals.get(host)
+            if min_interval is None:
+                return
+            now = time.monotonic()
+            request_time = max(now, self._next_request_time.get(host, now))
+            self._next_request_time[host] = request_time + min_interval
+
+        if request_time > now:
+            time.sleep(request_time - now)
+
+
+_RATE_LIMITER = HostRateLimiter()
+
+
+def set_host_rate_limit(host: str, requests_per_second: float):
+    """Set the request budget of a host for this process"""
+    _RATE_LIMITER.set_limit(host, requests_per_second)
+
+
+_CONCURRENCY = HostConcurrencyController()
+
+
+def set_host_concurrency(host: str, initial: int = 1, maximum: int = 8, **options):
+    """Enable the adaptive concurrency limit of a host for this process"""
+    _CONCURRENCY.set_host(host, initial=initial, maximum=maximum, **options)
+
+
+def host_concurrency_stats() -> dict:
+    """Current limit and number of adjustments of each controlled host"""
+    return _CONCURRENCY.stats()
+
+
 def _random_delay(url: str = ""):
     delay = random.uniform(MIN_DELAY_SECONDS, MAX_DELAY_SECONDS)
+    deadline = current_deadline()
+    if deadline is not None:
+        delay = deadline.timeout(delay)
     # print(f"Waiting {delay:.2f} seconds... for {url}")
     time.sleep(delay)
+    METRICS.observe("http_delay_seconds", delay, host=urlparse(url).hostname)
 
 
 def _make_request(url, headers=None, timeout=30, raise_error: bool = False):
@@ -53,8 +117,45 @@ def _make_request(url, headers=None, timeout=30, raise_error: bool = False):
     # merge default headers with provided headers
     merged_headers = {**DEFAULT_HEADERS, **(headers or {})}
 
+    deadline = current_deadline()
+    host = urlparse(url).hostname
     try:
-        response = _SESSION.get(url, headers=merged_headers, timeout=timeout)
+        for attempt in range(RATE_LIMITED_RETRIES + 1):
+            # The request is not sent after the deadline, and never waits beyond it
+            if deadline is not None:
+                deadline.check()
+                timeout = deadline.timeout(timeout)
+
+            with METRICS.timer("http_delay_seconds", host=host):
+                _RATE_LIMITER.wait(url)
+            with _CONCURRENCY.request(url) as record:
+                start_time = time.perf_counter()
+                try:
+                    response = _SESSION.get(url, headers=merged_headers, timeout=timeout)
+                except requests.exceptions.RequestException:
+                    METRICS.observe(
+                        "http_request_seconds",
+                        time.perf_counter() - start_time,
+                        host=host,
+                        status="error",
+                    )
+                    record(None)
+                    raise
+                METRICS.observe(
+                    "http_request_seconds",
+                    time.perf_counter() - start_time,
+                    host=host,
+                    status=response.status_code,
+                )
+                record(
+                    response.status_code,
+                    parse_retry_after(response.headers.get("Retry-After")),
+                )
+
+            # The next attempt waits until the controller allows the host again
+            if response.status_code not in (429, 503) or attempt == RATE_LIMITED_RETRIES:
+                break
+
         response.raise_for_status()
 
         # content_encoding = response.headers.get('content-encoding', '').lower()
@@ -65,6 +166,11 @@ def _make_request(url, headers=None, timeout=30, raise_error: bool = False):
         #         print(f"Brotli decompression failed: {brotli_error}, url: {url}")
 
         return response
+    except DeadlineExceeded as e:
+        print(f"Request to {url} not sent: {e}")
+        if raise_error:
+            raise e
+        return None
     except (requests.exceptions.RequestException, socket.gaierror) as e:
         print(f"Error making request to {url}: {e}")
         if isinstance(e, socket.gaierror):
@@ -85,6 +191,11 @@ def make_request_with_delay(
     return _make_request(url, headers, timeout, raise_error)
 
 
+def _playwright_timeout(deadline: Deadline) -> int:
+    """Milliseconds left for a Playwright call, at least 1 (0 means no timeout for Playwright)"""
+    return max(1, int(deadline.remaining() * 1000))
+
+
 def make_dinamic_request_with_delay(
     url,
     selector,
@@ -97,8 +208,14 @@ def make_dinamic_request_with_delay(
     max_loops: int = 12,
 ):
     last_error = None
+    deadline = current_deadline()
 
     for attempt in range(1, max_retries + 1):
+        if deadline is not None and deadline.expired():
+            print(f"Request to {url} not sent: deadline '{deadline.name}' exceeded")
+            last_error = last_error or DeadlineExceeded(f"Deadline '{deadline.name}' exceeded")
+            break
+
         try:
             with sync_playwright() as p:
                 browser = p.chromium.launch(headless=True)
@@ -112,10 +229,36 @@ def make_dinamic_request_with_delay(
                 if delay:
                     _random_delay(url=url)
 
-                page.goto(url, timeout=timeout)
+                with METRICS.timer("http_delay_seconds", host=urlparse(url).hostname):
+                    _RATE_LIMITER.wait(url)
+                # timeout (ms) is shared by the navigation and the wait for the
+                # selector, and never goes beyond the deadline of the thread
+                request_deadline = Deadline(timeout / 1000, parent=deadline, name=f"request {url}")
+                with _CONCURRENCY.request(url) as record:
+                    start_time = time.perf_counter()
+                    try:
+                        page_response = page.goto(url, timeout=_playwright_timeout(request_deadline))
+                    except Exception:
+                        METRICS.observe(
+                            "http_request_seconds",
+                            time.perf_counter() - start_time,
+                            host=urlparse(url).hostname,
+                            status="error",
+                        )
+                        record(None)
+                        raise
+                    METRICS.observe(
+                        "http_request_seconds",
+                        time.perf_counter() - start_time,
+                        host=urlparse(url).hostname,
+                        status=page_response.status if page_response else "error",
+                    )
+                    record(page_response.status if page_response else None)
 
                 # Espera conteúdo alvo inicial
-                page.wait_for_selector(selector, timeout=timeout, state="attached")
+                page.wait_for_selector(
+                    selector, timeout=_playwright_timeout(request_deadline), state="attached"
+                )
 
                 # Tenta atingir a quantidade mínima de elementos
                 def get_count() -> int:
@@ -1,41 +1,174 @@
+"""
+Logger of the scrapers
+
+Messages take %-style arguments, which are only formatted when the level is
+enabled, so a debug line inside a loop costs almost nothing in production:
+
+    LOGGER.debug("Processing product URL: %s", product_url)
+
+The records are written by a background thread (QueueHandler/QueueListener),
+so the workers never wait for stdout. Messages that repeat for every page can
+pass a key: only one message per key every RATE_LIMIT_SECONDS is written, with
+the number of the suppressed ones.
+
+Environment variables:
+    LOG_LEVEL   DEBUG, INFO (default), WARNING, ERROR
+    LOG_FORMAT  text (default) or json (one JSON object per line)
+"""
+
+import atexit
+import json
 import logging
+import os
+import queue
 import sys
+import threading
+import time
+from logging.handlers import QueueHandler, QueueListener
+from typing import Optional
+
+TEXT_FORMAT = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+# Minimum seconds between two messages with the same key
+RATE_LIMIT_SECONDS = 10
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per record, for log collectors"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            "time": self.formatTime(record, DATE_FORMAT),
+            "logger": record.name,
+            "level": record.levelname,
+            "message": record.getMessage(),
+            "thread": record.threadName,
+        }
+        if record.exc_info:
+            data["exception"] = self.formatException(record.exc_info)
+        return json.dumps(data, ensure_ascii=False)
+
+
+class _BackgroundHandler(QueueHandler):
+    """Hands the records to a thread that writes them to stdout"""
+
+    def __init__(self):
+        super().__init__(queue.SimpleQueue())
+        self.output = logging.StreamHandler(sys.stdout)
+        if os.getenv("LOG_FORMAT", "text").lower() == "json":
+            self.output.setFormatter(JsonFormatter())
+        else:
+            self.output.setFormatter(logging.Formatter(TEXT_FORMAT, datefmt=DATE_FORMAT))
+        self.listener: Optional[QueueListener] = None
+
+    def start(self):
+        # New queue: after a fork the one of the parent may be in use by its thread
+        self.queue = queue.SimpleQueue()
+        self.listener = QueueListener(self.queue, self.output)
+        self.listener.start()
+
+    def stop(self):
+        """Write the pending records and go on writing synchronously"""
+        listener, self.listener = self.listener, None
+        if listener is not None:
+            listener.stop()
+
+    def emit(self, record: logging.LogRecord):
+        if self.listener is None:
+            self.output.handle(record)
+            return
+        super().emit(record)
+
+
+_HANDLER: Optional[_BackgroundHandler] = None
+_HANDLER_LOCK = threading.Lock()
+
+
+def _after_fork_in_child():
+    # The writer thread is not copied to the child process
+    _HANDLER.start()
+    # multiprocessing ends its processes with os._exit, which skips atexit
+    from multiprocessing import util
+
+    util.Finalize(None, _HANDLER.stop, exitpriority=0)
+
+
+def _background_handler() -> _BackgroundHandler:
+    """Handler shared by all the loggers of the process"""
+    global _HANDLER
+    with _HANDLER_LOCK:
+        if _HANDLER is None:
+            _HANDLER = _BackgroundHandler()
+            _HANDLER.start()
+            atexit.register(_HANDLER.stop)
+            if hasattr(os, "register_at_fork"):
+                os.register_at_fork(after_in_child=_after_fork_in_child)
+        return _HANDLER
+
+
+class _RateLimiter:
+    """Lets a key through once every interval, counting the messages suppressed meanwhile"""
+
+    def __init__(self, interval_seconds: float):
+        self.interval_seconds = interval_seconds
+        self._keys = {}
+        self._lock = threading.Lock()
+
+    def allow(self, key) -> tuple:
+        """Return (allowed, number of messages suppressed since the last allowed one)"""
+        now = time.monotonic()
+        with self._lock:
+            allowed_at, suppressed = self._keys.get(key, (None, 0))
+            if allowed_at is not None and now - allowed_at < self.interval_seconds:
+                self._keys[key] = (allowed_at, suppressed + 1)
+                return False, 0
+            self._keys[key] = (now, 0)
+            return True, suppressed
+
+
+_RATE_LIMITER = _RateLimiter(RATE_LIMIT_SECONDS)
 
 
 class Logger:
     def __init__(self, name: str = "price_collection"):
         self.logger = logging.getLogger(name)
-        self.logger.setLevel(logging.INFO)
+        self.logger.setLevel(os.getenv("LOG_LEVEL", "INFO").upper())
 
         # Avoid duplicating handlers if they already exist
         if not self.logger.handlers:
-            # Handler for console
-            console_handler = logging.StreamHandler(sys.stdout)
-            console_handler.setLevel(logging.INFO)
+            self.logger.addHandler(_background_handler())
 
-            # Message format
-            formatter = logging.Formatter(
-                "%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-                datefmt="%Y-%m-%d %H:%M:%S",
-            )
-            console_handler.setFormatter(formatter)
+    def is_enabled_for(self, level: int) -> bool:
+        """Guard for messages whose arguments are expensive to compute"""
+        return self.logger.isEnabledFor(level)
 
-            self.logger.addHandler(console_handler)
+    def _log(self, level: int, message: str, args: tuple, key: Optional[str]):
+        if not self.logger.isEnabledFor(level):
+            return
+        if key is not None:
+            allowed, suppressed = _RATE_LIMITER.allow((self.logger.name, key))
+            if not allowed:
+                return
+            if suppressed:
+                message = f"{message} (+{suppressed} similar messages suppressed)"
+        # stacklevel: the caller of info/warning/... is the origin of the record
+        self.logger.log(level, message, *args, stacklevel=3)
 
-    def info(self, message: str):
+    def info(self, message: str, *args, key: Optional[str] = None):
         """Log info"""
-        self.logger.info(message)
+        self._log(logging.INFO, message, args, key)
 
-    def warning(self, message: str):
+    def warning(self, message: str, *args, key: Optional[str] = None):
         """Log warning"""
-        self.logger.warning(message)
+        self._log(logging.WARNING, message, args, key)
 
-    def error(self, message: str):
+    def error(self, message: str, *args, key: Optional[str] = None):
         """Log error"""
-        self.logger.error(message)
+        self._log(logging.ERROR, message, args, key)
 
-    def debug(self, message: str):
+    def debug(self, message: str, *args, key: Optional[str] = None):
         """Log debug"""
-        self.logger.debug(message)
+        self._log(logging.DEBUG, message, args, key)
 
 logger = Logger()
@@ -0,0 +1,223 @@
+"""
+Extraction of the package size from product names
+
+Examples:
+    "Biscoito CLUB SOCIAL Original Pacote 144g" -> 144 G
+    "Cerveja Pilsen Corona Lata 350ml"           -> 350 ML
+    "Picanha Bovina a Vácuo Resfriada 1,7kg"     -> 1700 G
+    "Arroz Tipo 1 1.000 g"                       -> 1000 G
+    "Picanha Bovina 1.000kg"                     -> 1000 G (1,000 kg)
+    "Refrigerante Coca-Cola 6x2L"                -> 6 x 2000 ML
+    "Iogurte Natural c/ 4 unidades 170g"         -> 4 x 170 G
+
+The sizes are always in base units (G, ML or UN), and `normalize_measure` converts
+the sizes published by the markets (e.g. St Marche "1,2" KG) to the same units.
+
+Sizes that don't fit the quantity column of the stage (decimal(8,2)) are
+discarded, they can only come from a misread name.
+
+This module only depends on the standard library, so it can be imported both by
+the scrapers and by the transform step.
+"""
+
+import re
+from decimal import Decimal, InvalidOperation
+from functools import lru_cache
+from typing import Iterable, List, NamedTuple, Optional, Tuple
+
+# Unit found in the name -> (base unit, factor to convert to the base unit)
+UNITS = {
+    "mg": ("G", Decimal("0.001")),
+    "g": ("G", Decimal(1)),
+    "gr": ("G", Decimal(1)),
+    "grs": ("G", Decimal(1)),
+    "grama": ("G", Decimal(1)),
+    "gramas": ("G", Decimal(1)),
+    "kg": ("G", Decimal(1000)),
+    "kgs": ("G", Decimal(1000)),
+    "kilo": ("G", Decimal(1000)),
+    "kilos": ("G", Decimal(1000)),
+    "ml": ("ML", Decimal(1)),
+    "cc": ("ML", Decimal(1)),
+    "l": ("ML", Decimal(1000)),
+    "lt": ("ML", Decimal(1000)),
+    "lts": ("ML", Decimal(1000)),
+    "litro": ("ML", Decimal(1000)),
+    "litros": ("ML", Decimal(1000)),
+    "un": ("UN", Decimal(1)),
+    "und": ("UN", Decimal(1)),
+    "unid": ("UN", Decimal(1)),
+}
+
+# Largest quantity of stage_scraping_products.quantity, decimal(8,2)
+MAX_QUANTITY = Decimal("999999.99")
+
+_MEASURE_UNITS = "|".join(
+    sorted((unit for unit, (base, _) in UNITS.items() if base != "UN"), key=len, reverse=True)
+)
+
+# The names are lowercased before the search, so the patterns don't need IGNORECASE
+
+# [pack x] quantity unit -> "6x2L", "6 x 350ml", "1,7kg", "1.000 g", "500 g". The
+# numbers are only validated after the search: a pattern that starts with a plain
+# character set is several times faster to search than one with the exact formats.
+_MEASURE = re.compile(
+    r"(?P<first>[0-9][0-9.,]*)(?:\s*x\s*(?P<second>[0-9][0-9.,]*))?\s*"
+    rf"(?P<unit>{_MEASURE_UNITS})(?![a-z0-9])"
+)
+
+# pt-BR thousands separator first (1.000, 2.500,5), then 1, 1,7 or 1.5. The thousands
+# are only read in the base units: "1.000 g" is 1000 g, but "1.000kg" is 1 kg
+_NUMBER = re.compile(
+    r"(?P<thousands>[1-9][0-9]{0,2}(?:\.[0-9]{3})+(?:,[0-9]+)?)|[0-9]+(?:[.,][0-9]+)?"
+)
+
+_PACK_SIZE = re.compile(r"[0-9]{1,3}")
+
+# Number of units in the package -> "c/ 4", "com 12", "pack 6", "kit 3", "fardo 6", "caixa 12"
+_PACK = re.compile(r"\b(?:c/|com|pack|kit|fardo|caixa)\s*([0-9]{1,3})\b")
+
+# -> "12 unidades", "4 un"
+_PACK_UNITS = re.compile(r"(?<![\w.,])([0-9]{1,3})\s*(?:unidades|unidade|unid|und|un)\b")
+
+_DIGITS = frozenset("0123456789")
+
+# Purchase limits are not package sizes -> "(máx 24 unidades por cpf)"
+_PURCHASE_LIMIT = re.compile(r"\(m[aá]x[^)]*\)")
+
+
+class Measure(NamedTuple):
+    """Package size of a product, in base units (G, ML or UN)"""
+
+    quantity: Decimal
+    unit: str
+    pack: int = 1
+
+    @property
+    def total_quantity(self) -> Decimal:
+        """Quantity of all the units in the package"""
+        return self.quantity * self.pack
+
+
+@lru_cache(maxsize=4096)
+def _to_base_unit(quantity_text: str, unit_text: str) -> Optional[Tuple[Decimal, str]]:
+    """Quantity and unit as written in the name -> quantity in the base unit"""
+    unit, factor = UNITS[unit_text]
+    # Most sizes are whole numbers, which stay whole in the base unit (except mg)
+    if quantity_text.isdigit() and factor >= 1:
+        return Decimal(quantity_text) * factor, unit
+
+    number = _NUMBER.fullmatch(quantity_text)
+    if number is None:
+        return None
+    if number.group("thousands") and factor <= 1:
+        quantity_text = quantity_text.replace(".", "")
+
+    try:
+        quantity = Decimal(quantity_text.replace(",", "."))
+    except InvalidOperation:
+        return None
+
+    quantity = quantity * factor
+    if quantity == quantity.to_integral_value():
+        quantity = quantity.quantize(Decimal(1))
+    return quantity, unit
+
+
+def _find_pack(name: str) -> Optional[int]:
+    """Number of units of the package written in the name, None if it is not found"""
+    # Substring checks are much cheaper than the searches, and most names have no pack
+    if (
+        "c/" in name
+        or "com" in name
+        or "pack" in name
+        or "kit" in name
+        or "fardo" in name
+        or "caixa" in name
+    ):
+        match = _PACK.search(name)
+        if match:
+            return int(match.group(1)) or 1
+    if "un" in name:
+        match = _PACK_UNITS.search(name)
+        if match:
+            return int(match.group(1)) or 1
+    return None
+
+
+def _find_measure(name: str) -> Optional[Tuple[Optional[int], Decimal, str]]:
+    """(pack or None, base quantity, base unit) of the first valid size in the name"""
+    # A search loop, finditer is twice as slow for the one or two matches of a name
+    match = _MEASURE.search(name)
+    while match is not None:
+        start = match.start()
+        # Numbers that continue a word or another number are not sizes -> "b12", "1.5.2"
+        if not start or not (name[start - 1].isalnum() or name[start - 1] in "_.,"):
+            first, second, unit_text = match.groups()
+            if second is None:
+                base = _to_base_unit(first, unit_text)
+                if base is not None:
+                    return None, base[0], base[1]
+            elif _PACK_SIZE.fullmatch(first) is not None:
+                base = _to_base_unit(second, unit_text)
+                if base is not None:
+                    return int(first) or 1, base[0], base[1]
+        match = _MEASURE.search(name, match.end())
+    return None
+
+
+@lru_cache(maxsize=65536)
+def extract_measure(name: Optional[str]) -> Optional[Measure]:
+    """Extract the package size from a product name, None if it is not found"""
+    # Names without numbers don't have a size (most of the fruits and vegetables)
+    if not name or _DIGITS.isdisjoint(name):
+        return None
+
+    name = name.lower()
+    if "(" in name:
+        name = _PURCHASE_LIMIT.sub("", name)
+
+    pack = _find_pack(name)
+
+    measure = _find_measure(name)
+    if measure is None:
+        if pack is not None:
+            return Measure(Decimal(1), "UN", pack)
+        return None
+
+    measure_pack, quantity, unit = measure
+    measure = Measure(quantity, unit, measure_pack or pack or 1)
+    if measure.total_quantity > MAX_QUANTITY:
+        return None
+    return measure
+
+
+def extract_measures(names: Iterable[Optional[str]]) -> List[Optional[Measure]]:
+    """Extract the package size of a batch of product names"""
+    return [extract_measure(name) for name in names]
+
+
+def normalize_measure(quantity, unit: Optional[str]) -> Tuple[Optional[Decimal], Optional[str]]:
+    """
+    Convert a size published by a market to the base units of `extract_measure`
+
+    Examples:
+        (Decimal("1.2"), "KG") -> (1200, "G")
+        (Decimal("2"), "L")    -> (2000, "ML")
+        (Decimal("350"), "ML") -> (350, "ML")
+        (None, "UN")           -> (None, "UN")
+        (Decimal("5000"), "KG") -> (None, "G"), too large for the stage
+
+    Unknown units are returned as they are.
+    """
+    base = UNITS.get(unit.strip().lower()) if unit is not None else None
+    if base is not None:
+        unit, factor = base
+        if quantity is not None:
+            quantity = Decimal(str(quantity)) * factor
+            if quantity == quantity.to_integral_value():
+                quantity = quantity.quantize(Decimal(1))
+
+    if quantity is not None and Decimal(str(quantity)) > MAX_QUANTITY:
+        return None, unit
+    return quantity, unit
@@ -0,0 +1,185 @@
+"""
+Timers and counters of the hot paths of the scrapers
+
+    scraper_step_seconds   market, category, step (fetch, decode, parse, model,
+                           file_write, db_insert)
+    http_request_seconds   host, status ("error" when there is no response)
+    http_delay_seconds     host (random delay and rate limit waits)
+    db_connect_seconds     client
+    db_query_seconds       client, table, strategy
+    db_rows_total          client, table
+
+The measures are aggregated in memory per name and labels (count, sum, max),
+so recording one is a dict update under a lock. At the end of the run they are
+written as JSON lines (one line per series) and optionally in the Prometheus
+text format.
+"""
+
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+_Key = Tuple[str, Tuple[Tuple[str, str], ...]]
+
+
+def _key(name: str, labels: dict) -> _Key:
+    return name, tuple(sorted((label, str(value)) for label, value in labels.items()))
+
+
+class Metrics:
+    """Registry of the timers and counters of a process (shared by all threads)"""
+
+    def __init__(self):
+        self._timers: Dict[_Key, list] = {}
+        self._counters: Dict[_Key, float] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, name: str, seconds: float, count: int = 1, **labels):
+        """Record the time of count operations (a page of products can be recorded at once)"""
+        key = _key(name, labels)
+        with self._lock:
+            timer = self._timers.get(key)
+            if timer is None:
+                self._timers[key] = [count, seconds, seconds]
+            else:
+                timer[0] += count
+                timer[1] += seconds
+                timer[2] = max(timer[2], seconds)
+
+    def increment(self, name: str, value: float = 1, **labels):
+        key = _key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    @contextmanager
+    def timer(self, name: str, **labels):
+        """Time the block, also when it raises"""
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start_time, **labels)
+
+    def reset(self):
+        with self._lock:
+            self._timers.clear()
+            self._counters.clear()
+
+    def series(self) -> List[dict]:
+        """One entry per name and labels"""
+        with self._lock:
+            timers = [(key, list(values)) for key, values in self._timers.items()]
+            counters = list(self._counters.items())
+
+        series = []
+        for (name, labels), (count, total, maximum) in timers:
+            series.append(
+                {
+                    "type": "timer",
+                    "name": name,
+                    "labels": dict(labels),
+                    "count": count,
+                    "sum_seconds": round(total, 6),
+                    "max_seconds": round(maximum, 6),
+                }
+            )
+        for (name, labels), value in counters:
+            series.append({"type": "counter", "name": name, "labels": dict(labels), "value": value})
+        return series
+
+    def totals(self, name: str, by: str, **labels) -> Dict[str, float]:
+        """Seconds of a timer grouped by one label, only the series with the given labels"""
+        totals = {}
+        for entry in self.series():
+            if entry["name"] != name or entry["type"] != "timer":
+                continue
+            if any(entry["labels"].get(label) != str(value) for label, value in labels.items()):
+                continue
+            group = entry["labels"].get(by)
+            totals[group] = round(totals.get(group, 0) + entry["sum_seconds"], 6)
+        return totals
+
+    def write_jsonl(self, filename: str, **run_labels) -> str:
+        """Append the series to a JSON lines file, each line with the labels of the run"""
+        timestamp = datetime.now().replace(microsecond=0).isoformat()
+        lines = [
+            json.dumps(
+                dict(entry, labels={**run_labels, **entry["labels"]}, timestamp=timestamp),
+                ensure_ascii=False,
+            )
+            for entry in self.series()
+        ]
+
+        directory = os.path.dirname(filename)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # A single write, so the markets can append to the same file
+        with open(filename, "a", encoding="utf-8") as f:
+            f.write("".join(line + "\n" for line in lines))
+        return filename
+
+    def to_prometheus(self, **run_labels) -> str:
+        """Series in the Prometheus text format (timers as summaries)"""
+        lines = []
+        declared = set()
+        for entry in sorted(self.series(), key=lambda entry: entry["name"]):
+            name = entry["name"]
+            labels = _format_labels({**run_labels, **entry["labels"]})
+            if entry["type"] == "timer":
+                if name not in declared:
+                    lines.append(f"# TYPE {name} summary")
+                lines.append(f"{name}_count{labels} {entry['count']}")
+                lines.append(f"{name}_sum{labels} {entry['sum_seconds']}")
+            else:
+                if name not in declared:
+                    lines.append(f"# TYPE {name} counter")
+                lines.append(f"{name}{labels} {entry['value']}")
+            declared.add(name)
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, filename: str, **run_labels) -> str:
+        directory = os.path.dirname(filename)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(filename, "w", encoding="utf-8") as f:
+            f.write(self.to_prometheus(**run_labels))
+        return filename
+
+
+def _format_labels(labels: dict) -> str:
+    if not labels:
+        return ""
+    values = ",".join(
+        '{}="{}"'.format(
+            label, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        )
+        for label, value in sorted(labels.items())
+    )
+    return "{" + values + "}"
+
+
+# Registry of the process
+METRICS = Metrics()
+
+
+def peak_memory_mb() -> Optional[float]:
+    """Peak resident memory of the process, None where it is not available (Windows)"""
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def step_timer(market: str, category: Optional[str], step: str):
+    """Timer of a step of the scrapers (scraper_step_seconds), category None for the whole run"""
+    if category is None:
+        return METRICS.timer("scraper_step_seconds", market=market, step=step)
+    return METRICS.timer("scraper_step_seconds", market=market, category=category, step=step)
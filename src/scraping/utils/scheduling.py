@@ -0,0 +1,27 @@
+from typing import Dict, List, Optional
+
+
+def unknown_category_size(category_sizes: Dict[str, int]) -> int:
+    """Size given to the categories without a size in the last run, above every known one"""
+    return max(category_sizes.values(), default=0) + 1
+
+
+def order_largest_first(
+    categories: List[dict], category_sizes: Optional[Dict[str, int]] = None
+) -> List[dict]:
+    """
+    Sort the categories by their size in the last run, largest first.
+
+    Starting the longest jobs first (LPT scheduling) keeps the parallel workers
+    busy until the end and reduces the total run time. Unknown categories are
+    considered large, so new departments are not left for the end.
+    """
+    if not category_sizes:
+        return list(categories)
+
+    unknown_size = unknown_category_size(category_sizes)
+    return sorted(
+        categories,
+        key=lambda category: category_sizes.get(category["name"], unknown_size),
+        reverse=True,
+    )
@@ -0,0 +1,426 @@
+"""
+Work queue to distribute the scraping between several workers (processes or machines)
+
+The coordinator enqueues one unit per (market, category, page range) and the
+workers lease them. A leased unit must be renewed with heartbeats, if the worker
+dies the lease expires and another worker takes the unit. Failed units are
+retried up to max_attempts, and a retry first deletes the products staged by
+the previous attempt, so its pages are not inserted twice.
+
+The broker is a SQLite file, shared by the workers of the same machine (or of a
+network filesystem). Another broker only needs the same methods as WorkQueue.
+
+Usage:
+    python work_queue.py coordinator                       # enqueue all the markets
+    python work_queue.py coordinator --market tenda --pages-per-unit 20
+    python work_queue.py worker                            # lease units until the queue is empty
+    python work_queue.py worker --wait                     # keep waiting for new units
+    python work_queue.py status
+"""
+
+import argparse
+import importlib
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Iterable, List, Optional
+from orchestrator import MARKETS, configure_hosts, load_category_stats
+from utils.logger import Logger
+from utils.scheduling import unknown_category_size
+
+LOGGER = Logger("work_queue")
+
+QUEUE_FILE = "data/work_queue.sqlite"
+
+LEASE_SECONDS = 300
+MAX_ATTEMPTS = 3
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS work_units (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    run_id TEXT NOT NULL,
+    market TEXT NOT NULL,
+    category TEXT NOT NULL,
+    category_name TEXT NOT NULL,
+    first_page INTEGER NOT NULL,
+    last_page INTEGER,
+    pages_per_unit INTEGER,
+    extraction_date TEXT NOT NULL,
+    priority INTEGER NOT NULL DEFAULT 0,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    max_attempts INTEGER NOT NULL,
+    worker_id TEXT,
+    lease_expires_at REAL,
+    error TEXT,
+    result TEXT,
+    updated_at REAL NOT NULL,
+    UNIQUE (run_id, market, category_name, first_page)
+);
+CREATE INDEX IF NOT EXISTS work_units_status_idx ON work_units (status, priority DESC, id);
+"""
+
+
+class WorkQueue:
+    """
+    Queue of work units stored in SQLite.
+
+    Unit status: pending -> leased -> done | failed (pending again while it has attempts left)
+    """
+
+    def __init__(self, path: str = QUEUE_FILE, lease_seconds: int = LEASE_SECONDS):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with self._connect() as connection:
+            connection.executescript(_SCHEMA)
+
+    @contextmanager
+    def _connect(self):
+        # autocommit mode, the transactions are opened explicitly
+        connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        connection.row_factory = sqlite3.Row
+        try:
+            connection.execute("PRAGMA journal_mode=WAL")
+            yield connection
+        finally:
+            connection.close()
+
+    @contextmanager
+    def _transaction(self):
+        with self._connect() as connection:
+            # Takes the write lock at the beginning, so two workers never lease the same unit
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                yield connection
+                connection.execute("COMMIT")
+            except Exception:
+                connection.execute("ROLLBACK")
+                raise
+
+    def enqueue(
+        self,
+        run_id: str,
+        market: str,
+        category: dict,
+        extraction_date: str,
+        first_page: int = 1,
+        last_page: Optional[int] = None,
+        pages_per_unit: Optional[int] = None,
+        priority: int = 0,
+        max_attempts: int = MAX_ATTEMPTS,
+    ) -> bool:
+        """
+        Add a unit, False if the same unit was already enqueued in the run
+
+        last_page: None is the rest of the category, the worker splits it in
+            ranges of pages_per_unit pages (None to scrape it at once)
+        """
+        with self._transaction() as connection:
+            cursor = connection.execute(
+                """
+                INSERT OR IGNORE INTO work_units
+                    (run_id, market, category, category_name, first_page, last_page,
+                     pages_per_unit, extraction_date, priority, max_attempts, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                """,
+                (
+                    run_id,
+                    market,
+                    json.dumps(category, ensure_ascii=False),
+                    category["name"],
+                    first_page,
+                    last_page,
+                    pages_per_unit,
+                    extraction_date,
+                    priority,
+                    max_attempts,
+                    time.time(),
+                ),
+            )
+            return cursor.rowcount == 1
+
+    def lease(self, worker_id: str, markets: Optional[Iterable[str]] = None) -> Optional[dict]:
+        """Take the next unit (highest priority first), None if there is nothing to do"""
+        now = time.time()
+        markets = list(markets or [])
+        market_filter = (
+            f"AND market IN ({', '.join('?' for _ in markets)})" if markets else ""
+        )
+
+        with self._transaction() as connection:
+            # Expired leases without attempts left are not retried anymore
+            connection.execute(
+                """
+                UPDATE work_units
+                SET status = 'failed', error = 'lease expired', updated_at = ?
+                WHERE status = 'leased' AND lease_expires_at < ? AND attempts >= max_attempts
+                """,
+                (now, now),
+            )
+
+            row = connection.execute(
+                f"""
+                SELECT * FROM work_units
+                WHERE (status = 'pending' OR (status = 'leased' AND lease_expires_at < ?))
+                  AND attempts < max_attempts
+                  {market_filter}
+                ORDER BY priority DESC, id
+                LIMIT 1
+                """,
+                (now, *markets),
+            ).fetchone()
+            if row is None:
+                return None
+
+            connection.execute(
+                """
+                UPDATE work_units
+                SET status = 'leased', attempts = attempts + 1, worker_id = ?,
+                    lease_expires_at = ?, updated_at = ?
+                WHERE id = ?
+                """,
+                (worker_id, now + self.lease_seconds, now, row["id"]),
+            )
+
+        unit = dict(row)
+        unit["category"] = json.loads(unit["category"])
+        unit["attempts"] += 1
+        return unit
+
+    def heartbeat(self, unit_id: int, worker_id: str) -> bool:
+        """Renew the lease, False if the unit is not leased by this worker anymore"""
+        now = time.time()
+        with self._transaction() as connection:
+            cursor = connection.execute(
+                """
+                UPDATE work_units SET lease_expires_at = ?, updated_at = ?
+                WHERE id = ? AND worker_id = ? AND status = 'leased'
+                """,
+                (now + self.lease_seconds, now, unit_id, worker_id),
+            )
+            return cursor.rowcount == 1
+
+    def ack(self, unit_id: int, worker_id: str, result: Optional[dict] = None) -> bool:
+        """Mark the unit as done"""
+        with self._transaction() as connection:
+            cursor = connection.execute(
+                """
+                UPDATE work_units SET status = 'done', result = ?, error = NULL,
+                    lease_expires_at = NULL, updated_at = ?
+                WHERE id = ? AND worker_id = ? AND status = 'leased'
+                """,
+                (json.dumps(result, default=str), time.time(), unit_id, worker_id),
+            )
+            return cursor.rowcount == 1
+
+    def fail(self, unit_id: int, worker_id: str, error: str) -> bool:
+        """Release the unit to be retried, or mark it as failed without attempts left"""
+        with self._transaction() as connection:
+            cursor = connection.execute(
+                """
+                UPDATE work_units
+                SET status = CASE WHEN attempts >= max_attempts THEN 'failed' ELSE 'pending' END,
+                    error = ?, lease_expires_at = NULL, updated_at = ?
+                WHERE id = ? AND worker_id = ? AND status = 'leased'
+                """,
+                (error, time.time(), unit_id, worker_id),
+            )
+            return cursor.rowcount == 1
+
+    def stats(self, run_id: Optional[str] = None) -> dict:
+        """Number of units by status"""
+        with self._connect() as connection:
+            rows = connection.execute(
+                f"""
+                SELECT status, COUNT(*) AS units FROM work_units
+                {"WHERE run_id = ?" if run_id else ""}
+                GROUP BY status
+                """,
+                (run_id,) if run_id else (),
+            ).fetchall()
+        return {row["status"]: row["units"] for row in rows}
+
+    def failed_units(self, run_id: Optional[str] = None) -> List[dict]:
+        with self._connect() as connection:
+            rows = connection.execute(
+                f"""
+                SELECT id, run_id, market, category_name, first_page, last_page, attempts, error
+                FROM work_units WHERE status = 'failed' {"AND run_id = ?" if run_id else ""}
+                ORDER BY id
+                """,
+                (run_id,) if run_id else (),
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+
+def coordinate(
+    queue: WorkQueue,
+    markets: List[str],
+    run_id: Optional[str] = None,
+    pages_per_unit: Optional[int] = None,
+) -> str:
+    """Enqueue one unit per category of the markets, largest categories first"""
+    extraction_date = datetime.now().isoformat()
+    run_id = run_id or datetime.now().replace(microsecond=0).isoformat()
+    category_stats = load_category_stats()
+
+    for market in markets:
+        module = importlib.import_module(MARKETS[market])
+        category_sizes = category_stats.get(market, {})
+        # Same rule as order_largest_first: new categories are not left for the end
+        unknown_size = unknown_category_size(category_sizes)
+
+        enqueued = 0
+        for category in module.list_categories():
+            enqueued += queue.enqueue(
+                run_id,
+                market,
+                category,
+                extraction_date,
+                pages_per_unit=pages_per_unit,
+                priority=category_sizes.get(category["name"], unknown_size),
+            )
+        LOGGER.info("[%s] %d units enqueued for market '%s'", run_id, enqueued, market)
+
+    return run_id
+
+
+class _Heartbeat:
+    """Renews the lease of a unit in the background while the worker scrapes it"""
+
+    def __init__(self, queue: WorkQueue, unit_id: int, worker_id: str):
+        self.queue = queue
+        self.unit_id = unit_id
+        self.worker_id = worker_id
+        self.lost = False
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.queue.lease_seconds / 3):
+            if not self.queue.heartbeat(self.unit_id, self.worker_id):
+                LOGGER.warning(
+                    "Lease of unit %d lost by worker %s", self.unit_id, self.worker_id
+                )
+                self.lost = True
+                return
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+
+def work(
+    queue: WorkQueue,
+    worker_id: Optional[str] = None,
+    markets: Optional[List[str]] = None,
+    wait: bool = False,
+    poll_seconds: float = 10,
+) -> int:
+    """Lease and scrape units until the queue is empty (or forever with wait), return the units done"""
+    worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}"
+    configure_hosts()
+
+    LOGGER.info("Worker %s started", worker_id)
+    units_done = 0
+    while True:
+        unit = queue.lease(worker_id, markets)
+        if unit is None:
+            if not wait:
+                break
+            time.sleep(poll_seconds)
+            continue
+
+        LOGGER.info(
+            "[%s] Unit %d: %s '%s' pages %d-%s (attempt %d/%d)",
+            worker_id,
+            unit["id"],
+            unit["market"],
+            unit["category_name"],
+            unit["first_page"],
+            unit["last_page"] or "end",
+            unit["attempts"],
+            unit["max_attempts"],
+        )
+
+        module = importlib.import_module(MARKETS[unit["market"]])
+
+        try:
+            with _Heartbeat(queue, unit["id"], worker_id) as heartbeat:
+                result = module.run_unit(
+                    unit["category"],
+                    first_page=unit["first_page"],
+                    last_page=unit["last_page"],
+                    pages_per_unit=unit["pages_per_unit"],
+                    extraction_date=unit["extraction_date"],
+                    attempt=unit["attempts"],
+                )
+
+            if heartbeat.lost:
+                # Another worker has the unit now, its result is the one that counts
+                continue
+
+            errors = sum(stage["errors"] for stage in result["stages"])
+            if errors:
+                raise RuntimeError(f"{errors} errors in the pipeline stages")
+            if result["lost_pages"]:
+                raise RuntimeError(f"{len(result['lost_pages'])} pages lost after the retries")
+
+            # The rest of the category is split in new units
+            for first_page, last_page in result["remaining_ranges"]:
+                queue.enqueue(
+                    unit["run_id"],
+                    unit["market"],
+                    unit["category"],
+                    unit["extraction_date"],
+                    first_page=first_page,
+                    last_page=last_page,
+                    pages_per_unit=unit["pages_per_unit"],
+                    priority=unit["priority"],
+                    max_attempts=unit["max_attempts"],
+                )
+
+            queue.ack(unit["id"], worker_id, result)
+            units_done += 1
+        except Exception as e:
+            LOGGER.error("[%s] Unit %d failed: %s", worker_id, unit["id"], e)
+            queue.fail(unit["id"], worker_id, str(e))
+
+    LOGGER.info("Worker %s finished, %d units done", worker_id, units_done)
+    return units_done
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Distributed scraping work queue")
+    parser.add_argument("role", choices=["coordinator", "worker", "status"])
+    parser.add_argument("--queue", default=QUEUE_FILE, help="SQLite file of the queue")
+    parser.add_argument(
+        "--market", action="append", choices=sorted(MARKETS), help="market (default: all)"
+    )
+    parser.add_argument("--run-id", help="run of the units (default: now)")
+    parser.add_argument(
+        "--pages-per-unit", type=int, help="coordinator: split the categories in units of this many pages"
+    )
+    parser.add_argument("--wait", action="store_true", help="worker: wait for new units")
+    parser.add_argument("--worker-id", help="worker: name of the worker (default: host-pid)")
+    args = parser.parse_args()
+
+    work_queue = WorkQueue(args.queue)
+    if args.role == "coordinator":
+        coordinate(work_queue, args.market or list(MARKETS), args.run_id, args.pages_per_unit)
+    elif args.role == "worker":
+        work(work_queue, args.worker_id, args.market, wait=args.wait)
+    else:
+        print(json.dumps(work_queue.stats(args.run_id), indent=2))
+        for failed_unit in work_queue.failed_units(args.run_id):
+            print(json.dumps(failed_unit, ensure_ascii=False))
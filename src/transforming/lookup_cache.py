@@ -0,0 +1,125 @@
+import sys
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, Iterable, List, Optional
+
+# Marker for keys that were looked up in the database and do not exist there
+_MISSING = object()
+
+
+class LookupCache:
+    """
+    Bounded LRU cache for reference table lookups (supermarkets, brands, products...)
+
+    Keys are loaded lazily from the database through `loader`, which receives a list
+    of keys and returns a dict {key: value} with the ones that exist. Keys that are
+    not returned are cached as missing so they are not queried again until `put`.
+    The loader must raise on errors: an empty result means the keys don't exist.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        loader: Callable[[List[Hashable]], Dict[Hashable, Any]],
+        max_entries: int = 100_000,
+        max_bytes: Optional[int] = None,
+    ):
+        self.name = name
+        self.loader = loader
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+
+        self._entries: "OrderedDict[Hashable, Any]" = OrderedDict()
+        self._sizes: Dict[Hashable, int] = {}
+        self._bytes = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.loads = 0
+        self.evictions = 0
+
+    @staticmethod
+    def _entry_size(key, value) -> int:
+        """Approximate memory used by one entry"""
+        return sys.getsizeof(key) + (0 if value is _MISSING else sys.getsizeof(value))
+
+    def _store(self, key, value):
+        if key in self._entries:
+            self._bytes -= self._sizes[key]
+        size = self._entry_size(key, value)
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        self._sizes[key] = size
+        self._bytes += size
+        self._evict()
+
+    def _evict(self):
+        while self._entries and (
+            len(self._entries) > self.max_entries
+            or (self.max_bytes is not None and self._bytes > self.max_bytes)
+        ):
+            key, _ = self._entries.popitem(last=False)
+            self._bytes -= self._sizes.pop(key)
+            self.evictions += 1
+
+    def _load(self, keys: List[Hashable]):
+        self.loads += 1
+        found = self.loader(keys)
+        for key in keys:
+            self._store(key, found.get(key, _MISSING))
+
+    def prefetch(self, keys: Iterable[Hashable]) -> None:
+        """Load in a single query all the keys that are not cached yet"""
+        missing_keys = [key for key in dict.fromkeys(keys) if key not in self._entries]
+        if missing_keys:
+            self._load(missing_keys)
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """Get the value of a key, querying the database if it is not cached"""
+        if key in self._entries:
+            self.hits += 1
+            self._entries.move_to_end(key)
+        else:
+            self.misses += 1
+            self._load([key])
+
+        value = self._entries.get(key, _MISSING)
+        return default if value is _MISSING else value
+
+    def __contains__(self, key: Hashable) -> bool:
+        return self.get(key, _MISSING) is not _MISSING
+
+    def put(self, key: Hashable, value: Any) -> None:
+        """Add a value created by the transform (e.g. a new inserted id)"""
+        self._store(key, value)
+
+    def discard(self, keys: Iterable[Hashable]) -> None:
+        """Forget some keys so the next lookup goes to the database again"""
+        for key in keys:
+            if key in self._entries:
+                del self._entries[key]
+                self._bytes -= self._sizes.pop(key)
+
+    def clear(self) -> None:
+        """Forget every key (e.g. after a rollback left inserted ids invalid)"""
+        self._entries.clear()
+        self._sizes.clear()
+        self._bytes = 0
+
+    def missing_keys(self, keys: Iterable[Hashable]) -> List[Hashable]:
+        """Keys that are cached as not existing in the database"""
+        return [
+            key for key in dict.fromkeys(keys) if self._entries.get(key) is _MISSING
+        ]
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "name": self.name,
+            "entries": len(self._entries),
+            "approx_bytes": self._bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "loads": self.loads,
+            "evictions": self.evictions,
+        }
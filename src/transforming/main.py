@@ -1,256 +1,588 @@
-from sql_client import create_query_client
+import argparse
+import multiprocessing
+import os
+import sys
+from sql_client import close_pool, create_query_client
 from logger import Logger
-from utils import normalize_word
+from lookup_cache import LookupCache
+from offers import OFFER_MAX_AGE_HOURS, build_offer, expire_offers, update_offers
+from queries import QUERIES, PRODUCTS_INDEX_QUERY
+from product_matcher import ProductMatcher
+from utils import normalize_many, group_discounts_by_product
+
+# The package size grammar is shared with the scrapers
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scraping", "utils"))
+from measures import extract_measure, normalize_measure
 
 
 LOGGER = Logger("query_examples")
-client = create_query_client("custom_queries")
 
-# Checking the supermarkets in the supermarkets table
-supermarkets_created_query = """
-    SELECT id, name 
-    FROM supermarkets
-    GROUP BY id, name;
-    """
-supermarkets_created_raw = client.execute_query(supermarkets_created_query)
-supermarkets_created = {row["name"]: row["id"] for row in supermarkets_created_raw}
-
-# Checking the brands in the brands table
-brands_created_query = """
-    SELECT id, normalized_name 
-    FROM brands
-    GROUP BY id, normalized_name;
-    """
-brands_created_raw = client.execute_query(brands_created_query)
-brands_created = {row["normalized_name"]: row["id"] for row in brands_created_raw}
-
-# Checking the url in the raw_product_data table
-raw_product_data_query = """
-    SELECT product_id, product_url 
-    FROM raw_product_data
-    GROUP BY product_id, product_url;
-    """
-raw_product_data_raw = client.execute_query(raw_product_data_query)
-raw_product_data = {row["product_url"]: row["product_id"] for row in raw_product_data_raw}
-
-# Checking the products in the products table
-products_created_query = """
-    SELECT id, normalized_name 
-    FROM products
-    GROUP BY id, normalized_name;
+# Query client of the process. Created by _connect in main and again in each worker,
+# so the connections and their prepared statements are never shared across a fork
+client = None
+
+CHUNK_SIZE = 500
+
+# A worker stops after this many consecutive failed chunks (avoids looping on bad rows)
+MAX_CHUNK_FAILURES = 3
+
+# Columns created by the migrations the transform depends on (doc/migrations)
+REQUIRED_COLUMNS = {
+    "001_prices_validity_interval.sql": ("prices", "valid_to"),
+    "002_current_and_best_offers.sql": ("current_prices", "best_value"),
+}
+
+# Upper bounds for the lookup caches (number of entries / approximate bytes)
+CACHE_MAX_ENTRIES = 200_000
+CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+
+def _load_supermarkets(names):
+    rows = client.execute_named("load_supermarkets", (names,))
+    return {row["name"]: row["id"] for row in rows}
+
+
+def _load_brands(normalized_names):
+    rows = client.execute_named("load_brands", (normalized_names,))
+    return {row["normalized_name"]: row["id"] for row in rows}
+
+
+def _load_raw_product_data(product_urls):
+    rows = client.execute_named("load_raw_product_data", (product_urls,))
+    return {row["product_url"]: row["product_id"] for row in rows}
+
+
+def _load_products(normalized_names):
+    rows = client.execute_named("load_products", (normalized_names,))
+    return {row["normalized_name"]: row["id"] for row in rows}
+
+
+def _load_prices(keys):
+    # keys are (id_supermarket, id_product, extraction_date)
+    id_supermarkets, id_products, extraction_dates = (list(column) for column in zip(*keys))
+    rows = client.execute_named("load_prices", (id_supermarkets, id_products, extraction_dates))
+    return {
+        (row["id_supermarket"], row["id_product"], row["extraction_date"]): row["id"]
+        for row in rows
+    }
+
+
+def _load_latest_prices(keys):
+    # keys are (id_supermarket, id_product), returns the last price registered for each one
+    id_supermarkets, id_products = (list(column) for column in zip(*keys))
+    rows = client.execute_named("load_latest_prices", (id_supermarkets, id_products))
+    if not rows:
+        return {}
+
+    discounts_by_price = {}
+    for discount in client.execute_named("load_latest_price_discounts", ([row["id"] for row in rows],)):
+        discounts_by_price.setdefault(discount["id_price"], []).append(
+            (discount["unit_value"], discount["condition_type"], discount["min_qty"], discount["multiple_qty"])
+        )
+
+    return {
+        (row["id_supermarket"], row["id_product"]): {
+            **row,
+            "discounts": _discounts_signature(discounts_by_price.get(row["id"], [])),
+        }
+        for row in rows
+    }
+
+
+def _create_caches():
+    return {
+        name: LookupCache(name, loader, CACHE_MAX_ENTRIES, CACHE_MAX_BYTES)
+        for name, loader in (
+            ("supermarkets", _load_supermarkets),
+            ("brands", _load_brands),
+            ("raw_product_data", _load_raw_product_data),
+            ("products", _load_products),
+            ("prices", _load_prices),
+            ("latest_prices", _load_latest_prices),
+        )
+    }
+
+
+def _create_product_matcher():
+    # Indexing every registered product name for the fuzzy matching
+    matcher = ProductMatcher()
+    for batch in client.iter_query(PRODUCTS_INDEX_QUERY, chunk_size=50_000):
+        matcher.add_many(batch)
+    LOGGER.info("Product matcher ready with %d products", len(matcher))
+    return matcher
+
+
+def _claim_scraped_products(db, market, chunk_size):
+    # Claiming products scraped to be processed. The rows stay locked until the
+    # transaction ends, and SKIP LOCKED makes other workers take the next ones
+    return db.execute_named("claim_scraped_products", (market, chunk_size))
+
+
+def _load_scraped_discounts(db, scraped_product_ids):
+    # Checking discounts scraped to be processed (only for the current batch of products)
+    if not scraped_product_ids:
+        return []
+
+    return db.execute_named("load_scraped_discounts", (scraped_product_ids,))
+
+
+def _lock_new_keys(db, caches, rows):
     """
-products_created_raw = client.execute_query(products_created_query)
-products_created = {row["normalized_name"]: row["id"] for row in products_created_raw}
-
-# Checking the prices registered in the price table
-price_created_query = """
-    SELECT id_supermarket, id_product, extraction_date 
-    FROM prices
-    GROUP BY id_supermarket, id_product, extraction_date;
+    Serialize the creation of supermarkets, brands, products and urls between workers.
+
+    The keys that don't exist yet are locked (in a fixed order, so workers can't
+    deadlock) until the transaction ends. After getting the locks they are looked
+    up again because another worker may have created them in the meantime.
     """
-price_created_raw = client.execute_query(price_created_query)
-price_created = {(row["id_supermarket"], row["id_product"], row["extraction_date"]) for row in price_created_raw}
-
-
-# Checking products scraped to be processed
-scraped_products_query = """
-        SELECT p.*
-        FROM stage_scraping_products p
-        WHERE p.market = 'tenda'
-        --AND length(p.id::text) > 5
-        AND p.is_processed = false
-        --AND p.id = 619600713277767680
-        ORDER BY p.source_id DESC
-        LIMIT 100;
-        """
-scraped_products=client.execute_query(scraped_products_query)
-
-# Checking discounts scraped to be processed
-scraped_discounts_query = """
-        SELECT id
-            ,product_id
-            ,type
-            ,discounted_price
-            ,conditions_text
-            ,conditions_min_quantity
-            ,conditions_buy_quantity
-            ,conditions_get_quantity
-            ,created_at
-        FROM stage_discounts;
-        """
-scraped_discounts=client.execute_query(scraped_discounts_query)
-
-
-for scraped_product in scraped_products:
-    print(scraped_product)
-    _id = scraped_product["id"]
-    name = scraped_product["name"]
-    normalized_name = normalize_word(scraped_product["name"])
-    market = normalize_word(scraped_product["market"])
-    category = scraped_product["category"]
-    brand = scraped_product["brand"]
-    normalized_brand = normalize_word(scraped_product["brand"])
-    product_url = scraped_product["product_url"]
-    source_id = scraped_product["source_id"]
-    price = scraped_product["price"]
-    quantity = scraped_product["quantity"]
-    unit = scraped_product["unit_of_measure"]
-    extraction_url = scraped_product["extraction_url"]
-    extraction_date = scraped_product["extraction_date"]
-    currency = scraped_product["currency"]
-    #created_at = scraped_product["created_at"]
-
-## Product
+    new_keys = {
+        "supermarkets": caches["supermarkets"].missing_keys(row["normalized_market"] for row in rows),
+        "raw_product_data": caches["raw_product_data"].missing_keys(row["product_url"] for row in rows),
+        "brands": caches["brands"].missing_keys(_brand_keys(rows)),
+        "products": caches["products"].missing_keys(row["normalized_name"] for row in rows),
+    }
+    lock_names = sorted(f"{name}:{key}" for name, keys in new_keys.items() for key in keys)
+    if not lock_names:
+        return
+
+    db.execute_named("lock_keys", (lock_names,))
+
+    for name, keys in new_keys.items():
+        caches[name].discard(keys)
+        caches[name].prefetch(keys)
+
+
+def _get_supermarket_id(db, caches, market):
+    # Checking if the supermarket is in the supermarkets table
+    id_supermarket = caches["supermarkets"].get(market)
+    if id_supermarket is None:
+        # Inserting the supermarket in the supermarkets table
+        new_supermarket = db.execute_named("insert_supermarket", (market,))
+        id_supermarket = new_supermarket[0]["id"]
+
+        # Add to the cache to avoid re-insertion
+        caches["supermarkets"].put(market, id_supermarket)
+        LOGGER.debug("Inserted supermarket %s with id %s.", market, id_supermarket)
+    return id_supermarket
+
+
+def _brand_keys(rows):
+    # Some markets don't publish the brand (St Marche), those products have no brand
+    return (row["normalized_brand"] for row in rows if row["normalized_brand"] is not None)
+
+
+def _get_brand_id(db, caches, brand, normalized_brand):
+    if normalized_brand is None:
+        return None
+
+    # Checking if the brand is in the brands table
+    id_brand = caches["brands"].get(normalized_brand)
+    if id_brand is None:
+        # Inserting the brand in the brands table
+        new_brand = db.execute_named("insert_brand", (brand, normalized_brand))
+        id_brand = new_brand[0]["id"]
+
+        # Add to the cache to avoid re-insertion
+        caches["brands"].put(normalized_brand, id_brand)
+        LOGGER.debug("Inserted brand %s with id %s.", brand, id_brand)
+    return id_brand
+
+
+def _get_product_id(db, caches, row, matcher=None):
+    product_url = row["product_url"]
+
     # Checking if the product_url is in the raw_product_data table
-    if product_url not in raw_product_data:
-        print(f"Product_url {product_url} not found in the raw_product_data table.")
-
-    ## Supermarket   
-        # Checking if the supermarket is in the supermarkets table
-        if market not in supermarkets_created:
-            # Inserting the supermarket in the supermarkets table
-            supermarket_query = """
-                INSERT INTO supermarkets (name)
-                VALUES (%s)
-                RETURNING id;
-                """
-            new_supermarket = client.execute_non_query(supermarket_query, (market,))
-            id_supermarket = new_supermarket[0]["id"]
-
-            # Add to local dictionary to avoid re-insertion
-            supermarkets_created[market] = id_supermarket
-            print(f"Inserted supermarket {market} with id {id_supermarket}.")
-        else:
-            # Get the id of the existing supermarket
-            id_supermarket = supermarkets_created[market]
-            print(f"Supermarket {market} already exists with id {id_supermarket}.")
-
-    ## Brand
-        # Checking if the brand is in the brands table
-        if normalized_brand not in brands_created:
-            # Inserting the brand in the brands table
-            brand_query = """
-                INSERT INTO brands (name, normalized_name)
-                VALUES (%s, %s)
-                RETURNING id;
-                """
-            new_brand = client.execute_non_query(brand_query, (brand, normalized_brand))
-            id_brand = new_brand[0]["id"]
-
-            # Add to local dictionary to avoid re-insertion
-            brands_created[normalized_brand] = id_brand
-            print(f"Inserted brand {brand} with id {id_brand}.")
-        else:
-            # Get the id of the existing brand
-            id_brand = brands_created[normalized_brand]
-            print(f"Brand {brand} already exists with id {id_brand}.")
+    id_product = caches["raw_product_data"].get(product_url)
+    if id_product is not None:
+        LOGGER.debug("Product_url %s already exists with product id %s.", product_url, id_product)
+        return id_product
+
+    id_brand = _get_brand_id(db, caches, row["brand"], row["normalized_brand"])
 
     ## Unit of measurement
         # Checking if the unit of measurement is in the units_of_measure table PENDING
 
-## Product
-    
-        # Checking if the product is already in the products table
-        if normalized_name not in products_created:
-            # Inserting the product in the products table
-            product_query = """
-                INSERT INTO products (name, normalized_name, quantity, id_brand)
-                VALUES (%s, %s, %s, %s)
-                RETURNING id;
-                """
-            new_product = client.execute_non_query(product_query, (name, normalized_name, quantity, id_brand))
-            id_product = new_product[0]["id"]
-
-            # Add to local dictionary to avoid re-insertion
-            products_created[normalized_name] = id_product
-            print(f"Inserted product {name} with id {id_product}.")
-        
-        else:
-            # Get the id of the existing product
-            id_product = products_created[normalized_name]
-            print(f"Product {name} already exists with id {id_product}.")
-    
-                
-        # Inserting the product_url in the raw_product_data table
-        raw_product_data_query = """
-                    INSERT INTO raw_product_data (original_name, product_url, product_id, extraction_date, market)
-                    VALUES (%s, %s, %s, %s, %s)
-                    """
-        client.execute_non_query(raw_product_data_query, (name, product_url, id_product, extraction_date, market))
-
-        # Add to local dictionary to avoid re-insertion
-        raw_product_data[product_url] = product_url
-        print(f"Inserted product_url {product_url} with product_id {id_product}.")
-    
-    else:
-        # Get the id of the existing product_url
-        #id_product_url = raw_product_data[product_url]
-        print(f"Product_url {product_url} already exists with product id {id_product}.")
-
-## Price
-    if (id_supermarket, id_product, extraction_date) in price_created:
-        print(f"Price {price} already exists with id_supermarket {id_supermarket}, id_product {id_product} and extraction_date {extraction_date}.")
+    # Checking if the product is already in the products table
+    id_product = caches["products"].get(row["normalized_name"])
+    if id_product is None and matcher is not None:
+        # Checking if the same product is registered with a similar name
+        match = matcher.match(row["normalized_name"])
+        if match is not None:
+            id_product, score = match
+            caches["products"].put(row["normalized_name"], id_product)
+            LOGGER.debug("Product %s matched product id %s (score %.2f).", row["name"], id_product, score)
+
+    if id_product is None:
+        # Inserting the product in the products table
+        new_product = db.execute_named(
+            "insert_product", (row["name"], row["normalized_name"], row["quantity"], id_brand)
+        )
+        id_product = new_product[0]["id"]
+
+        # Add to the cache to avoid re-insertion
+        caches["products"].put(row["normalized_name"], id_product)
+        if matcher is not None:
+            matcher.add(id_product, row["normalized_name"])
+        LOGGER.debug("Inserted product %s with id %s.", row["name"], id_product)
+
+    # Inserting the product_url in the raw_product_data table
+    db.execute_named(
+        "insert_raw_product_data",
+        (row["name"], product_url, id_product, row["extraction_date"], row["normalized_market"]),
+    )
+
+    # Add to the cache to avoid re-insertion
+    caches["raw_product_data"].put(product_url, id_product)
+    LOGGER.debug("Inserted product_url %s with product_id %s.", product_url, id_product)
+    return id_product
+
+
+def _build_discounts(product_discounts):
+    """Convert the staged discounts into (unit_value, condition_type, min_qty, multiple_qty)"""
+    discounts = []
+    # Processing each discount found
+    for discount in product_discounts:
+        # Extracting the discount data
+        discount_type = discount['type']
+        discounted_price = discount['discounted_price']
+        conditions_text = discount['conditions_text']
+        conditions_min_quantity = discount['conditions_min_quantity']
+        conditions_buy_quantity = discount['conditions_buy_quantity']
+        conditions_get_quantity = discount['conditions_get_quantity']
+
+        # Calculating the unit price (only these types are registered until the
+        # unit price of the others is defined)
+        if discount_type in ['WHOLESALE', 'CARD'] and conditions_text is None:
+            unit_value = discounted_price
+            multiple_qty = 1
+            discounts.append((unit_value, discount_type, conditions_min_quantity, multiple_qty))
+        #elif discount_type == 'BUY_X_GET_Y' and conditions_text is not None:
+        #    unit_price = discounted_price / conditions_buy_quantity
+        # else:
+        #    unit_price = discounted_price
+    return discounts
+
+
+def _discounts_signature(discounts):
+    # Order independent representation used to compare the discounts of two prices
+    return tuple(sorted(discounts, key=repr))
+
+
+def _insert_discounts(db, id_price, id_product, discounts):
+    for unit_value, discount_type, min_qty, multiple_qty in discounts:
+        # Inserting the discount in the discounts table
+        db.execute_named("insert_discount", (id_price, unit_value, discount_type, min_qty, multiple_qty))
+        LOGGER.debug("Inserted discount %s (type: %s) for product %s.", unit_value, discount_type, id_product)
+
+
+def _is_unchanged_price(latest_price, extraction_date, price, currency, discounts):
+    return (
+        latest_price is not None
+        and latest_price["extraction_date"] <= extraction_date
+        and latest_price["value"] == price
+        and latest_price["currency"] == currency
+        and latest_price["discounts"] == _discounts_signature(discounts)
+    )
+
+
+def _extend_price_validity(db, caches, latest_key, latest_price, extraction_date):
+    # The price didn't change since the last run: only the end of its validity moves
+    if latest_price["valid_to"] is not None and latest_price["valid_to"] >= extraction_date:
+        return
+
+    db.execute_named("extend_price_validity", (extraction_date, latest_price["id"], extraction_date))
+    caches["latest_prices"].put(latest_key, {**latest_price, "valid_to": extraction_date})
+    LOGGER.debug(
+        "Price %s with id %s is still valid at %s.", latest_price["value"], latest_price["id"], extraction_date
+    )
+
+
+def _insert_price(db, caches, row, discounts_by_product, delta=False):
+    """Register the price of a staged row, returns its offer (None if it was already registered)"""
+    price_key = (row["id_supermarket"], row["id_product"], row["extraction_date"])
+    latest_key = (row["id_supermarket"], row["id_product"])
+    price = row["price"]
+
+    ## Price
+    if caches["prices"].get(price_key) is not None:
+        LOGGER.debug(
+            "Price %s already exists with id_supermarket %s, id_product %s and extraction_date %s.",
+            price,
+            *price_key,
+        )
         # Products in distinct categories at the same supermarket and extraction date
-    else:
-        # Defining the currency
-        if currency is None:
-            currency = 'BRL'
-
-        # Inserting the price in the prices table
-        price_query = """
-            INSERT INTO prices (id_supermarket, id_product, extraction_date, value, currency)
-            VALUES (%s, %s, %s, %s, %s)
-            RETURNING id;
-            """
-        new_price=client.execute_non_query(price_query, (id_supermarket, id_product, extraction_date, price, currency))
-        id_price = new_price[0]["id"]
-
-        # Add to local dictionary to avoid re-insertion
-        price_created.add((id_supermarket, id_product, extraction_date))
-
-        print(f"Inserted price {price} with id_supermarket {id_supermarket}, id_product {id_product} and extraction_date {extraction_date}.")
-
-        # Checking if the product has discounts to be processed
-        product_discounts = [discount for discount in scraped_discounts if discount['product_id'] == _id]
-
-        if product_discounts:
-            print(f"Product {name} has {len(product_discounts)} discount(s) to be processed.")
-            
-            # Processing each discount found
-            for discount in product_discounts:
-                # Extracting the discount data
-                discount_type = discount['type']
-                discounted_price = discount['discounted_price']
-                conditions_text = discount['conditions_text']
-                conditions_min_quantity = discount['conditions_min_quantity']
-                conditions_buy_quantity = discount['conditions_buy_quantity']
-                conditions_get_quantity = discount['conditions_get_quantity']
-                
-                # Calculating the unit price
-                if discount_type in ['WHOLESALE', 'CARD'] and conditions_text is None:
-                    unit_value = discounted_price
-                    multiple_qty = 1
-                #elif discount_type == 'BUY_X_GET_Y' and conditions_text is not None:
-                #    unit_price = discounted_price / conditions_buy_quantity
-               # else:
-                #    unit_price = discounted_price
-
-                # Inserting the discount in the discounts table
-                discount_query = """
-                    INSERT INTO discounts (id_price, unit_value, condition_type, min_qty, multiple_qty)
-                    VALUES (%s, %s, %s, %s, %s)
-                    """
-                client.execute_non_query(discount_query, (id_price, unit_value, discount_type,conditions_min_quantity, multiple_qty))
-                print(f"Inserted discount {unit_value} (type: {discount_type}) for product {id_product}.")
+        return None
+
+    # Defining the currency
+    currency = row["currency"] or 'BRL'
+
+    # Checking if the product has discounts to be processed
+    discounts = _build_discounts(discounts_by_product.get(row["id"], []))
+
+    if delta:
+        latest_price = caches["latest_prices"].get(latest_key)
+        if _is_unchanged_price(latest_price, row["extraction_date"], price, currency, discounts):
+            _extend_price_validity(db, caches, latest_key, latest_price, row["extraction_date"])
+            return build_offer(
+                latest_price["id"], row, price, currency, discounts, latest_price["extraction_date"]
+            )
+
+    # Inserting the price in the prices table. Another worker may have inserted the
+    # same (supermarket, product, date) from a different stage row, so conflicts are skipped
+    new_price = db.execute_named("insert_price", (*price_key, row["extraction_date"], price, currency))
+    if not new_price:
+        LOGGER.debug(
+            "Price %s with id_supermarket %s, id_product %s and extraction_date %s was inserted by another worker.",
+            price,
+            *price_key,
+        )
+        return None
+    id_price = new_price[0]["id"]
+
+    # Add to the cache to avoid re-insertion
+    caches["prices"].put(price_key, id_price)
+    if delta:
+        caches["latest_prices"].put(
+            latest_key,
+            {
+                "id": id_price,
+                "extraction_date": row["extraction_date"],
+                "valid_to": row["extraction_date"],
+                "value": price,
+                "currency": currency,
+                "discounts": _discounts_signature(discounts),
+            },
+        )
+    LOGGER.debug(
+        "Inserted price %s with id_supermarket %s, id_product %s and extraction_date %s.",
+        price,
+        *price_key,
+    )
+
+    if discounts:
+        LOGGER.debug("Product %s has %d discount(s) to be processed.", row["name"], len(discounts))
+        _insert_discounts(db, id_price, row["id_product"], discounts)
+
+    return build_offer(id_price, row, price, currency, discounts)
+
+
+def process_chunk(db, caches, scraped_products, matcher=None, delta=False):
+    """Transform one chunk of staged products into the final tables"""
+    discounts_by_product = group_discounts_by_product(
+        _load_scraped_discounts(db, [scraped_product["id"] for scraped_product in scraped_products])
+    )
+
+    rows = [dict(scraped_product) for scraped_product in scraped_products]
+    for column in ("name", "market", "brand"):
+        for row, normalized in zip(rows, normalize_many([row[column] for row in rows])):
+            row[f"normalized_{column}"] = normalized
+
+    # Filling the size of the products staged without it, in the same base units
+    # for every market (older St Marche rows were staged in KG)
+    for row in rows:
+        if row["quantity"] is not None:
+            row["quantity"], row["unit_of_measure"] = normalize_measure(
+                row["quantity"], row["unit_of_measure"]
+            )
         else:
-            print(f"Product {name} has no discounts to be processed.")
-
-    #Update the field is_processed in the stage_scraping_products table
-    stage_scraping_products_query = """
-        UPDATE stage_scraping_products
-        SET is_processed = true
-        WHERE id = %s
-        """
-    client.execute_non_query(stage_scraping_products_query, (_id,))
-    print(f"Updated field is_processed in the stage_scraping_products table for product {_id}.")
-    
\ No newline at end of file
+            measure = extract_measure(row["name"])
+            if measure is not None:
+                row["quantity"] = measure.total_quantity
+                row["unit_of_measure"] = measure.unit
+
+    # Prefetching only the keys needed by this chunk
+    caches["supermarkets"].prefetch(row["normalized_market"] for row in rows)
+    caches["raw_product_data"].prefetch(row["product_url"] for row in rows)
+    caches["brands"].prefetch(_brand_keys(rows))
+    caches["products"].prefetch(row["normalized_name"] for row in rows)
+
+    _lock_new_keys(db, caches, rows)
+
+    ## Supermarket / Brand / Product
+    for row in rows:
+        row["id_supermarket"] = _get_supermarket_id(db, caches, row["normalized_market"])
+        row["id_product"] = _get_product_id(db, caches, row, matcher)
+
+    caches["prices"].prefetch(
+        (row["id_supermarket"], row["id_product"], row["extraction_date"]) for row in rows
+    )
+
+    if delta:
+        caches["latest_prices"].prefetch(
+            (row["id_supermarket"], row["id_product"]) for row in rows
+        )
+
+    offers = []
+    for row in rows:
+        offer = _insert_price(db, caches, row, discounts_by_product, delta)
+        if offer is not None:
+            offers.append(offer)
+
+    #Update the field is_processed in the stage_scraping_products table (whole chunk, same transaction)
+    db.execute_named("mark_scraped_products_processed", ([row["id"] for row in rows],))
+    LOGGER.debug("Updated field is_processed in the stage_scraping_products table for %d products.", len(rows))
+
+    # Keeping the cheapest offer per product up to date with the new prices
+    update_offers(db, offers)
+
+
+def _connect():
+    """Create the query client (and on first use the connection pool) of this process"""
+    global client
+    client = create_query_client("custom_queries", QUERIES)
+
+
+def _disconnect():
+    """Close the connections of this process, before forking the workers"""
+    global client
+    client = None
+    close_pool()
+
+
+def _check_schema():
+    """Stop with a clear message if the migrations needed by the transform were not applied"""
+    tables = sorted({table for table, _ in REQUIRED_COLUMNS.values()})
+    columns = {
+        (row["table_name"], row["column_name"])
+        for row in client.execute_named("load_schema_columns", (tables,))
+    }
+    missing = [migration for migration, column in REQUIRED_COLUMNS.items() if column not in columns]
+    if missing:
+        LOGGER.error("Missing database migrations, apply them before the transform: %s", ", ".join(
+            f"doc/migrations/{migration}" for migration in missing
+        ))
+        sys.exit(1)
+
+
+def _get_pending_markets():
+    return sorted(row["market"] for row in client.execute_named("load_pending_markets"))
+
+
+def run_worker(worker_id, markets, chunk_size=CHUNK_SIZE, fuzzy_match=False, delta=False):
+    """Claim and transform chunks of the given markets until none is left"""
+    _connect()
+    caches = _create_caches()
+    matcher = _create_product_matcher() if fuzzy_match else None
+    total_processed = 0
+
+    for market in markets:
+        failures = 0
+        while failures < MAX_CHUNK_FAILURES:
+            try:
+                with client.transaction() as db:
+                    scraped_products = _claim_scraped_products(db, market, chunk_size)
+                    if scraped_products:
+                        process_chunk(db, caches, scraped_products, matcher, delta)
+            except Exception as error:
+                # The ids inserted in the rolled back transaction are not valid anymore
+                for cache in caches.values():
+                    cache.clear()
+                if matcher is not None:
+                    matcher = _create_product_matcher()
+                failures += 1
+                LOGGER.error(
+                    "[worker %d] Error processing a chunk of market '%s': %s", worker_id, market, error
+                )
+                continue
+
+            if not scraped_products:
+                break
+
+            failures = 0
+            total_processed += len(scraped_products)
+            LOGGER.info(
+                "[worker %d] Processed %d staged products (market '%s')", worker_id, total_processed, market
+            )
+
+    for cache in caches.values():
+        stats = cache.stats()
+        LOGGER.info(
+            "[worker %d] Cache '%s': %d entries (~%d KB), hit rate %.1f%%, %d loads, %d evictions",
+            worker_id,
+            stats["name"],
+            stats["entries"],
+            stats["approx_bytes"] // 1024,
+            stats["hit_rate"] * 100,
+            stats["loads"],
+            stats["evictions"],
+        )
+    return total_processed
+
+
+def expire_missing_offers(markets, max_age_hours=OFFER_MAX_AGE_HOURS):
+    """Close the offers of the products that the last scrapes of each market don't contain"""
+    for market, normalized_market in zip(markets, normalize_many(markets)):
+        try:
+            with client.transaction() as db:
+                expired = expire_offers(db, normalized_market, max_age_hours)
+        except Exception as error:
+            LOGGER.error("Error closing the missing offers of market '%s': %s", market, error)
+            continue
+        if expired:
+            LOGGER.info("Closed the offers of %d products not seen anymore in market '%s'", expired, market)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Transform the staged scraping products")
+    parser.add_argument("--market", action="append", help="market to process (default: all pending)")
+    parser.add_argument("--workers", type=int, default=1, help="number of worker processes")
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE)
+    parser.add_argument(
+        "--fuzzy-match",
+        action="store_true",
+        help="match new names to existing products with similar names",
+    )
+    parser.add_argument(
+        "--price-mode",
+        choices=("full", "delta"),
+        default="full",
+        help="delta only inserts prices that changed since the last known value",
+    )
+    parser.add_argument(
+        "--offer-max-age-hours",
+        type=float,
+        default=OFFER_MAX_AGE_HOURS,
+        help="close the current prices not seen for this long before the last scrape of their market",
+    )
+    args = parser.parse_args()
+
+    _connect()
+    _check_schema()
+
+    delta = args.price_mode == "delta"
+    markets = args.market or _get_pending_markets()
+    if not markets:
+        LOGGER.info("No staged products to process")
+        return
+
+    if args.workers <= 1:
+        run_worker(0, markets, args.chunk_size, args.fuzzy_match, delta)
+        expire_missing_offers(markets, args.offer_max_age_hours)
+        return
+
+    # The connections of this process can't be shared with the workers, each
+    # one opens its own pool, and this process opens a new one after the join
+    _disconnect()
+
+    # Each worker starts with its own market partition and then helps with the
+    # others, claiming disjoint chunks with SKIP LOCKED
+    workers = []
+    for worker_id in range(args.workers):
+        offset = worker_id % len(markets)
+        worker_markets = markets[offset:] + markets[:offset]
+        worker = multiprocessing.Process(
+            target=run_worker,
+            args=(worker_id, worker_markets, args.chunk_size, args.fuzzy_match, delta),
+        )
+        worker.start()
+        workers.append(worker)
+
+    for worker in workers:
+        worker.join()
+
+    # Once every chunk of the markets is processed, no worker is updating their offers
+    _connect()
+    expire_missing_offers(markets, args.offer_max_age_hours)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+from typing import Any, Dict, List
+
+# Columns shared by current_prices and best_offers
+OFFER_COLUMNS = (
+    "id_supermarket",
+    "id_product",
+    "id_price",
+    "extraction_date",
+    "last_seen",
+    "value",
+    "best_value",
+    "best_condition_type",
+    "currency",
+)
+
+OFFER_ARRAY_TYPES = (
+    "int[]",
+    "int[]",
+    "int[]",
+    "timestamp[]",
+    "timestamp[]",
+    "int[]",
+    "int[]",
+    "varchar[]",
+    "varchar[]",
+)
+
+# Discounts that any customer gets for one unit (WHOLESALE once the minimum
+# quantity is reached). Conditioned ones, BUY_X_GET_Y or PERCENTAGE_QUANTITY
+# don't give a unit price comparable between supermarkets
+BEST_VALUE_DISCOUNT_TYPES = ("CARD", "WHOLESALE")
+
+# Offers not seen for longer than this before the last scrape of their supermarket
+# are closed. Greater than the full refresh interval of the incremental mode (24h)
+OFFER_MAX_AGE_HOURS = 48
+
+
+def build_offer(id_price, row, value, currency, discounts, extraction_date=None):
+    """
+    Effective offer of a price: the regular value and the best value taking into
+    account the CARD and WHOLESALE discounts, as (unit_value, condition_type, ...)
+    """
+    best_value, best_condition_type = value, None
+    for unit_value, condition_type, *_ in discounts:
+        if condition_type not in BEST_VALUE_DISCOUNT_TYPES:
+            continue
+        if unit_value is not None and unit_value < best_value:
+            best_value, best_condition_type = unit_value, condition_type
+
+    return {
+        "id_supermarket": row["id_supermarket"],
+        "id_product": row["id_product"],
+        "id_price": id_price,
+        "extraction_date": extraction_date or row["extraction_date"],
+        "last_seen": row["extraction_date"],
+        "value": value,
+        "best_value": best_value,
+        "best_condition_type": best_condition_type,
+        "currency": currency,
+    }
+
+
+def update_offers(db, offers: List[Dict[str, Any]]) -> None:
+    """
+    Update current_prices with the offers of a chunk and refresh best_offers only
+    for the products that were touched (instead of recomputing from prices)
+
+    Workers of different markets can touch the same product at the same time. Each
+    product is locked until the transaction ends, so the refresh of the second
+    worker waits for the commit of the first one and sees its current price
+    (otherwise the last commit wins with a best offer computed without the other).
+    """
+    if not offers:
+        return
+
+    # Only the most recent offer of each (supermarket, product) of the chunk
+    latest_offers = {}
+    for offer in offers:
+        key = (offer["id_supermarket"], offer["id_product"])
+        if key not in latest_offers or latest_offers[key]["last_seen"] <= offer["last_seen"]:
+            latest_offers[key] = offer
+
+    # Locks taken in a fixed order (lock_keys sorts them), so workers can't deadlock
+    product_ids = sorted({offer["id_product"] for offer in latest_offers.values()})
+    db.execute_named("lock_keys", ([f"offers:{id_product}" for id_product in product_ids],))
+
+    # Rows upserted in key order, for the same reason
+    sorted_offers = [latest_offers[key] for key in sorted(latest_offers)]
+    db.execute_named(
+        "upsert_current_prices",
+        tuple([offer[column] for offer in sorted_offers] for column in OFFER_COLUMNS),
+    )
+
+    db.execute_named("refresh_best_offers", (product_ids,))
+
+
+def expire_offers(db, market: str, max_age_hours: float = OFFER_MAX_AGE_HOURS) -> int:
+    """
+    Close the current prices of a supermarket that its newer scrapes don't contain
+    anymore, and refresh the best offers of those products. Returns the number of
+    products whose offer was closed
+    """
+    keys = sorted(
+        (row["id_supermarket"], row["id_product"])
+        for row in db.execute_named("load_expired_current_prices", (market, max_age_hours))
+    )
+    if not keys:
+        return 0
+
+    # Same locks as update_offers, taken before touching current_prices
+    product_ids = sorted({id_product for _, id_product in keys})
+    db.execute_named("lock_keys", ([f"offers:{id_product}" for id_product in product_ids],))
+    db.execute_named("delete_current_prices", tuple(list(column) for column in zip(*keys)))
+
+    db.execute_named("refresh_best_offers", (product_ids,))
+    db.execute_named("delete_orphan_best_offers", (product_ids,))
+    return len(product_ids)
@@ -0,0 +1,107 @@
+from collections import defaultdict
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from Levenshtein import ratio
+
+
+class ProductMatcher:
+    """
+    Fuzzy matching of product names against the products already registered.
+
+    Comparing every new name with every product is too slow, so the names are
+    indexed by token (inverted index token -> products). For each incoming name
+    only the products sharing its rarest tokens are candidates, and just those
+    are scored with the Levenshtein ratio.
+
+    Names are expected to be already normalized with `normalize_word`.
+    """
+
+    def __init__(
+        self,
+        min_score: float = 0.9,
+        max_candidates: int = 50,
+        max_postings: int = 20_000,
+    ):
+        self.min_score = min_score
+        # Number of best candidates (by shared tokens) that are scored
+        self.max_candidates = max_candidates
+        # Maximum number of postings read per lookup, rare tokens are read first
+        self.max_postings = max_postings
+
+        self._ids: List[int] = []
+        self._names: List[str] = []
+        self._numbers: List[frozenset] = []
+        self._index: Dict[str, List[int]] = defaultdict(list)
+
+    @staticmethod
+    def _tokens(name: str) -> List[str]:
+        return list(dict.fromkeys(name.lower().split()))
+
+    @staticmethod
+    def _numeric_tokens(tokens: Iterable[str]) -> frozenset:
+        # Tokens with digits are sizes or variants (1kg, 5kg, 350ml, tipo 1)
+        return frozenset(token for token in tokens if any(c.isdigit() for c in token))
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def add(self, product_id: int, normalized_name: str) -> None:
+        """Add a product to the index"""
+        position = len(self._ids)
+        tokens = self._tokens(normalized_name)
+
+        self._ids.append(product_id)
+        self._names.append(normalized_name.lower())
+        self._numbers.append(self._numeric_tokens(tokens))
+        for token in tokens:
+            self._index[token].append(position)
+
+    def add_many(self, products: Iterable[Tuple[int, str]]) -> None:
+        """Add (product_id, normalized_name) pairs to the index"""
+        for product_id, normalized_name in products:
+            self.add(product_id, normalized_name)
+
+    def _candidates(self, tokens: List[str]) -> List[int]:
+        postings = sorted(
+            (self._index[token] for token in tokens if token in self._index), key=len
+        )
+
+        shared_tokens: Dict[int, int] = defaultdict(int)
+        postings_read = 0
+        for posting in postings:
+            if shared_tokens and postings_read + len(posting) > self.max_postings:
+                break
+            postings_read += len(posting)
+            for position in posting:
+                shared_tokens[position] += 1
+
+        return sorted(shared_tokens, key=shared_tokens.get, reverse=True)[
+            : self.max_candidates
+        ]
+
+    def match(self, normalized_name: str) -> Optional[Tuple[int, float]]:
+        """Return (product_id, score) of the best match above min_score, or None"""
+        name = normalized_name.lower()
+        tokens = self._tokens(name)
+        numbers = self._numeric_tokens(tokens)
+
+        best_position, best_score = None, self.min_score
+        for position in self._candidates(tokens):
+            # Never match different sizes/variants, even if the names are similar
+            if self._numbers[position] != numbers:
+                continue
+            score = ratio(name, self._names[position])
+            if score >= best_score:
+                best_position, best_score = position, score
+
+        if best_position is None:
+            return None
+        return self._ids[best_position], best_score
+
+    def match_many(
+        self, normalized_names: Iterable[str]
+    ) -> List[Optional[Tuple[int, float]]]:
+        """Match a batch of names, each distinct name is matched once"""
+        normalized_names = list(normalized_names)
+        matches = {name: self.match(name) for name in set(normalized_names)}
+        return [matches[name] for name in normalized_names]
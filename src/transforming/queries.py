@@ -0,0 +1,185 @@
+"""
+Registry of the queries used by the transform, executed by name as prepared
+statements (see DatabaseQueryClient.execute_named)
+"""
+
+from offers import OFFER_COLUMNS, OFFER_ARRAY_TYPES
+
+_OFFER_COLUMNS_SQL = ", ".join(OFFER_COLUMNS)
+_OFFER_UNNEST_SQL = ", ".join(f"%s::{array_type}" for array_type in OFFER_ARRAY_TYPES)
+
+# Streamed with iter_query (server-side cursors can't run prepared statements)
+PRODUCTS_INDEX_QUERY = """
+    SELECT id, normalized_name
+    FROM products
+    WHERE normalized_name IS NOT NULL;
+"""
+
+QUERIES = {
+    "load_supermarkets": """
+        SELECT id, name
+        FROM supermarkets
+        WHERE name = ANY(%s);
+    """,
+    "load_brands": """
+        SELECT id, normalized_name
+        FROM brands
+        WHERE normalized_name = ANY(%s);
+    """,
+    "load_raw_product_data": """
+        SELECT product_id, product_url
+        FROM raw_product_data
+        WHERE product_url = ANY(%s);
+    """,
+    "load_products": """
+        SELECT id, normalized_name
+        FROM products
+        WHERE normalized_name = ANY(%s);
+    """,
+    "load_prices": """
+        SELECT p.id, p.id_supermarket, p.id_product, p.extraction_date
+        FROM prices p
+        JOIN unnest(%s::int[], %s::int[], %s::timestamp[])
+            AS k(id_supermarket, id_product, extraction_date)
+            USING (id_supermarket, id_product, extraction_date);
+    """,
+    "load_latest_prices": """
+        SELECT DISTINCT ON (p.id_supermarket, p.id_product)
+            p.id, p.id_supermarket, p.id_product, p.extraction_date, p.valid_to, p.value, p.currency
+        FROM prices p
+        JOIN unnest(%s::int[], %s::int[]) AS k(id_supermarket, id_product)
+            USING (id_supermarket, id_product)
+        ORDER BY p.id_supermarket, p.id_product, p.extraction_date DESC;
+    """,
+    "load_latest_price_discounts": """
+        SELECT id_price, unit_value, condition_type, min_qty, multiple_qty
+        FROM discounts
+        WHERE id_price = ANY(%s);
+    """,
+    "claim_scraped_products": """
+        SELECT p.*
+        FROM stage_scraping_products p
+        WHERE p.market = %s
+        AND p.is_processed = false
+        ORDER BY p.source_id DESC
+        LIMIT %s
+        FOR UPDATE SKIP LOCKED;
+    """,
+    "load_scraped_discounts": """
+        SELECT id
+            ,product_id
+            ,type
+            ,discounted_price
+            ,conditions_text
+            ,conditions_min_quantity
+            ,conditions_buy_quantity
+            ,conditions_get_quantity
+            ,created_at
+        FROM stage_discounts
+        WHERE product_id = ANY(%s);
+    """,
+    "lock_keys": """
+        SELECT pg_advisory_xact_lock(hashtextextended(k, 0))
+        FROM (SELECT unnest(%s::text[]) AS k ORDER BY 1) AS lock_keys;
+    """,
+    "insert_supermarket": """
+        INSERT INTO supermarkets (name)
+        VALUES (%s)
+        RETURNING id;
+    """,
+    "insert_brand": """
+        INSERT INTO brands (name, normalized_name)
+        VALUES (%s, %s)
+        RETURNING id;
+    """,
+    "insert_product": """
+        INSERT INTO products (name, normalized_name, quantity, id_brand)
+        VALUES (%s, %s, %s, %s)
+        RETURNING id;
+    """,
+    "insert_raw_product_data": """
+        INSERT INTO raw_product_data (original_name, product_url, product_id, extraction_date, market)
+        VALUES (%s, %s, %s, %s, %s)
+    """,
+    "insert_discount": """
+        INSERT INTO discounts (id_price, unit_value, condition_type, min_qty, multiple_qty)
+        VALUES (%s, %s, %s, %s, %s)
+    """,
+    "extend_price_validity": """
+        UPDATE prices
+        SET valid_to = %s
+        WHERE id = %s
+        AND (valid_to IS NULL OR valid_to < %s);
+    """,
+    "insert_price": """
+        INSERT INTO prices (id_supermarket, id_product, extraction_date, valid_to, value, currency)
+        VALUES (%s, %s, %s, %s, %s, %s)
+        ON CONFLICT (id_supermarket, id_product, extraction_date) DO NOTHING
+        RETURNING id;
+    """,
+    "mark_scraped_products_processed": """
+        UPDATE stage_scraping_products
+        SET is_processed = true
+        WHERE id = ANY(%s)
+    """,
+    "load_schema_columns": """
+        SELECT table_name, column_name
+        FROM information_schema.columns
+        WHERE table_schema = current_schema()
+        AND table_name = ANY(%s);
+    """,
+    "load_pending_markets": """
+        SELECT DISTINCT market
+        FROM stage_scraping_products
+        WHERE is_processed = false;
+    """,
+    "upsert_current_prices": f"""
+        INSERT INTO current_prices ({_OFFER_COLUMNS_SQL})
+        SELECT * FROM unnest({_OFFER_UNNEST_SQL})
+        ON CONFLICT (id_supermarket, id_product) DO UPDATE SET
+            id_price = EXCLUDED.id_price,
+            extraction_date = EXCLUDED.extraction_date,
+            last_seen = EXCLUDED.last_seen,
+            value = EXCLUDED.value,
+            best_value = EXCLUDED.best_value,
+            best_condition_type = EXCLUDED.best_condition_type,
+            currency = EXCLUDED.currency
+        WHERE current_prices.last_seen <= EXCLUDED.last_seen;
+    """,
+    "load_expired_current_prices": """
+        SELECT c.id_supermarket, c.id_product
+        FROM current_prices c
+        JOIN supermarkets s ON s.id = c.id_supermarket
+        WHERE s.name = %s
+        AND c.last_seen < (
+            SELECT max(last_seen) FROM current_prices WHERE id_supermarket = c.id_supermarket
+        ) - %s::float8 * interval '1 hour';
+    """,
+    "delete_current_prices": """
+        DELETE FROM current_prices
+        WHERE (id_supermarket, id_product) IN (
+            SELECT * FROM unnest(%s::int[], %s::int[])
+        );
+    """,
+    "delete_orphan_best_offers": """
+        DELETE FROM best_offers b
+        WHERE b.id_product = ANY(%s)
+        AND NOT EXISTS (SELECT 1 FROM current_prices c WHERE c.id_product = b.id_product);
+    """,
+    "refresh_best_offers": f"""
+        INSERT INTO best_offers ({_OFFER_COLUMNS_SQL})
+        SELECT DISTINCT ON (id_product) {_OFFER_COLUMNS_SQL}
+        FROM current_prices
+        WHERE id_product = ANY(%s)
+        ORDER BY id_product, best_value, value, id_supermarket
+        ON CONFLICT (id_product) DO UPDATE SET
+            id_supermarket = EXCLUDED.id_supermarket,
+            id_price = EXCLUDED.id_price,
+            extraction_date = EXCLUDED.extraction_date,
+            last_seen = EXCLUDED.last_seen,
+            value = EXCLUDED.value,
+            best_value = EXCLUDED.best_value,
+            best_condition_type = EXCLUDED.best_condition_type,
+            currency = EXCLUDED.currency;
+    """,
+}
@@ -1,4 +1,4 @@
-from query_client import create_query_client
+from sql_client import create_query_client
 from logger import Logger
 
 LOGGER = Logger("query_examples")
@@ -21,7 +21,7 @@ def example_custom_queries():
     expensive_products = client.execute_query(expensive_products_query)
     for product in expensive_products:
         LOGGER.info(
-            f"   ${product['price']:.2f} - {product['name']} ({product['market']})"
+            "   $%.2f - %s (%s)", product["price"], product["name"], product["market"]
         )
 
     # 2. Query personalizada: productos por rango de precio
@@ -34,7 +34,7 @@ def example_custom_queries():
     LIMIT 10
     """
     mid_range_products = client.execute_query(price_range_query, (100, 500))
-    LOGGER.info(f"   Encontrados {len(mid_range_products)} productos en este rango")
+    LOGGER.info("   Encontrados %d productos en este rango", len(mid_range_products))
 
     # 3. Query personalizada: productos agregados hoy
     LOGGER.info("3. Obteniendo productos agregados hoy...")
@@ -45,7 +45,57 @@ def example_custom_queries():
     ORDER BY extraction_date DESC
     """
     today_products = client.execute_query(today_products_query)
-    LOGGER.info(f"   Encontrados {len(today_products)} productos agregados hoy")
+    LOGGER.info("   Encontrados %d productos agregados hoy", len(today_products))
+
+    # 4. Query en streaming: precio medio por mercado sin cargar toda la tabla en memoria
+    LOGGER.info("4. Calculando el precio medio por mercado en streaming...")
+    all_prices_query = """
+    SELECT market, price
+    FROM stage_scraping_products
+    WHERE price IS NOT NULL
+    """
+    totals_by_market = {}
+    for batch in client.iter_query(all_prices_query, chunk_size=10000, row_format="columns"):
+        for market, price in zip(batch["market"], batch["price"]):
+            total, count = totals_by_market.get(market, (0, 0))
+            totals_by_market[market] = (total + price, count + 1)
+    for market, (total, count) in totals_by_market.items():
+        LOGGER.info("   %s: %d productos, precio medio %.2f", market, count, total / count)
+
+
+def example_best_offers(id_product: int):
+    """Ejemplo de consulta de la mejor oferta actual de un producto"""
+    LOGGER.info("=== Ejemplo de Mejor Oferta ===")
+
+    # best_offers se mantiene en el transform, así que es una búsqueda por clave
+    best_offer_query = """
+    SELECT s.name AS supermarket, b.value, b.best_value, b.best_condition_type, b.last_seen
+    FROM best_offers b
+    JOIN supermarkets s ON s.id = b.id_supermarket
+    WHERE b.id_product = %s
+    """
+    best_offer = client.execute_query(best_offer_query, (id_product,))
+    for offer in best_offer:
+        LOGGER.info(
+            "   %s: %s (%s, precio normal %s)",
+            offer["supermarket"],
+            offer["best_value"],
+            offer["best_condition_type"] or "sin descuento",
+            offer["value"],
+        )
+
+    # Precio actual del producto en cada supermercado
+    current_prices_query = """
+    SELECT s.name AS supermarket, c.value, c.best_value
+    FROM current_prices c
+    JOIN supermarkets s ON s.id = c.id_supermarket
+    WHERE c.id_product = %s
+    ORDER BY c.best_value
+    """
+    for price in client.execute_query(current_prices_query, (id_product,)):
+        LOGGER.info(
+            "   - %s: %s (normal %s)", price["supermarket"], price["best_value"], price["value"]
+        )
 
 
 def example_maintenance():
@@ -63,9 +113,7 @@ def example_maintenance():
     """
     old_count = client.execute_query(old_products_query)
     if old_count:
-        LOGGER.info(
-            f"   Hay {old_count[0]['count']} productos más antiguos que 30 días"
-        )
+        LOGGER.info("   Hay %s productos más antiguos que 30 días", old_count[0]["count"])
 
 
 def example_non_query_operations():
@@ -139,9 +187,9 @@ def example_non_query_operations():
     LOGGER.info("5. Verificando los cambios realizados...")
     verify_query = "SELECT name, price, created_at FROM test_products ORDER BY id"
     results = client.execute_query(verify_query)
-    LOGGER.info(f"   Productos restantes en tabla temporal: {len(results)}")
+    LOGGER.info("   Productos restantes en tabla temporal: %d", len(results))
     for product in results:
-        LOGGER.info(f"   - {product['name']}: ${product['price']}")
+        LOGGER.info("   - %s: $%s", product["name"], product["price"])
 
     # 6. Limpiar tabla temporal (se elimina automáticamente al final de la sesión)
     LOGGER.info(
@@ -168,13 +216,21 @@ def run_all_examples():
         example_custom_queries()
         print()  # Línea en blanco
 
+        # Mejor oferta del último producto visto
+        last_offer = client.execute_query(
+            "SELECT id_product FROM best_offers ORDER BY last_seen DESC LIMIT 1"
+        )
+        if last_offer:
+            example_best_offers(last_offer[0]["id_product"])
+            print()
+
         example_maintenance()
         print()
 
         LOGGER.info("✅ Todos los ejemplos ejecutados exitosamente")
 
     except Exception as e:
-        LOGGER.error(f"❌ Error ejecutando ejemplos: {e}")
+        LOGGER.error("❌ Error ejecutando ejemplos: %s", e)
 
 
 if __name__ == "__main__":
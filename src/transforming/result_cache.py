@@ -0,0 +1,134 @@
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, List, Optional, Set
+
+# Tables read by a query
+_READ_TABLES = re.compile(r"\b(?:FROM|JOIN)\s+([a-zA-Z_][\w.]*)", re.IGNORECASE)
+
+# Tables written by a query
+_WRITTEN_TABLES = re.compile(
+    r"\b(?:INSERT\s+INTO|UPDATE|DELETE\s+FROM|TRUNCATE(?:\s+TABLE)?)\s+([a-zA-Z_][\w.]*)",
+    re.IGNORECASE,
+)
+
+
+def read_tables(query: str) -> Set[str]:
+    return {table.lower() for table in _READ_TABLES.findall(query)}
+
+
+def written_tables(query: str) -> Set[str]:
+    return {table.lower() for table in _WRITTEN_TABLES.findall(query)}
+
+
+class QueryResultCache:
+    """
+    Cache of SELECT results keyed by SQL + params, with TTL and LRU eviction.
+
+    Every entry remembers the tables its query reads, and is dropped as soon as
+    a query of this process writes to one of them. Writes of other processes are
+    detected with the versions of the tables (see DatabaseQueryClient): an entry
+    is only served for the same versions it was stored with.
+    """
+
+    def __init__(self, max_entries: int = 256, max_rows: int = 500_000):
+        self.max_entries = max_entries
+        self.max_rows = max_rows
+
+        self._entries: "OrderedDict[tuple, Dict[str, Any]]" = OrderedDict()
+        self._rows = 0
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    @staticmethod
+    def _key(query: str, params) -> tuple:
+        # params may contain lists (ANY(%s)), repr makes them hashable
+        return (" ".join(query.split()), repr(params))
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        self._rows -= len(entry["rows"])
+
+    def get(self, query: str, params, versions=None) -> Optional[List[Dict[str, Any]]]:
+        """Cached rows of the query, None if they are not cached, expired or outdated"""
+        key = self._key(query, params)
+        with self._lock:
+            entry = self._entries.get(key)
+            if (
+                entry is None
+                or entry["expires_at"] < time.monotonic()
+                or entry["versions"] != versions
+            ):
+                if entry is not None:
+                    self._remove(key)
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return [dict(row) for row in entry["rows"]]
+
+    def put(
+        self, query: str, params, rows: List[Dict[str, Any]], ttl: float, versions=None
+    ) -> None:
+        if len(rows) > self.max_rows:
+            return
+
+        key = self._key(query, params)
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+
+            self._entries[key] = {
+                "rows": [dict(row) for row in rows],
+                "tables": read_tables(query),
+                "expires_at": time.monotonic() + ttl,
+                "versions": versions,
+            }
+            self._rows += len(rows)
+
+            while self._entries and (
+                len(self._entries) > self.max_entries or self._rows > self.max_rows
+            ):
+                self._remove(next(iter(self._entries)))
+
+    def invalidate_tables(self, tables: Iterable[str]) -> None:
+        """Drop the results of the queries that read any of these tables"""
+        tables = {table.lower() for table in tables}
+        if not tables:
+            return
+
+        with self._lock:
+            for key in [
+                key for key, entry in self._entries.items() if entry["tables"] & tables
+            ]:
+                self._remove(key)
+                self.invalidations += 1
+
+    def invalidate_query(self, query: str) -> None:
+        """Drop the results that may be changed by a write query"""
+        self.invalidate_tables(written_tables(query))
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._rows = 0
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "rows": self._rows,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "invalidations": self.invalidations,
+        }
+
+
+# Shared by all the clients of the process, so any write invalidates every reader
+RESULT_CACHE = QueryResultCache()
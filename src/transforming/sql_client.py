@@ -1,11 +1,25 @@
 import os
+import re
+import threading
+import time
+import uuid
+import itertools
 import psycopg2
+import psycopg2.extensions
+import psycopg2.pool
+from contextlib import contextmanager
 from dotenv import load_dotenv
 from logger import Logger
-from typing import List, Dict, Any, Optional
+from result_cache import RESULT_CACHE, read_tables, written_tables
+from typing import List, Dict, Any, Optional, Iterator, Union
 
 load_dotenv()
 
+ROW_FORMATS = ("tuple", "dict", "columns")
+
+# Conexiones abiertas como máximo por proceso
+POOL_MAX_CONNECTIONS = int(os.getenv("DB_POOL_MAX_CONNECTIONS", 5))
+
 DB_CONFIG = {
     "host": os.getenv("DB_HOST"),
     "database": os.getenv("DB_NAME"),
@@ -15,52 +29,366 @@ DB_CONFIG = {
 }
 
 
+class PreparedConnection(psycopg2.extensions.connection):
+    """Conexión que recuerda las sentencias que ya fueron preparadas en ella"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared_statements = set()
+
+
+_POOL = None
+_POOL_PID = None
+
+# Pools heredados del proceso padre en un fork. Se guardan sin cerrarlos: al liberar
+# una conexión heredada psycopg2 envía Terminate por el socket que comparte con el
+# padre, y el servidor cierra también la conexión del padre
+_INHERITED_POOLS = []
+
+
+def _get_pool() -> psycopg2.pool.ThreadedConnectionPool:
+    """Pool de conexiones del proceso (los procesos hijos crean el suyo)"""
+    global _POOL, _POOL_PID
+    if _POOL is None or _POOL_PID != os.getpid():
+        if _POOL is not None:
+            _INHERITED_POOLS.append(_POOL)
+        _POOL = psycopg2.pool.ThreadedConnectionPool(
+            1, POOL_MAX_CONNECTIONS, connection_factory=PreparedConnection, **DB_CONFIG
+        )
+        _POOL_PID = os.getpid()
+    return _POOL
+
+
+def _forget_inherited_pool():
+    """Después de un fork, el hijo no usa ni cierra el pool del padre"""
+    global _POOL, _POOL_PID
+    if _POOL is not None:
+        _INHERITED_POOLS.append(_POOL)
+    _POOL = None
+    _POOL_PID = None
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_forget_inherited_pool)
+
+
+def close_pool() -> None:
+    """Cierra las conexiones del pool de este proceso (por ejemplo antes de crear workers)"""
+    global _POOL, _POOL_PID
+    if _POOL is not None and _POOL_PID == os.getpid():
+        _POOL.closeall()
+    _POOL = None
+    _POOL_PID = None
+
+
+# Versión de las tablas escritas por el transform (doc/migrations/004_table_versions.sql).
+# La caché de resultados la compara para descartar lo escrito por otros procesos
+TABLE_VERSIONS_QUERY = """
+    SELECT table_name, version
+    FROM table_versions
+    WHERE table_name = ANY(%s);
+"""
+
+BUMP_TABLE_VERSIONS_QUERY = """
+    INSERT INTO table_versions (table_name, version)
+    SELECT unnest(%s::varchar[]), 1
+    ON CONFLICT (table_name) DO UPDATE SET
+        version = table_versions.version + 1,
+        updated_at = now();
+"""
+
+
+# Segundos que se reutilizan las versiones leídas: en ese intervalo los resultados en
+# caché se sirven sin ir a la base de datos, aunque otro proceso haya escrito las tablas
+TABLE_VERSIONS_TTL = float(os.getenv("DB_TABLE_VERSIONS_TTL_SECONDS", 1))
+
+# Tablas leídas por una query (ordenadas) -> (versiones, momento en que expiran)
+_TABLE_VERSIONS = {}
+_TABLE_VERSIONS_LOCK = threading.Lock()
+
+
+def _recent_table_versions(tables: tuple) -> Optional[tuple]:
+    """Versiones leídas hace menos de TABLE_VERSIONS_TTL segundos, None si no hay"""
+    with _TABLE_VERSIONS_LOCK:
+        entry = _TABLE_VERSIONS.get(tables)
+    if entry is None or entry[1] < time.monotonic():
+        return None
+    return entry[0]
+
+
+def _remember_table_versions(tables: tuple, versions: tuple) -> None:
+    with _TABLE_VERSIONS_LOCK:
+        _TABLE_VERSIONS[tables] = (versions, time.monotonic() + TABLE_VERSIONS_TTL)
+
+
+def _forget_table_versions(tables) -> None:
+    """Descarta las versiones de las tablas escritas por este proceso"""
+    tables = set(tables)
+    with _TABLE_VERSIONS_LOCK:
+        for key in [key for key in _TABLE_VERSIONS if tables.intersection(key)]:
+            del _TABLE_VERSIONS[key]
+
+
+def _rows_to_dicts(cursor) -> List[Dict[str, Any]]:
+    columns = [desc[0] for desc in cursor.description]
+    return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+
+def _execute_prepared(cursor, name: str, query: str, params: Optional[tuple] = None):
+    """Prepara la query una vez por conexión (PREPARE) y la ejecuta por nombre (EXECUTE)"""
+    parameters_count = query.count("%s")
+    prepared_statements = cursor.connection.prepared_statements
+
+    if name not in prepared_statements:
+        # PREPARE usa $1, $2... en lugar de %s
+        counter = itertools.count(1)
+        prepared_query = re.sub(r"%s", lambda _: f"${next(counter)}", query)
+        cursor.execute(f"PREPARE {name} AS {prepared_query}")
+        prepared_statements.add(name)
+
+    if parameters_count:
+        placeholders = ", ".join(["%s"] * parameters_count)
+        cursor.execute(f"EXECUTE {name} ({placeholders})", params)
+    else:
+        cursor.execute(f"EXECUTE {name}")
+
+
+class QueryTransaction:
+    """Ejecuta varias queries en la misma conexión y transacción"""
+
+    def __init__(self, conn, logger: Logger, queries: Optional[Dict[str, str]] = None):
+        self.conn = conn
+        self.logger = logger
+        self.queries = queries or {}
+        # Tablas modificadas, se invalidan en la caché de resultados al hacer commit
+        self.written_tables = set()
+
+    def execute_query(
+        self, query: str, params: Optional[tuple] = None
+    ) -> List[Dict[str, Any]]:
+        """Ejecuta una query SELECT dentro de la transacción"""
+        with self.conn.cursor() as cursor:
+            cursor.execute(query, params)
+            results = _rows_to_dicts(cursor)
+
+        self.logger.debug("Query executed successfully, %d rows returned", len(results))
+        return results
+
+    def execute_non_query(self, query: str, params: Optional[tuple] = None):
+        """Ejecuta una query INSERT/UPDATE/DELETE dentro de la transacción (sin commit)"""
+        self.written_tables |= written_tables(query)
+        with self.conn.cursor() as cursor:
+            cursor.execute(query, params)
+            self.logger.debug(
+                "Non-query executed successfully, %d rows affected", cursor.rowcount
+            )
+            if cursor.description:
+                return _rows_to_dicts(cursor)
+            return None
+
+    def execute_named(self, name: str, params: Optional[tuple] = None):
+        """Ejecuta una query registrada como sentencia preparada dentro de la transacción"""
+        self.written_tables |= written_tables(self.queries[name])
+        with self.conn.cursor() as cursor:
+            _execute_prepared(cursor, name, self.queries[name], params)
+            self.logger.debug(
+                "Prepared statement '%s' executed successfully, %d rows", name, cursor.rowcount
+            )
+            if cursor.description:
+                return _rows_to_dicts(cursor)
+            return None
+
+
 class DatabaseQueryClient:
-    def __init__(self, logger_name: str = "query_client"):
+    def __init__(
+        self,
+        logger_name: str = "query_client",
+        queries: Optional[Dict[str, str]] = None,
+    ):
         self.logger = Logger(logger_name)
+        # Queries con nombre, se preparan una vez por conexión del pool
+        self.queries = dict(queries or {})
+
+    def register_query(self, name: str, query: str) -> None:
+        """Registra una query para ejecutarla por nombre con execute_named"""
+        self.queries[name] = query
 
     def _connect_db(self):
-        """Establece conexión con la base de datos"""
+        """Obtiene una conexión del pool"""
         try:
-            conn = psycopg2.connect(**DB_CONFIG)
+            conn = _get_pool().getconn()
             self.logger.debug("Database connection established")
             return conn
         except psycopg2.Error as error:
-            self.logger.error(f"Error connecting to the database: {error}")
+            self.logger.error("Error connecting to the database: %s", error)
+            return None
+
+    def _release_db(self, conn):
+        """Devuelve la conexión al pool sin transacciones abiertas"""
+        if not conn.closed:
+            conn.rollback()
+        _get_pool().putconn(conn, close=bool(conn.closed))
+
+    def _table_versions(self, conn, tables: tuple) -> Optional[tuple]:
+        """Versión actual de las tablas, None si no se puede leer (sin la migración 004)"""
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute(TABLE_VERSIONS_QUERY, (tables,))
+                versions = dict(cursor.fetchall())
+        except psycopg2.Error as error:
+            conn.rollback()
+            self.logger.error(
+                "Result cache disabled, table versions not available: %s", error, key="table_versions"
+            )
             return None
 
+        versions = tuple((table, versions.get(table, 0)) for table in tables)
+        _remember_table_versions(tables, versions)
+        return versions
+
+    def _tables_written(self, conn, tables) -> None:
+        """Invalida la caché de este proceso y sube la versión de las tablas para los demás
+
+        Se llama después del commit: quien lea la versión nueva ya ve los datos nuevos.
+        """
+        RESULT_CACHE.invalidate_tables(tables)
+        _forget_table_versions(tables)
+        if not tables:
+            return
+
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute(BUMP_TABLE_VERSIONS_QUERY, (sorted(tables),))
+            conn.commit()
+        except psycopg2.Error as error:
+            # Los datos ya tienen commit, los otros procesos esperan al TTL
+            conn.rollback()
+            self.logger.error("Error updating the table versions: %s", error, key="table_versions")
+
     def execute_query(
-        self, query: str, params: Optional[tuple] = None
+        self,
+        query: str,
+        params: Optional[tuple] = None,
+        cache_ttl: Optional[float] = None,
     ) -> List[Dict[str, Any]]:
-        """Ejecuta una query SELECT y retorna los resultados como lista de diccionarios"""
+        """Ejecuta una query SELECT y retorna los resultados como lista de diccionarios
+
+        cache_ttl: segundos que el resultado se guarda en caché (None = sin caché).
+        Pensado para procesos de larga duración que repiten las mismas queries. La
+        caché se invalida cuando cualquier proceso escribe en las tablas de la query
+        con este cliente (versiones en la tabla table_versions); lo escrito por otros
+        medios, como los scrapers, solo se ve al expirar el TTL. Las versiones se leen
+        como mucho una vez cada TABLE_VERSIONS_TTL segundos: mientras tanto un acierto
+        no usa la base de datos, y lo escrito por otros procesos tarda ese tiempo en verse.
+
+        Los errores se propagan, una lista vacía siempre es un resultado sin filas.
+        """
+        tables = tuple(sorted(read_tables(query))) if cache_ttl else None
+        versions = _recent_table_versions(tables) if cache_ttl else None
+        if versions is not None:
+            cached_results = RESULT_CACHE.get(query, params, versions)
+            if cached_results is not None:
+                self.logger.debug(
+                    "Query served from cache, %d rows returned", len(cached_results)
+                )
+                return cached_results
+
         conn = self._connect_db()
         if conn is None:
-            return []
+            raise psycopg2.OperationalError("Could not connect to the database")
 
         try:
             cursor = conn.cursor()
-            cursor.execute(query, params)
+            if cache_ttl and versions is None:
+                # Versiones leídas antes de la query: si alguien escribe mientras tanto,
+                # el resultado queda con la versión anterior y se descarta en el siguiente get
+                versions = self._table_versions(conn, tables)
+                if versions is not None:
+                    cached_results = RESULT_CACHE.get(query, params, versions)
+                    if cached_results is not None:
+                        self.logger.debug(
+                            "Query served from cache, %d rows returned", len(cached_results)
+                        )
+                        return cached_results
 
-            # Obtener nombres de columnas
-            columns = [desc[0] for desc in cursor.description]
+            cursor.execute(query, params)
 
             # Convertir resultados a lista de diccionarios
-            results = []
-            for row in cursor.fetchall():
-                results.append(dict(zip(columns, row)))
+            results = _rows_to_dicts(cursor)
+
+            if versions is not None:
+                RESULT_CACHE.put(query, params, results, cache_ttl, versions)
 
             self.logger.debug(
-                f"Query executed successfully, {len(results)} rows returned"
+                "Query executed successfully, %d rows returned", len(results)
             )
             return results
 
         except psycopg2.Error as error:
-            self.logger.error(f"Error executing query: {error}")
-            return []
+            self.logger.error("Error executing query: %s", error)
+            raise
+
+        finally:
+            cursor.close()
+            self._release_db(conn)
+
+    def iter_query(
+        self,
+        query: str,
+        params: Optional[tuple] = None,
+        chunk_size: int = 5000,
+        row_format: str = "tuple",
+    ) -> Iterator[Union[List[tuple], List[Dict[str, Any]], Dict[str, List[Any]]]]:
+        """Ejecuta una query SELECT con un cursor del servidor y retorna los resultados por bloques
+
+        row_format:
+            "tuple"   -> lista de tuplas
+            "dict"    -> lista de diccionarios
+            "columns" -> diccionario {columna: lista de valores}
+
+        Los errores se propagan: un resultado cortado no se distingue de uno completo.
+        """
+        if row_format not in ROW_FORMATS:
+            raise ValueError(f"row_format must be one of {ROW_FORMATS}")
+
+        conn = self._connect_db()
+        if conn is None:
+            raise psycopg2.OperationalError("Could not connect to the database")
+
+        # Los cursores con nombre se quedan en el servidor y solo envían chunk_size filas por vez
+        cursor = conn.cursor(name=f"iter_query_{uuid.uuid4().hex}")
+        cursor.itersize = chunk_size
+        total_rows = 0
+
+        try:
+            cursor.execute(query, params)
+
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    break
+
+                total_rows += len(rows)
+                columns = [desc[0] for desc in cursor.description]
+
+                if row_format == "tuple":
+                    yield rows
+                elif row_format == "dict":
+                    yield [dict(zip(columns, row)) for row in rows]
+                else:
+                    yield {column: list(values) for column, values in zip(columns, zip(*rows))}
+
+            self.logger.debug(
+                "Streaming query executed successfully, %d rows returned", total_rows
+            )
+
+        except psycopg2.Error as error:
+            self.logger.error("Error executing streaming query: %s", error)
+            raise
 
         finally:
             cursor.close()
-            conn.close()
+            self._release_db(conn)
 
     def execute_non_query(self, query: str, params: Optional[tuple] = None) -> bool:
         """Ejecuta una query que no retorna datos (INSERT, UPDATE, DELETE)"""
@@ -72,26 +400,82 @@ class DatabaseQueryClient:
             cursor = conn.cursor()
             cursor.execute(query, params)
             conn.commit()
+            self._tables_written(conn, written_tables(query))
 
             self.logger.debug(
-                f"Non-query executed successfully, {cursor.rowcount} rows affected"
+                "Non-query executed successfully, %d rows affected", cursor.rowcount
             )
             if cursor.description:
-                columns = [desc[0] for desc in cursor.description]
-                results = [dict(zip(columns, row)) for row in cursor.fetchall()]
-                return results
+                return _rows_to_dicts(cursor)
             return None
 
         except psycopg2.Error as error:
-            self.logger.error(f"Error executing non-query: {error}")
+            self.logger.error("Error executing non-query: %s", error)
             conn.rollback()
             return None
 
         finally:
             cursor.close()
-            conn.close()
+            self._release_db(conn)
+
+    def execute_named(self, name: str, params: Optional[tuple] = None) -> List[Dict[str, Any]]:
+        """Ejecuta una query registrada como sentencia preparada y hace commit
+
+        Los errores se propagan (después del rollback): quien la llama no debe
+        confundir un error con un resultado vacío, por ejemplo al guardar en
+        caché que una clave no existe.
+        """
+        conn = self._connect_db()
+        if conn is None:
+            raise psycopg2.OperationalError("Could not connect to the database")
+
+        try:
+            cursor = conn.cursor()
+            _execute_prepared(cursor, name, self.queries[name], params)
+            conn.commit()
+            self._tables_written(conn, written_tables(self.queries[name]))
+
+            self.logger.debug(
+                "Prepared statement '%s' executed successfully, %d rows", name, cursor.rowcount
+            )
+            if cursor.description:
+                return _rows_to_dicts(cursor)
+            return []
+
+        except psycopg2.Error as error:
+            self.logger.error("Error executing prepared statement '%s': %s", name, error)
+            if not conn.closed:
+                conn.rollback()
+            raise
+
+        finally:
+            cursor.close()
+            self._release_db(conn)
+
+    @contextmanager
+    def transaction(self):
+        """Abre una transacción: hace commit al salir o rollback si hay un error"""
+        conn = self._connect_db()
+        if conn is None:
+            raise psycopg2.OperationalError("Could not connect to the database")
+
+        try:
+            transaction = QueryTransaction(conn, self.logger, self.queries)
+            yield transaction
+            conn.commit()
+        except Exception as error:
+            self.logger.error("Error in transaction, rolling back: %s", error)
+            if not conn.closed:
+                conn.rollback()
+            raise
+        else:
+            self._tables_written(conn, transaction.written_tables)
+        finally:
+            self._release_db(conn)
 
 # Función de conveniencia para uso rápido
-def create_query_client(logger_name: str = "query_client") -> DatabaseQueryClient:
+def create_query_client(
+    logger_name: str = "query_client", queries: Optional[Dict[str, str]] = None
+) -> DatabaseQueryClient:
     """Crea una instancia del cliente de queries"""
-    return DatabaseQueryClient(logger_name)
+    return DatabaseQueryClient(logger_name, queries)
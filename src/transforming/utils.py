@@ -1,15 +1,41 @@
 import re
 import unicodedata
+from functools import lru_cache
 
+# Everything that is not a lowercase letter, a digit or a space is removed
+_SPECIAL_CHARACTERS = re.compile(r'[^a-z0-9 ]')
+
+# Brands, markets and many product names repeat a lot between rows
+NORMALIZE_CACHE_SIZE = 65536
+
+
+@lru_cache(maxsize=NORMALIZE_CACHE_SIZE)
 def normalize_word(word):
     # lowercase
     word = word.lower()
-    # remove accents
-    word = ''.join(c for c in unicodedata.normalize('NFD', word) if unicodedata.category(c) != 'Mn')
+    # remove accents (the combining marks are dropped with the special caracters)
+    if not word.isascii():
+        word = unicodedata.normalize('NFD', word)
     # remove special caracters
-    word = re.sub(r'[^a-z0-9 ]', '', word)
+    word = _SPECIAL_CHARACTERS.sub('', word)
     # remover duplicated space
-    word = re.sub(r'\s+', ' ', word).strip()
+    word = ' '.join(word.split())
     # capitalize first letter
     word = word.capitalize()
-    return word
\ No newline at end of file
+    return word
+
+
+def normalize_many(words):
+    # normalize a batch of words, computing each distinct value only once.
+    # Missing values (e.g. the brand in St Marche) stay None
+    normalized = {word: normalize_word(word) for word in set(words) if word is not None}
+    normalized[None] = None
+    return [normalized[word] for word in words]
+
+
+def group_discounts_by_product(discounts):
+    # index the staged discounts by product_id so each product lookup is O(1)
+    discounts_by_product = {}
+    for discount in discounts:
+        discounts_by_product.setdefault(discount['product_id'], []).append(discount)
+    return discounts_by_product
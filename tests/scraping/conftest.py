@@ -0,0 +1,20 @@
+import os
+import sys
+
+SRC_DIR = os.path.normpath(
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "src")
+)
+# The scrapers import their modules by name (they run from src/scraping)
+SCRAPING_DIR = os.path.join(SRC_DIR, "scraping")
+TRANSFORMING_DIR = os.path.join(SRC_DIR, "transforming")
+
+
+def pytest_collectstart(collector):
+    # The utils package of the scrapers has no __init__.py, so src/transforming/utils.py
+    # wins wherever it is in the path: it is left out while the scraping tests are imported
+    for path in (SCRAPING_DIR, TRANSFORMING_DIR):
+        if path in sys.path:
+            sys.path.remove(path)
+    sys.path.insert(0, SCRAPING_DIR)
+    if "utils" in sys.modules and not hasattr(sys.modules["utils"], "__path__"):
+        del sys.modules["utils"]
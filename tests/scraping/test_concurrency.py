@@ -0,0 +1,118 @@
+import time
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime
+
+from utils.concurrency import AdaptiveLimit, HostConcurrencyController, parse_retry_after
+
+
+def _request(limit, status=200, latency=0.1, retry_after=None):
+    limit.acquire()
+    limit.release(status, latency, retry_after)
+
+
+def test_the_limit_is_halved_on_429():
+    limit = AdaptiveLimit("example.com", initial=6, maximum=8)
+
+    _request(limit, 429)
+
+    assert limit.limit == 3
+    assert limit.decreases == 1
+
+
+def test_the_limit_is_cut_once_for_the_requests_in_flight():
+    limit = AdaptiveLimit("example.com", initial=8, maximum=8)
+    _request(limit, 200)
+
+    _request(limit, 429)
+    _request(limit, 503)
+
+    assert limit.limit == 4
+    assert limit.decreases == 1
+
+
+def test_the_limit_never_goes_below_the_minimum():
+    limit = AdaptiveLimit("example.com", initial=1, minimum=1)
+
+    _request(limit, 429)
+
+    assert limit.limit == 1
+
+
+def test_the_limit_grows_after_a_full_window_of_healthy_responses():
+    limit = AdaptiveLimit("example.com", initial=1, maximum=3, window=5)
+
+    for _ in range(4):
+        _request(limit)
+    assert limit.limit == 1
+
+    _request(limit)
+    assert limit.limit == 2
+
+    for _ in range(20):
+        _request(limit)
+    assert limit.limit == 3
+    assert limit.stats()["max_reached"] == 3
+
+
+def test_retry_after_pauses_the_host():
+    limit = AdaptiveLimit("example.com", initial=2)
+
+    _request(limit, 503, retry_after=30)
+
+    assert limit.paused_until - time.monotonic() > 29
+    assert limit.limit == 1
+
+
+def test_a_high_error_rate_decreases_the_limit():
+    limit = AdaptiveLimit("example.com", initial=4, window=10, max_error_rate=0.2)
+
+    for status in (200, 200, 500, 200):
+        _request(limit, status)
+    assert limit.limit == 4
+
+    # Half a window seen, 2 of 5 failed
+    _request(limit, None)
+    assert limit.limit == 2
+
+
+def test_latency_spikes_decrease_the_limit():
+    limit = AdaptiveLimit("example.com", initial=4, latency_factor=3.0, min_latency_spike=1.0)
+    _request(limit, latency=0.5)
+
+    # 3 times slower but less than a second slower: jitter
+    _request(limit, latency=1.4)
+    assert limit.limit == 4
+
+    _request(limit, latency=5.0)
+    assert limit.limit == 2
+
+
+def test_parse_retry_after():
+    assert parse_retry_after("120") == 120
+    assert parse_retry_after(None) is None
+    assert parse_retry_after("soon") is None
+
+    in_a_minute = datetime.now(timezone.utc) + timedelta(seconds=60)
+    assert 55 < parse_retry_after(format_datetime(in_a_minute, usegmt=True)) <= 60
+    an_hour_ago = datetime.now(timezone.utc) - timedelta(hours=1)
+    assert parse_retry_after(format_datetime(an_hour_ago, usegmt=True)) == 0
+
+
+def test_controller_only_limits_the_configured_hosts():
+    controller = HostConcurrencyController()
+    controller.set_host("api.example.com", initial=4)
+
+    with controller.request("https://api.example.com/products?page=2") as record:
+        record(429)
+    with controller.request("https://other.example.com/") as record:
+        record(429)
+
+    assert controller.stats() == {
+        "api.example.com": {
+            "limit": 2,
+            "max_reached": 4,
+            "increases": 0,
+            "decreases": 1,
+            "latency": None,
+        }
+    }
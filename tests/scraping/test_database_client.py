@@ -0,0 +1,80 @@
+import psycopg2
+import pytest
+
+from database.client import DatabaseClient
+
+
+class FakeCursor:
+    rowcount = 0
+
+    def executemany(self, query, rows):
+        pass
+
+    def close(self):
+        pass
+
+
+class FakeConnection:
+    def __init__(self):
+        self.closed = 0
+        self.commits = 0
+
+    def cursor(self):
+        return FakeCursor()
+
+    def commit(self):
+        self.commits += 1
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        self.closed = 1
+
+
+@pytest.fixture
+def connections(monkeypatch):
+    opened = []
+
+    def connect(**config):
+        opened.append(FakeConnection())
+        return opened[-1]
+
+    monkeypatch.setattr(psycopg2, "connect", connect)
+    return opened
+
+
+def test_each_insert_opens_its_own_connection(connections):
+    db_client = DatabaseClient("test", strategy="executemany", db_config={})
+
+    assert db_client.insert_scraping_products_with_discounts([("product",)])
+    assert db_client.insert_scraping_products_with_discounts([("product",)])
+
+    assert len(connections) == 2
+    assert all(conn.closed for conn in connections)
+
+
+def test_kept_connection_is_shared_by_the_inserts(connections):
+    db_client = DatabaseClient("test", strategy="executemany", db_config={})
+
+    with db_client.keep_connection():
+        for _ in range(3):
+            assert db_client.insert_scraping_products_with_discounts([("product",)])
+        assert len(connections) == 1
+        assert connections[0].commits == 3
+        assert not connections[0].closed
+
+    assert connections[0].closed
+
+
+def test_lost_kept_connection_is_opened_again(connections):
+    db_client = DatabaseClient("test", strategy="executemany", db_config={})
+
+    with db_client.keep_connection():
+        db_client.insert_scraping_products_with_discounts([("product",)])
+        # The server closed it
+        connections[0].closed = 2
+        assert db_client.insert_scraping_products_with_discounts([("product",)])
+
+    assert len(connections) == 2
+    assert connections[1].commits == 1
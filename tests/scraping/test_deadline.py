@@ -0,0 +1,59 @@
+import threading
+
+import pytest
+
+from utils.deadline import Deadline, DeadlineExceeded, current_deadline
+
+
+def test_without_seconds_there_is_no_limit():
+    deadline = Deadline()
+
+    assert deadline.remaining() is None
+    assert not deadline.expired()
+    assert deadline.timeout(30) == 30
+
+
+def test_a_nested_deadline_is_clamped_by_its_parent():
+    market = Deadline(10, name="market")
+    category = market.child(600, name="category")
+
+    assert 9 < category.remaining() <= 10
+    assert category.timeout(30) <= 10
+
+
+def test_a_nested_deadline_can_be_shorter_than_its_parent():
+    market = Deadline(600, name="market")
+    category = market.child(5, name="category")
+
+    assert 4 < category.remaining() <= 5
+    assert 599 < market.remaining() <= 600
+
+
+def test_a_nested_deadline_expires_with_its_parent():
+    run = Deadline(0, name="run")
+    market = run.child(None, name="market")
+    category = market.child(600, name="category")
+
+    assert category.expired()
+    assert category.remaining() == 0
+    assert category.timeout(30) == 0
+    with pytest.raises(DeadlineExceeded, match="category"):
+        category.check()
+
+
+def test_the_active_deadline_is_per_thread():
+    deadline = Deadline(60)
+    seen_by_other_thread = []
+
+    with deadline.activate():
+        assert current_deadline() is deadline
+        thread = threading.Thread(target=lambda: seen_by_other_thread.append(current_deadline()))
+        thread.start()
+        thread.join()
+
+        with deadline.child(5, name="category").activate() as category:
+            assert current_deadline() is category
+        assert current_deadline() is deadline
+
+    assert current_deadline() is None
+    assert seen_by_other_thread == [None]
@@ -0,0 +1,66 @@
+import json
+import os
+from datetime import datetime
+
+import pytest
+
+from database.file_storage import ScrapingProductsFileWriter, save_scraping_products_to_file
+from database.models.scraping_product import ScrapingProduct
+
+EXTRACTION_DATE = "2025-08-06T16:22:09.123456"
+
+
+@pytest.fixture(autouse=True)
+def working_dir(tmp_path, monkeypatch):
+    # The snapshots are written in data/ of the working directory
+    monkeypatch.chdir(tmp_path)
+
+
+def _product(name, price):
+    product = ScrapingProduct(
+        name=name,
+        market="Tenda",
+        price=price,
+        extraction_date=datetime(2025, 8, 6, 16, 22, 9),
+        category="Mercearia",
+        source_id=name,
+    )
+    product.add_wholesale_discount(discounted_price=price - 100, min_quantity=6)
+    return product
+
+
+def test_same_file_as_saving_all_the_products_at_the_end():
+    products = [_product("Arroz Camil 5kg", 2590), _product("Feijão Kicaldo 1kg", 890)]
+    snapshot = ScrapingProductsFileWriter("Tenda", EXTRACTION_DATE)
+
+    snapshot.write(products[:1])
+    snapshot.write([])
+    snapshot.write(products[1:])
+    # Only renamed on close
+    assert os.path.exists(snapshot.partial_filename)
+    filename = snapshot.close()
+
+    with open(filename, encoding="utf-8") as f:
+        streamed = f.read()
+    saved_filename = save_scraping_products_to_file(products, "Tenda", EXTRACTION_DATE)
+    with open(saved_filename, encoding="utf-8") as f:
+        assert streamed == f.read()
+    assert filename == "data/Tenda_products_2025-08-06T16-22-09.json"
+    assert [product["name"] for product in json.loads(streamed)] == [
+        "Arroz Camil 5kg",
+        "Feijão Kicaldo 1kg",
+    ]
+
+
+def test_without_products_no_file_is_left():
+    snapshot = ScrapingProductsFileWriter("Tenda", EXTRACTION_DATE)
+
+    assert snapshot.close() is None
+    assert os.listdir("data") == []
+
+
+def test_each_part_of_the_run_has_its_own_file():
+    snapshot = ScrapingProductsFileWriter("Tenda", EXTRACTION_DATE, part="Bebidas/Sucos_p21")
+    snapshot.write([_product("Suco Del Valle 1L", 790)])
+
+    assert snapshot.close() == "data/Tenda_products_2025-08-06T16-22-09_Bebidas_Sucos_p21.json"
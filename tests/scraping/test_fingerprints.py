@@ -0,0 +1,51 @@
+from datetime import datetime, timedelta
+
+from utils.fingerprints import CategoryFingerprints, build_fingerprint
+
+NOW = datetime(2025, 8, 6, 6, 0, 0)
+
+
+def test_fingerprint_ignores_the_order_of_the_items():
+    assert build_fingerprint(48, [(1, 990), (2, 1290)]) == build_fingerprint(
+        48, [(2, 1290), (1, 990)]
+    )
+    assert build_fingerprint(48, [(1, 990)]) != build_fingerprint(49, [(1, 990)])
+    assert build_fingerprint(48, [(1, 990)]) != build_fingerprint(48, [(1, 1090)])
+
+
+def test_should_crawl(tmp_path):
+    fingerprints = CategoryFingerprints(
+        str(tmp_path / "fingerprints.json"), full_refresh_interval=timedelta(hours=24)
+    )
+    fingerprints.record("Mercearia", "abc", now=NOW)
+
+    assert fingerprints.should_crawl("Bebidas", "abc", now=NOW) == (True, "new")
+    assert fingerprints.should_crawl("Mercearia", "def", now=NOW) == (True, "changed")
+    assert fingerprints.should_crawl("Mercearia", "abc", now=NOW + timedelta(hours=23)) == (
+        False,
+        "unchanged",
+    )
+    assert fingerprints.should_crawl("Mercearia", "abc", now=NOW + timedelta(hours=24)) == (
+        True,
+        "full refresh",
+    )
+
+
+def test_unchanged_categories_are_sampled(tmp_path):
+    fingerprints = CategoryFingerprints(str(tmp_path / "fingerprints.json"), sample_rate=1.0)
+    fingerprints.record("Mercearia", "abc", now=NOW)
+
+    assert fingerprints.should_crawl("Mercearia", "abc", now=NOW) == (True, "sample")
+
+
+def test_fingerprints_are_kept_between_runs(tmp_path):
+    path = str(tmp_path / "data" / "fingerprints.json")
+    fingerprints = CategoryFingerprints(path)
+    fingerprints.record("Mercearia", "abc", now=NOW)
+    fingerprints.save()
+
+    next_run = CategoryFingerprints(path)
+    assert next_run.should_crawl("Mercearia", "abc", now=NOW + timedelta(hours=1)) == (
+        False,
+        "unchanged",
+    )
@@ -0,0 +1,91 @@
+from decimal import Decimal
+
+import pytest
+
+from utils.measures import Measure, extract_measure, normalize_measure
+
+
+@pytest.mark.parametrize(
+    "name, expected",
+    [
+        ("Biscoito CLUB SOCIAL Original Pacote 144g", Measure(Decimal(144), "G")),
+        ("Cerveja Pilsen Corona Lata 350ml", Measure(Decimal(350), "ML")),
+        ("Picanha Bovina a Vácuo Resfriada 1,7kg", Measure(Decimal(1700), "G")),
+        ("Leite UHT Integral 1.5L", Measure(Decimal(1500), "ML")),
+        ("Refrigerante Coca-Cola 6x2L", Measure(Decimal(2000), "ML", 6)),
+        ("Iogurte Natural c/ 4 unidades 170g", Measure(Decimal(170), "G", 4)),
+        ("Ovos Brancos c/ 12", Measure(Decimal(1), "UN", 12)),
+        ("Cerveja Pilsen Corona Lata 350ml (máx 24 unidades por cpf)", Measure(Decimal(350), "ML")),
+        ("Vitamina B12 500mg", Measure(Decimal("0.5"), "G")),
+        ("Banana Prata", None),
+        ("", None),
+        (None, None),
+    ],
+)
+def test_extract_measure(name, expected):
+    assert extract_measure(name) == expected
+
+
+@pytest.mark.parametrize(
+    "name, expected",
+    [
+        # pt-BR thousands separator, not a decimal point
+        ("Arroz Tipo 1 1.000 g", Measure(Decimal(1000), "G")),
+        ("Arroz Tipo 1 1.000g", Measure(Decimal(1000), "G")),
+        ("Sabão em Pó 2.500,5 g", Measure(Decimal("2500.5"), "G")),
+        ("Água Mineral 1.500 ml", Measure(Decimal(1500), "ML")),
+        # a leading zero is a decimal
+        ("Queijo Minas 0.500 kg", Measure(Decimal(500), "G")),
+        # only in the base units, 1.000 kg is 1 kg
+        ("Picanha Bovina 1.000kg", Measure(Decimal(1000), "G")),
+        ("Água Mineral 1.500 L", Measure(Decimal(1500), "ML")),
+        ("Suplemento 1.000 mg", Measure(Decimal(1), "G")),
+    ],
+)
+def test_extract_measure_thousands(name, expected):
+    assert extract_measure(name) == expected
+
+
+@pytest.mark.parametrize(
+    "name",
+    [
+        # stage_scraping_products.quantity is decimal(8,2)
+        "Areia Fina 2000 kg",
+        "Caixa Água 1.000.000 ml",
+        "Fardo 12 x 100 kg",
+    ],
+)
+def test_extract_measure_too_large_for_the_stage(name):
+    assert extract_measure(name) is None
+
+
+def test_extract_measure_total_quantity():
+    assert extract_measure("Refrigerante Coca-Cola 6x2L").total_quantity == 12000
+
+
+@pytest.mark.parametrize(
+    "quantity, unit, expected",
+    [
+        # St Marche publishes the weighed products in KG
+        (Decimal("1.2"), "KG", (Decimal(1200), "G")),
+        (Decimal("0.35"), "kg", (Decimal(350), "G")),
+        (Decimal(2), "L", (Decimal(2000), "ML")),
+        (Decimal(350), "ML", (Decimal(350), "ML")),
+        (None, "UN", (None, "UN")),
+        (Decimal(3), "CX", (Decimal(3), "CX")),
+        (None, None, (None, None)),
+        # too large for the stage, the size is taken from the name instead
+        (Decimal(5000), "KG", (None, "G")),
+        (Decimal(1000000), "CX", (None, "CX")),
+        (Decimal("999.99999"), "KG", (Decimal("999999.99"), "G")),
+    ],
+)
+def test_normalize_measure(quantity, unit, expected):
+    assert normalize_measure(quantity, unit) == expected
+
+
+def test_both_markets_in_the_same_units():
+    # Tenda sizes come from the names, St Marche ones from the product card
+    tenda = extract_measure("Picanha Bovina a Vácuo Resfriada 1,2kg")
+    marche = normalize_measure(Decimal("1.2"), "KG")
+    assert (tenda.total_quantity, tenda.unit) == marche
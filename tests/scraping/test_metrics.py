@@ -0,0 +1,100 @@
+import json
+
+import pytest
+
+from utils.metrics import Metrics
+
+
+def test_timers_aggregate_count_sum_and_max():
+    metrics = Metrics()
+    metrics.observe("db_query_seconds", 0.5, table="stage_discounts")
+    metrics.observe("db_query_seconds", 1.5, table="stage_discounts")
+    metrics.observe("scraper_step_seconds", 2.0, count=24, step="parse")
+
+    assert sorted(metrics.series(), key=lambda entry: entry["name"]) == [
+        {
+            "type": "timer",
+            "name": "db_query_seconds",
+            "labels": {"table": "stage_discounts"},
+            "count": 2,
+            "sum_seconds": 2.0,
+            "max_seconds": 1.5,
+        },
+        {
+            "type": "timer",
+            "name": "scraper_step_seconds",
+            "labels": {"step": "parse"},
+            "count": 24,
+            "sum_seconds": 2.0,
+            "max_seconds": 2.0,
+        },
+    ]
+
+
+def test_the_timer_records_blocks_that_raise():
+    metrics = Metrics()
+
+    with pytest.raises(ValueError):
+        with metrics.timer("http_request_seconds", host="example.com", status="error"):
+            raise ValueError("connection reset")
+
+    assert metrics.series()[0]["count"] == 1
+
+
+def test_counters_and_labels():
+    metrics = Metrics()
+    metrics.increment("db_rows_total", 24, table="stage_scraping_products", client="Tenda")
+    # The order of the labels doesn't matter
+    metrics.increment("db_rows_total", 6, client="Tenda", table="stage_scraping_products")
+
+    assert metrics.series() == [
+        {
+            "type": "counter",
+            "name": "db_rows_total",
+            "labels": {"client": "Tenda", "table": "stage_scraping_products"},
+            "value": 30,
+        }
+    ]
+
+
+def test_totals_grouped_by_a_label():
+    metrics = Metrics()
+    metrics.observe("scraper_step_seconds", 1.0, market="Tenda", category="Bebidas", step="fetch")
+    metrics.observe("scraper_step_seconds", 2.0, market="Tenda", category="Limpeza", step="fetch")
+    metrics.observe("scraper_step_seconds", 0.5, market="Tenda", category="Limpeza", step="parse")
+    metrics.observe("scraper_step_seconds", 9.0, market="St Marche", step="fetch")
+
+    assert metrics.totals("scraper_step_seconds", by="step", market="Tenda") == {
+        "fetch": 3.0,
+        "parse": 0.5,
+    }
+
+
+def test_write_jsonl_appends_a_line_per_series(tmp_path):
+    metrics = Metrics()
+    metrics.increment("db_rows_total", 24, table="stage_discounts")
+    filename = str(tmp_path / "metrics" / "run.jsonl")
+
+    metrics.write_jsonl(filename, market="Tenda")
+    metrics.write_jsonl(filename, market="St Marche")
+
+    with open(filename, encoding="utf-8") as f:
+        lines = [json.loads(line) for line in f]
+    assert [line["labels"] for line in lines] == [
+        {"market": "Tenda", "table": "stage_discounts"},
+        {"market": "St Marche", "table": "stage_discounts"},
+    ]
+
+
+def test_prometheus_format():
+    metrics = Metrics()
+    metrics.observe("http_request_seconds", 0.25, host="example.com", status=200)
+    metrics.increment("db_rows_total", 24, table='stage "discounts"')
+
+    assert metrics.to_prometheus(run="1") == (
+        "# TYPE db_rows_total counter\n"
+        'db_rows_total{run="1",table="stage \\"discounts\\""} 24\n'
+        "# TYPE http_request_seconds summary\n"
+        'http_request_seconds_count{host="example.com",run="1",status="200"} 1\n'
+        'http_request_seconds_sum{host="example.com",run="1",status="200"} 0.25\n'
+    )
@@ -0,0 +1,179 @@
+import threading
+
+from pipeline import PersistProducts, Pipeline, RetryQueue, Stage
+from utils.deadline import Deadline
+
+
+def _collector():
+    items = []
+    lock = threading.Lock()
+
+    def collect(item):
+        with lock:
+            items.append(item)
+
+    return items, collect
+
+
+def test_items_go_through_every_stage():
+    items, collect = _collector()
+    pipeline = Pipeline(
+        [
+            Stage("split", lambda number: [number, number * 10]),
+            Stage("double", lambda number: [number * 2], workers=3),
+            Stage("collect", collect),
+        ]
+    )
+
+    report = pipeline.run([1, 2, 3])
+
+    assert sorted(items) == [2, 4, 6, 20, 40, 60]
+    assert [(stage["stage"], stage["items_in"], stage["items_out"]) for stage in report["stages"]] == [
+        ("split", 3, 6),
+        ("double", 6, 6),
+        ("collect", 6, 0),
+    ]
+
+
+def test_an_item_that_fails_doesnt_stop_the_stage():
+    items, collect = _collector()
+
+    def parse(number):
+        if number == 2:
+            raise ValueError("broken page")
+        return [number]
+
+    pipeline = Pipeline([Stage("parse", parse), Stage("collect", collect)])
+    report = pipeline.run([1, 2, 3])
+
+    assert sorted(items) == [1, 3]
+    assert report["stages"][0]["errors"] == 1
+
+
+def test_start_stage_skips_the_previous_stages():
+    items, collect = _collector()
+    pipeline = Pipeline(
+        [Stage("fetch", lambda url: [f"page of {url}"]), Stage("collect", collect)]
+    )
+
+    report = pipeline.run(["page already fetched"], start_stage="collect")
+
+    assert items == ["page already fetched"]
+    assert [stage["stage"] for stage in report["stages"]] == ["collect"]
+
+
+def test_an_expired_deadline_only_cancels_the_cancellable_stages():
+    items, collect = _collector()
+    pipeline = Pipeline(
+        [Stage("fetch", lambda url: [url], cancellable=True), Stage("collect", collect)],
+        deadline=Deadline(0),
+    )
+
+    report = pipeline.run(["/page/1", "/page/2"])
+    assert items == []
+    assert report["stages"][0]["cancelled"] == 2
+
+    # What was already fetched is still saved
+    pipeline.run(["/page/3"], start_stage="collect")
+    assert items == ["/page/3"]
+
+
+def test_deferred_items_are_retried_from_their_stage():
+    retries = RetryQueue(rounds=2, wait_seconds=0)
+    items, collect = _collector()
+    attempts = {}
+
+    def fetch(url):
+        attempts[url] = attempts.get(url, 0) + 1
+        if url == "/flaky" and attempts[url] == 1:
+            retries.defer("fetch", url, "status 503")
+            return []
+        return [url]
+
+    pipeline = Pipeline([Stage("fetch", fetch), Stage("collect", collect)])
+    pipeline.run(["/ok", "/flaky"])
+    report = retries.drain(pipeline)
+
+    assert sorted(items) == ["/flaky", "/ok"]
+    assert attempts == {"/ok": 1, "/flaky": 2}
+    assert report == {"deferred": 1, "retried": 1, "lost": []}
+
+
+def test_items_are_lost_after_the_last_round():
+    retries = RetryQueue(rounds=2, wait_seconds=0)
+
+    def fetch(url):
+        retries.defer("fetch", url, "status 503")
+        return []
+
+    pipeline = Pipeline([Stage("fetch", fetch)])
+    pipeline.run(["/down"])
+    report = retries.drain(pipeline, lambda url: {"url": url})
+
+    assert report["retried"] == 2
+    assert report["lost"] == [{"url": "/down", "reason": "status 503"}]
+
+
+def test_items_over_the_budget_are_not_retried():
+    retries = RetryQueue(rounds=1, budget=1, wait_seconds=0)
+    fetched = []
+
+    def fetch(url):
+        fetched.append(url)
+        if len(fetched) <= 2:
+            retries.defer("fetch", url, "timeout")
+        return []
+
+    pipeline = Pipeline([Stage("fetch", fetch)])
+    pipeline.run(["/a", "/b"])
+    report = retries.drain(pipeline, lambda url: {"url": url})
+
+    assert fetched == ["/a", "/b", "/a"]
+    assert report["lost"] == [{"url": "/b", "reason": "retry budget exhausted"}]
+
+
+class FakeDatabaseClient:
+    def __init__(self, success=True):
+        self.success = success
+        self.batches = []
+
+    def insert_scraping_products_with_discounts(self, products):
+        self.batches.append(list(products))
+        return self.success
+
+
+class FakeSnapshot:
+    def __init__(self):
+        self.products = []
+
+    def write(self, products):
+        self.products.extend(products)
+
+
+def test_persist_products_inserts_each_batch():
+    db_client = FakeDatabaseClient(success=False)
+    insertions = []
+    persist = PersistProducts(
+        db_client, lambda *insertion: insertions.append(insertion), market="Tenda"
+    )
+
+    persist({"category": "Mercearia", "products": ["arroz", "feijão"]})
+    persist({"category": "Bebidas", "products": ["água"]})
+    persist({"category": "Bebidas", "products": []})
+
+    assert db_client.batches == [["arroz", "feijão"], ["água"]]
+    assert insertions == [(False, 2, "Mercearia"), (False, 1, "Bebidas")]
+    assert persist.product_count == 3
+    assert persist.category_counts == {"Mercearia": 2, "Bebidas": 1}
+    assert persist.products == ["arroz", "feijão", "água"]
+
+
+def test_persist_products_with_a_snapshot_doesnt_keep_the_products():
+    snapshot = FakeSnapshot()
+    persist = PersistProducts(FakeDatabaseClient(), snapshot=snapshot)
+
+    persist({"category": "Mercearia", "products": ["arroz", "feijão"]})
+
+    assert snapshot.products == ["arroz", "feijão"]
+    assert persist.products == []
+    assert persist.product_count == 2
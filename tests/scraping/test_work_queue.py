@@ -0,0 +1,189 @@
+import sys
+import threading
+from types import SimpleNamespace
+
+import pytest
+
+import work_queue
+from work_queue import WorkQueue, coordinate, work
+
+RUN_ID = "2025-08-06T06:00:00"
+EXTRACTION_DATE = "2025-08-06T06:00:00.123456"
+
+
+@pytest.fixture
+def queue_file(tmp_path):
+    return str(tmp_path / "work_queue.sqlite")
+
+
+def _enqueue(queue, name, **options):
+    return queue.enqueue(RUN_ID, "tenda", {"id": 1, "name": name}, EXTRACTION_DATE, **options)
+
+
+def test_a_unit_is_enqueued_once_per_run(queue_file):
+    queue = WorkQueue(queue_file)
+
+    assert _enqueue(queue, "Mercearia")
+    assert not _enqueue(queue, "Mercearia")
+    assert _enqueue(queue, "Mercearia", first_page=21)
+    assert queue.stats() == {"pending": 2}
+
+
+def test_units_are_leased_by_priority(queue_file):
+    queue = WorkQueue(queue_file)
+    _enqueue(queue, "Bebidas", priority=10)
+    _enqueue(queue, "Mercearia", priority=500)
+    _enqueue(queue, "Limpeza", priority=10)
+
+    leased = [queue.lease("worker")["category_name"] for _ in range(3)]
+
+    assert leased == ["Mercearia", "Bebidas", "Limpeza"]
+    assert queue.lease("worker") is None
+
+
+def test_two_workers_never_lease_the_same_unit(queue_file):
+    queue = WorkQueue(queue_file)
+    for number in range(40):
+        _enqueue(queue, f"Categoria {number}")
+
+    leased = []
+    lock = threading.Lock()
+
+    def worker(worker_id):
+        # Each worker with its own connections, as separate processes
+        worker_queue = WorkQueue(queue_file)
+        while True:
+            unit = worker_queue.lease(worker_id)
+            if unit is None:
+                return
+            with lock:
+                leased.append(unit["id"])
+
+    threads = [threading.Thread(target=worker, args=(f"worker-{n}",)) for n in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert sorted(leased) == list(range(1, 41))
+
+
+def test_an_expired_lease_is_leased_again(queue_file):
+    # The worker that leased it died: its lease is already expired
+    dead_worker_queue = WorkQueue(queue_file, lease_seconds=-1)
+    _enqueue(dead_worker_queue, "Mercearia")
+    unit = dead_worker_queue.lease("dead-worker")
+
+    queue = WorkQueue(queue_file)
+    retried_unit = queue.lease("worker")
+
+    assert retried_unit["id"] == unit["id"]
+    assert retried_unit["attempts"] == 2
+    # The lease belongs to the new worker now
+    assert not queue.heartbeat(unit["id"], "dead-worker")
+    assert not queue.ack(unit["id"], "dead-worker")
+    assert queue.heartbeat(unit["id"], "worker")
+    assert queue.ack(unit["id"], "worker", {"products": 10})
+    assert queue.stats() == {"done": 1}
+
+
+def test_a_healthy_lease_is_not_leased_again(queue_file):
+    queue = WorkQueue(queue_file)
+    _enqueue(queue, "Mercearia")
+
+    assert queue.lease("worker") is not None
+    assert queue.lease("other-worker") is None
+
+
+def test_expired_lease_without_attempts_left_fails(queue_file):
+    queue = WorkQueue(queue_file, lease_seconds=-1)
+    _enqueue(queue, "Mercearia", max_attempts=1)
+    queue.lease("dead-worker")
+
+    assert queue.lease("worker") is None
+    assert queue.failed_units()[0]["error"] == "lease expired"
+
+
+def test_failed_units_are_retried_until_max_attempts(queue_file):
+    queue = WorkQueue(queue_file)
+    _enqueue(queue, "Mercearia", max_attempts=2)
+
+    unit = queue.lease("worker")
+    assert queue.fail(unit["id"], "worker", "timeout")
+    assert queue.stats() == {"pending": 1}
+
+    unit = queue.lease("worker")
+    assert unit["attempts"] == 2
+    assert queue.fail(unit["id"], "worker", "timeout again")
+
+    assert queue.lease("worker") is None
+    assert queue.stats() == {"failed": 1}
+    assert queue.failed_units()[0]["attempts"] == 2
+    assert queue.failed_units()[0]["error"] == "timeout again"
+
+
+@pytest.fixture
+def fake_market(monkeypatch):
+    """Market "fake" whose run_unit is set by each test"""
+    market = SimpleNamespace(
+        list_categories=lambda: [{"name": "Mercearia"}, {"name": "Nova"}, {"name": "Bebidas"}],
+        run_unit=None,
+    )
+    monkeypatch.setitem(sys.modules, "market_fake", market)
+    monkeypatch.setitem(work_queue.MARKETS, "fake", "market_fake")
+    monkeypatch.setattr(work_queue, "configure_hosts", lambda: None)
+    return market
+
+
+def test_coordinate_enqueues_new_categories_first(queue_file, fake_market, monkeypatch):
+    monkeypatch.setattr(
+        work_queue, "load_category_stats", lambda: {"fake": {"Mercearia": 500, "Bebidas": 80}}
+    )
+    queue = WorkQueue(queue_file)
+
+    coordinate(queue, ["fake"], RUN_ID)
+
+    leased = [queue.lease("worker")["category_name"] for _ in range(3)]
+    assert leased == ["Nova", "Mercearia", "Bebidas"]
+
+
+def _unit_result(remaining_ranges=(), errors=0):
+    return {
+        "products": 10,
+        "remaining_ranges": list(remaining_ranges),
+        "lost_pages": [],
+        "stages": [{"stage": "fetch", "errors": errors}],
+    }
+
+
+def test_work_enqueues_the_rest_of_the_category(queue_file, fake_market):
+    calls = []
+
+    def run_unit(category, first_page, last_page, **options):
+        calls.append((first_page, last_page, options["attempt"]))
+        return _unit_result([(3, 4), (5, 6)] if first_page == 1 else [])
+
+    fake_market.run_unit = run_unit
+    queue = WorkQueue(queue_file)
+    queue.enqueue(RUN_ID, "fake", {"name": "Mercearia"}, EXTRACTION_DATE, pages_per_unit=2)
+
+    assert work(queue, "worker") == 3
+    assert calls == [(1, None, 1), (3, 4, 1), (5, 6, 1)]
+    assert queue.stats() == {"done": 3}
+
+
+def test_work_releases_the_units_that_fail(queue_file, fake_market):
+    attempts = []
+
+    def run_unit(category, attempt, **options):
+        attempts.append(attempt)
+        return _unit_result(errors=1 if attempt == 1 else 0)
+
+    fake_market.run_unit = run_unit
+    queue = WorkQueue(queue_file)
+    queue.enqueue(RUN_ID, "fake", {"name": "Mercearia"}, EXTRACTION_DATE)
+
+    assert work(queue, "worker") == 1
+    # The retry knows it is one, so it deletes what the first attempt staged
+    assert attempts == [1, 2]
+    assert queue.stats() == {"done": 1}
@@ -0,0 +1,18 @@
+import os
+import sys
+
+# The transform modules import each other by name (they run from src/transforming)
+TRANSFORMING_DIR = os.path.normpath(
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "src", "transforming")
+)
+
+
+def pytest_collectstart(collector):
+    # src/transforming/utils.py has the same name as the utils package of the
+    # scrapers, so the module goes first while the transform tests are imported
+    if TRANSFORMING_DIR in sys.path:
+        sys.path.remove(TRANSFORMING_DIR)
+    sys.path.insert(0, TRANSFORMING_DIR)
+    if hasattr(sys.modules.get("utils"), "__path__"):
+        for name in [name for name in sys.modules if name == "utils" or name.startswith("utils.")]:
+            del sys.modules[name]
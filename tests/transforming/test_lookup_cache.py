@@ -0,0 +1,25 @@
+import pytest
+
+from lookup_cache import LookupCache
+
+
+def test_loader_errors_are_not_cached_as_missing():
+    calls = []
+
+    def loader(keys):
+        calls.append(list(keys))
+        if len(calls) == 1:
+            raise ConnectionError("database unavailable")
+        return {"Camil": 7}
+
+    cache = LookupCache("brands", loader)
+    with pytest.raises(ConnectionError):
+        cache.prefetch(["Camil", "Tio joao"])
+
+    # The failed keys are queried again instead of being taken as not registered
+    assert cache.missing_keys(["Camil", "Tio joao"]) == []
+    assert cache.get("Camil") == 7
+    assert cache.missing_keys(["Tio joao"]) == []
+    assert cache.get("Tio joao") is None
+    assert cache.missing_keys(["Tio joao"]) == ["Tio joao"]
+    assert calls == [["Camil", "Tio joao"], ["Camil"], ["Tio joao"]]
@@ -0,0 +1,135 @@
+from datetime import datetime
+from itertools import count
+
+import pytest
+
+pytest.importorskip("psycopg2")
+pytest.importorskip("dotenv")
+pytest.importorskip("Levenshtein")
+
+import main  # noqa: E402
+from lookup_cache import LookupCache  # noqa: E402
+
+
+class FakeTransaction:
+    """Records the prepared statements executed by process_chunk, new ids are sequential"""
+
+    INSERTS_RETURNING_ID = {"insert_supermarket", "insert_brand", "insert_product", "insert_price"}
+
+    def __init__(self):
+        self.calls = []
+        self._ids = count(1)
+
+    def execute_named(self, name, params=None):
+        self.calls.append((name, params))
+        if name in self.INSERTS_RETURNING_ID:
+            return [{"id": next(self._ids)}]
+        return []
+
+    def params_of(self, name):
+        return [params for call_name, params in self.calls if call_name == name]
+
+
+def _empty_caches():
+    # Nothing registered in the database yet
+    return {
+        name: LookupCache(name, lambda keys: {})
+        for name in ("supermarkets", "brands", "raw_product_data", "products", "prices", "latest_prices")
+    }
+
+
+def _stage_row(**values):
+    row = {
+        "id": 1,
+        "name": "Arroz Branco Tipo 1 Camil 5kg",
+        "market": "St Marche",
+        "category": "Mercearia",
+        "brand": None,
+        "product_url": "https://www.marche.com.br/produto/arroz-branco-tipo-1-camil-5kg",
+        "source_id": "123",
+        "price": 3299,
+        "quantity": None,
+        "unit_of_measure": None,
+        "extraction_url": "https://www.marche.com.br/categoria/mercearia?page=1",
+        "extraction_date": datetime(2026, 10, 1, 8, 0),
+        "currency": "BRL",
+        "is_processed": False,
+    }
+    row.update(values)
+    return row
+
+
+def test_process_chunk_without_brand():
+    # St Marche doesn't publish the brand of its products
+    db = FakeTransaction()
+    main.process_chunk(db, _empty_caches(), [_stage_row()])
+
+    assert db.params_of("insert_brand") == []
+    name, normalized_name, quantity, id_brand = db.params_of("insert_product")[0]
+    assert normalized_name == "Arroz branco tipo 1 camil 5kg"
+    assert id_brand is None
+    assert db.params_of("mark_scraped_products_processed") == [([1],)]
+
+    # No advisory lock is taken for the missing brand
+    for (lock_names,) in db.params_of("lock_keys"):
+        assert not any(lock_name.startswith("brands:") for lock_name in lock_names)
+
+
+def test_process_chunk_mixed_brands():
+    db = FakeTransaction()
+    rows = [
+        _stage_row(),
+        _stage_row(
+            id=2,
+            name="Feijão Carioca Camil 1kg",
+            market="Tenda",
+            brand="CAMIL",
+            product_url="https://www.tendaatacado.com.br/produto/feijao-carioca-camil-1kg",
+        ),
+    ]
+    main.process_chunk(db, _empty_caches(), rows)
+
+    assert db.params_of("insert_brand") == [("CAMIL", "Camil")]
+    id_brands = [params[3] for params in db.params_of("insert_product")]
+    assert id_brands[0] is None
+    assert id_brands[1] is not None
+    assert db.params_of("mark_scraped_products_processed") == [([1, 2],)]
+
+
+def _stage_discount(discount_type, discounted_price, conditions_text=None, min_quantity=None):
+    return {
+        "product_id": 1,
+        "type": discount_type,
+        "discounted_price": discounted_price,
+        "conditions_text": conditions_text,
+        "conditions_min_quantity": min_quantity,
+        "conditions_buy_quantity": None,
+        "conditions_get_quantity": None,
+    }
+
+
+def test_build_discounts_only_unconditioned_card_and_wholesale():
+    discounts = main._build_discounts(
+        [
+            _stage_discount("WHOLESALE", 900, min_quantity=3),
+            _stage_discount("CARD", 950),
+            _stage_discount("CARD", 800, conditions_text="Leve 2"),
+            _stage_discount("BUY_X_GET_Y", 500, conditions_text="Leve 3 pague 2"),
+            _stage_discount("PERCENTAGE_QUANTITY", 700),
+        ]
+    )
+    assert discounts == [(900, "WHOLESALE", 3, 1), (950, "CARD", None, 1)]
+
+
+def test_disconnect_before_forking_the_workers(monkeypatch):
+    closed = []
+    monkeypatch.setattr(main, "close_pool", lambda: closed.append(True))
+    monkeypatch.setattr(main, "client", None)
+
+    main._connect()
+    assert main.client is not None and main.client.queries == main.QUERIES
+
+    # The workers create their own client and pool after the fork
+    main._disconnect()
+    assert main.client is None
+    assert closed == [True]
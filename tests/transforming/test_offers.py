@@ -0,0 +1,88 @@
+from datetime import datetime
+
+from offers import OFFER_COLUMNS, build_offer, expire_offers, update_offers
+
+
+class RecordingTransaction:
+    def __init__(self):
+        self.calls = []
+
+    def execute_named(self, name, params=None):
+        self.calls.append((name, params))
+        return []
+
+
+def _offer(id_supermarket, id_product, value=1000, day=1):
+    row = {
+        "id_supermarket": id_supermarket,
+        "id_product": id_product,
+        "extraction_date": datetime(2026, 10, day),
+    }
+    return build_offer(id_product * 10 + id_supermarket, row, value, "BRL", [])
+
+
+def test_update_offers_locks_products_before_writing():
+    db = RecordingTransaction()
+    update_offers(db, [_offer(2, 7), _offer(1, 7), _offer(1, 3), _offer(1, 3, day=2)])
+
+    assert [name for name, _ in db.calls] == ["lock_keys", "upsert_current_prices", "refresh_best_offers"]
+    assert db.calls[0][1] == (["offers:3", "offers:7"],)
+
+    # One row per (supermarket, product), the most recent one, in key order
+    columns = dict(zip(OFFER_COLUMNS, db.calls[1][1]))
+    assert list(zip(columns["id_supermarket"], columns["id_product"])) == [(1, 3), (1, 7), (2, 7)]
+    assert columns["last_seen"][0] == datetime(2026, 10, 2)
+    assert db.calls[2][1] == ([3, 7],)
+
+
+def test_update_offers_without_offers():
+    db = RecordingTransaction()
+    update_offers(db, [])
+    assert db.calls == []
+
+
+def test_build_offer_best_value_only_card_and_wholesale():
+    row = {"id_supermarket": 1, "id_product": 2, "extraction_date": datetime(2026, 10, 1)}
+    discounts = [
+        (500, "BUY_X_GET_Y", None, 1),
+        (600, "PERCENTAGE_QUANTITY", 2, 1),
+        (900, "WHOLESALE", 3, 1),
+        (950, "CARD", None, 1),
+    ]
+    offer = build_offer(10, row, 1000, "BRL", discounts)
+    assert (offer["best_value"], offer["best_condition_type"]) == (900, "WHOLESALE")
+
+    offer = build_offer(10, row, 1000, "BRL", discounts[:2])
+    assert (offer["best_value"], offer["best_condition_type"]) == (1000, None)
+
+
+class ExpiringTransaction(RecordingTransaction):
+    def __init__(self, expired):
+        super().__init__()
+        self.expired = expired
+
+    def execute_named(self, name, params=None):
+        super().execute_named(name, params)
+        if name == "load_expired_current_prices":
+            return self.expired
+        return []
+
+
+def test_expire_offers():
+    db = ExpiringTransaction(
+        [{"id_supermarket": 1, "id_product": 9}, {"id_supermarket": 1, "id_product": 4}]
+    )
+    assert expire_offers(db, "St marche", 48) == 2
+    assert db.calls == [
+        ("load_expired_current_prices", ("St marche", 48)),
+        ("lock_keys", (["offers:4", "offers:9"],)),
+        ("delete_current_prices", ([1, 1], [4, 9])),
+        ("refresh_best_offers", ([4, 9],)),
+        ("delete_orphan_best_offers", ([4, 9],)),
+    ]
+
+
+def test_expire_offers_nothing_expired():
+    db = ExpiringTransaction([])
+    assert expire_offers(db, "Tenda", 48) == 0
+    assert [name for name, _ in db.calls] == ["load_expired_current_prices"]
@@ -0,0 +1,22 @@
+from result_cache import QueryResultCache
+
+QUERY = "SELECT id_product, best_value FROM best_offers WHERE id_product = ANY(%s)"
+ROWS = [{"id_product": 1, "best_value": 900}]
+
+
+def test_entries_are_served_only_for_the_same_table_versions():
+    cache = QueryResultCache()
+    cache.put(QUERY, ([1],), ROWS, ttl=60, versions=(("best_offers", 3),))
+
+    assert cache.get(QUERY, ([1],), (("best_offers", 3),)) == ROWS
+    # Another process wrote best_offers
+    assert cache.get(QUERY, ([1],), (("best_offers", 4),)) is None
+    # The outdated entry is dropped
+    assert cache.get(QUERY, ([1],), (("best_offers", 3),)) is None
+
+
+def test_writes_of_this_process_invalidate_the_readers():
+    cache = QueryResultCache()
+    cache.put(QUERY, ([1],), ROWS, ttl=60, versions=(("best_offers", 3),))
+    cache.invalidate_query("DELETE FROM best_offers WHERE id_product = ANY(%s)")
+    assert cache.get(QUERY, ([1],), (("best_offers", 3),)) is None
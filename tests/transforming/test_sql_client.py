@@ -0,0 +1,176 @@
+import gc
+import json
+import os
+import weakref
+
+import pytest
+
+pytest.importorskip("psycopg2")
+pytest.importorskip("dotenv")
+
+import sql_client  # noqa: E402
+
+
+class FakePool:
+    """Stands for ThreadedConnectionPool, without connecting to the database"""
+
+    def __init__(self, *args, **kwargs):
+        self.closed = False
+
+    def closeall(self):
+        self.closed = True
+
+
+@pytest.fixture
+def fake_pool(monkeypatch):
+    monkeypatch.setattr(sql_client.psycopg2.pool, "ThreadedConnectionPool", FakePool)
+    monkeypatch.setattr(sql_client, "_POOL", None)
+    monkeypatch.setattr(sql_client, "_POOL_PID", None)
+    monkeypatch.setattr(sql_client, "_INHERITED_POOLS", [])
+
+
+@pytest.mark.skipif(not hasattr(os, "fork"), reason="needs os.fork")
+# The background thread of the logger is running, the child only touches the pool
+@pytest.mark.filterwarnings("ignore:This process .* is multi-threaded")
+def test_fork_after_the_pool_is_used_keeps_the_parent_connections(fake_pool):
+    parent_pool = sql_client._get_pool()
+    read_fd, write_fd = os.pipe()
+
+    pid = os.fork()
+    if pid == 0:
+        # Child: a new pool, and the inherited one is neither closed nor deallocated
+        try:
+            inherited = weakref.ref(parent_pool)
+            child_pool = sql_client._get_pool()
+            del parent_pool
+            gc.collect()
+            result = {
+                "new_pool": child_pool is not inherited(),
+                "inherited_alive": inherited() is not None,
+                "inherited_closed": inherited() is not None and inherited().closed,
+            }
+            os.write(write_fd, json.dumps(result).encode())
+        finally:
+            os._exit(0)
+
+    os.close(write_fd)
+    _, status = os.waitpid(pid, 0)
+    with os.fdopen(read_fd) as pipe:
+        result = json.loads(pipe.read())
+
+    assert status == 0
+    assert result == {"new_pool": True, "inherited_alive": True, "inherited_closed": False}
+    assert sql_client._get_pool() is parent_pool
+    assert not parent_pool.closed
+
+
+def test_close_pool_before_forking_workers(fake_pool):
+    pool = sql_client._get_pool()
+    sql_client.close_pool()
+
+    assert pool.closed
+    # The next use in this process opens a new pool
+    assert sql_client._get_pool() is not pool
+
+
+QUERY = "SELECT id_product, best_value FROM best_offers WHERE id_product = ANY(%s)"
+ROWS = [{"id_product": 1, "best_value": 900}]
+
+
+class FakeCursor:
+    def __init__(self, conn):
+        self.conn = conn
+        self.description = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def execute(self, query, params=None):
+        self.conn.executed.append(query)
+        if self.conn.fail_on and self.conn.fail_on in query:
+            raise RuntimeError("connection lost")
+        if "table_versions" in query:
+            self.rows = [("best_offers", 3)]
+        else:
+            self.description = [("id_product",), ("best_value",)]
+            self.rows = [(1, 900)]
+
+    def fetchall(self):
+        return self.rows
+
+    def close(self):
+        pass
+
+
+class FakeConnection:
+    def __init__(self, fail_on=None):
+        self.executed = []
+        self.fail_on = fail_on
+        self.closed = False
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+
+@pytest.fixture
+def query_client(monkeypatch):
+    monkeypatch.setattr(sql_client, "_TABLE_VERSIONS", {})
+    sql_client.RESULT_CACHE.clear()
+    client = sql_client.create_query_client("test")
+    client.connections = []
+    client.released = []
+    client.fail_on = None
+
+    def connect():
+        conn = FakeConnection(client.fail_on)
+        client.connections.append(conn)
+        return conn
+
+    monkeypatch.setattr(client, "_connect_db", connect)
+    monkeypatch.setattr(client, "_release_db", client.released.append)
+    yield client
+    sql_client.RESULT_CACHE.clear()
+
+
+def test_cache_hits_with_recent_versions_dont_use_the_database(query_client):
+    assert query_client.execute_query(QUERY, ([1],), cache_ttl=60) == ROWS
+    assert query_client.execute_query(QUERY, ([1],), cache_ttl=60) == ROWS
+
+    # Only the first call borrowed a connection, for the versions and the query
+    assert len(query_client.connections) == 1
+    assert len(query_client.connections[0].executed) == 2
+
+
+def test_expired_versions_are_read_again(query_client, monkeypatch):
+    monkeypatch.setattr(sql_client, "TABLE_VERSIONS_TTL", 0)
+    query_client.execute_query(QUERY, ([1],), cache_ttl=60)
+    assert query_client.execute_query(QUERY, ([1],), cache_ttl=60) == ROWS
+
+    # Same versions: served from the cache after reading them
+    assert len(query_client.connections) == 2
+    assert query_client.connections[1].executed == [sql_client.TABLE_VERSIONS_QUERY]
+
+
+def test_writes_of_this_process_drop_the_recent_versions(query_client):
+    query_client.execute_query(QUERY, ([1],), cache_ttl=60)
+    query_client._tables_written(FakeConnection(), {"best_offers"})
+
+    query_client.execute_query(QUERY, ([1],), cache_ttl=60)
+    assert len(query_client.connections) == 2
+
+
+def test_the_connection_is_released_when_reading_the_versions_fails(query_client):
+    query_client.fail_on = "table_versions"
+    with pytest.raises(RuntimeError):
+        query_client.execute_query(QUERY, ([1],), cache_ttl=60)
+
+    assert query_client.released == query_client.connections
@@ -0,0 +1,65 @@
+import re
+import unicodedata
+
+import pytest
+
+from utils import normalize_many, normalize_word
+
+
+def reference_normalize_word(word):
+    """normalize_word before the precompiled and memoized version"""
+    word = word.lower()
+    word = ''.join(c for c in unicodedata.normalize('NFD', word) if unicodedata.category(c) != 'Mn')
+    word = re.sub(r'[^a-z0-9 ]', '', word)
+    word = re.sub(r'\s+', ' ', word).strip()
+    word = word.capitalize()
+    return word
+
+
+CORPUS = [
+    "",
+    " ",
+    "   \t\n ",
+    "Açúcar Refinado União 1kg",
+    "FEIJÃO CARIOCA  CAMIL 1KG",
+    "Pão de Queijo Forno de Minas 400g",
+    "Café Pilão Tradicional 500 g",
+    "Maçã Fuji (kg)",
+    "Leite Integral Piracanjuba 1L - Cx c/ 12",
+    "Óleo de Soja Liza 900ml",
+    "Coca-Cola Zero 2,5L",
+    "Biscoito Trakinas 126g!!!",
+    "São João 100% Natural",
+    "Crème Brûlée Ñoño",
+    "Água Mineral s/ Gás 1,5 L",
+    "Sabão em Pó OMO 1.6kg #promo",
+    "  espaços   no   início e no fim  ",
+    "ÇÃÕÉÍÓÚÂÊÔÀ",
+    "ﬁ ligature ½ ™ ©",
+    "日本語 テキスト",
+    "123 456",
+    "St Marche",
+    "ST. MARCHÉ",
+]
+
+
+@pytest.mark.parametrize("word", CORPUS)
+def test_normalize_word_matches_reference(word):
+    assert normalize_word(word) == reference_normalize_word(word)
+    # Second call served by the cache
+    assert normalize_word(word) == reference_normalize_word(word)
+    assert normalize_word.__wrapped__(word) == reference_normalize_word(word)
+
+
+def test_normalize_word_none_fails_as_reference():
+    with pytest.raises(AttributeError):
+        reference_normalize_word(None)
+    with pytest.raises(AttributeError):
+        normalize_word(None)
+
+
+def test_normalize_many():
+    words = CORPUS + CORPUS[::-1] + [None]
+    assert normalize_many(words) == [
+        None if word is None else reference_normalize_word(word) for word in words
+    ]